@@ -0,0 +1,295 @@
+# Copyright (c) 2017 Agatti Software Labs. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+import eventlet
+from eventlet import semaphore
+from oslo_log import log as logging
+
+from manila.share.drivers.freenas.freenasapi import FreeNASApiError
+from manila.share.drivers.freenas.freenasapi import FreeNASServer
+
+LOG = logging.getLogger(__name__)
+
+
+# Non-blocking FreeNAS REST API calls on eventlet green threads
+class FreeNASFuture(object):
+    """Handle to a FreeNAS call running on a green thread."""
+
+    def __init__(self, description):
+        self.description = description
+        self._thread = None
+        self._cancelled = False
+
+    def _start(self, func, *args, **kwargs):
+        self._thread = eventlet.spawn(func, *args, **kwargs)
+
+    def done(self):
+        return self._cancelled or self._thread.dead
+
+    def cancel(self):
+        """Cancel the call. Has no effect once it has finished."""
+        if self._thread.dead:
+            return False
+        self._cancelled = True
+        self._thread.kill()
+        return True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def wait(self):
+        """Block the calling green thread until the call finishes.
+
+        Returns the call result, re-raises its exception, or raises
+        FreeNASApiError if the call was cancelled.
+        """
+        if not self._cancelled:
+            result = self._thread.wait()
+        if self._cancelled:
+            raise FreeNASApiError('Cancelled', self.description)
+        return result
+
+
+class FreeNASAsyncServer(object):
+    """Asynchronous client with the command surface of FreeNASServer.
+
+    Each submitted command runs on its own green thread over the pooled
+    transport of the wrapped FreeNASServer, so the socket layer must be
+    eventlet monkey patched (as it is in manila-share). At most
+    max_concurrency commands per appliance host are in flight at once,
+    shared between all clients of that host. Clients configured with
+    different max_concurrency share the smallest one.
+    """
+
+    # host -> [max_concurrency, semaphore]
+    _host_limits = {}
+    _host_limits_lock = threading.Lock()
+
+    def __init__(self, server, max_concurrency=8, timeout=None):
+        self._server = server
+        self._timeout = timeout
+        host = server.get_host()
+        with self._host_limits_lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = [
+                    max_concurrency, semaphore.Semaphore(max_concurrency)]
+            limit = self._host_limits[host]
+            if max_concurrency < limit[0]:
+                self._lower_limit(limit[1], limit[0] - max_concurrency)
+                limit[0] = max_concurrency
+            self._limit = limit[1]
+
+    @staticmethod
+    def _lower_limit(limit, count):
+        # Slots are taken for good, those in use as soon as they are freed.
+        for _ in range(count):
+            if not limit.acquire(blocking=False):
+                eventlet.spawn_n(limit.acquire)
+
+    def get_server(self):
+        return self._server
+
+    def _invoke(self, description, timeout, func, *args, **kwargs):
+        timer = eventlet.Timeout(timeout)
+        try:
+            with self._limit:
+                return func(*args, **kwargs)
+        except eventlet.Timeout as t:
+            if t is not timer:
+                raise
+            raise FreeNASApiError('Timeout', '%s did not finish in %ss' %
+                                  (description, timeout))
+        finally:
+            timer.cancel()
+
+    def submit(self, command_d, request_d, param_list, timeout=None):
+        """Start an invoke_command call and return its FreeNASFuture."""
+        if timeout is None:
+            timeout = self._timeout
+        description = '%s %s' % (command_d, request_d)
+        future = FreeNASFuture(description)
+        future._start(self._invoke, description, timeout,
+                      self._server.invoke_command, command_d, request_d,
+                      param_list)
+        return future
+
+    def select(self, request_d, timeout=None):
+        return self.submit(FreeNASServer.SELECT_COMMAND, request_d, None,
+                           timeout=timeout)
+
+    def create(self, request_d, param_list, timeout=None):
+        return self.submit(FreeNASServer.CREATE_COMMAND, request_d,
+                           param_list, timeout=timeout)
+
+    def update(self, request_d, param_list, timeout=None):
+        return self.submit(FreeNASServer.UPDATE_COMMAND, request_d,
+                           param_list, timeout=timeout)
+
+    def delete(self, request_d, timeout=None):
+        return self.submit(FreeNASServer.DELETE_COMMAND, request_d, None,
+                           timeout=timeout)
+
+    def spawn(self, func, *args, **kwargs):
+        """Run an operation made of several API calls on a green thread.
+
+        Spawned operations are not counted against the per-host limit.
+        """
+        description = getattr(func, '__name__', repr(func))
+        future = FreeNASFuture(description)
+        future._start(func, *args, **kwargs)
+        return future
+
+    def paginate(self, request_d, page_size, fields=None):
+        """Yield the records of a listing fetched page by page.
+
+        Pages are requested with limit/offset. The next page is fetched on
+        a green thread while the caller consumes the current one.
+        """
+        separator = '&' if '?' in request_d else '?'
+
+        def _fetch(offset):
+            page_req = '%s%slimit=%d&offset=%d' % (request_d, separator,
+                                                   page_size, offset)
+            with self._limit:
+                return list(self._server.iter_command(page_req, fields))
+
+        offset = 0
+        pending = eventlet.spawn(_fetch, offset)
+        try:
+            while pending is not None:
+                page = pending.wait()
+                offset += len(page)
+                pending = None
+                if len(page) == page_size:
+                    pending = eventlet.spawn(_fetch, offset)
+                for record in page:
+                    yield record
+        finally:
+            if pending is not None:
+                pending.kill()
+
+    @staticmethod
+    def wait_all(futures):
+        """Wait for all futures; returns a list of (result, error) tuples."""
+        results = []
+        for future in futures:
+            try:
+                results.append((future.wait(), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
+
+
+class FreeNASJob(object):
+    """A long running share operation tracked by FreeNASJobTracker."""
+
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, job_id, kind, future):
+        self.job_id = job_id
+        self.kind = kind
+        self.future = future
+        self.state = self.RUNNING
+        self.result = None
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+
+
+class FreeNASJobTracker(object):
+    """Follows running jobs from one shared poller green thread.
+
+    The poller checks all running jobs, sleeping min_interval after a job
+    finished and twice as long after each idle round, up to max_interval.
+    It exits when no job is running and is restarted by the next track().
+    Finished jobs are kept for retention seconds so their outcome can be
+    read.
+
+    FreeNAS v1.0 has no job API, a job is the local green thread running
+    the synchronous request and polling only checks whether it ended.
+    """
+
+    def __init__(self, min_interval=0.5, max_interval=10, retention=3600):
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._retention = retention
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._poller = None
+
+    def track(self, job_id, kind, future):
+        """Follow the FreeNASFuture of an operation; returns its job."""
+        job = FreeNASJob(job_id, kind, future)
+        with self._lock:
+            self._jobs[job_id] = job
+            if self._poller is None:
+                self._poller = eventlet.spawn(self._poll)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def pop(self, job_id):
+        with self._lock:
+            return self._jobs.pop(job_id, None)
+
+    def running(self):
+        return [job for job in self._jobs.values()
+                if job.state == FreeNASJob.RUNNING]
+
+    def _finish(self, job):
+        try:
+            job.result = job.future.wait()
+            job.state = FreeNASJob.DONE
+        except Exception as e:
+            LOG.warning('FreeNAS %(kind)s job %(id)s failed: %(err)s',
+                        {'kind': job.kind, 'id': job.job_id, 'err': e})
+            job.error = e
+            job.state = FreeNASJob.FAILED
+        job.finished = time.time()
+
+    def poll(self):
+        """Check the running jobs once; returns how many finished."""
+        finished = 0
+        now = time.time()
+        with self._lock:
+            jobs = list(self._jobs.values())
+            for job in jobs:
+                if (job.state != FreeNASJob.RUNNING and
+                        now - job.finished > self._retention):
+                    del self._jobs[job.job_id]
+        for job in jobs:
+            if job.state == FreeNASJob.RUNNING and job.future.done():
+                self._finish(job)
+                finished += 1
+        return finished
+
+    def _poll(self):
+        interval = self._min_interval
+        while True:
+            eventlet.sleep(interval)
+            if self.poll():
+                interval = self._min_interval
+            else:
+                interval = min(interval * 2, self._max_interval)
+            with self._lock:
+                if not any(job.state == FreeNASJob.RUNNING
+                           for job in self._jobs.values()):
+                    self._poller = None
+                    return
@@ -13,11 +13,24 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import time
+
+import eventlet
+import six
+
+from manila.common import constants
 from manila import exception
 from manila.i18n import _
 from manila.share import driver
+from manila.share.drivers.freenas.asyncapi import FreeNASJob
+from manila.share.drivers.freenas.asyncapi import FreeNASJobTracker
+from manila.share.drivers.freenas.freenasapi import FreeNASApiError
 from manila.share.drivers.freenas import options
 from manila.share.drivers.freenas import process_req
+from manila.share.drivers.freenas.replication import FreeNASReplica
+from manila.share.drivers.freenas.replication import FreeNASReplicator
+from manila.share import utils as share_utils
 from oslo_log import log
 
 
@@ -49,11 +62,81 @@ class FreeNasDriver(driver.ShareDriver):
                 options.freenas_dataset_opts)
             self.configuration.append_config_values(
                 options.freenas_transport_opts)
+            self.configuration.append_config_values(
+                options.freenas_replication_opts)
+            self.configuration.append_config_values(
+                options.freenas_retention_opts)
             self.helper = process_req.FreeNASProcessRequests(self.configuration)
+            self.helpers = self._create_helpers()
+            # Pool name -> (time read, processor stats) of the last good read.
+            self._pool_stats = {}
+            self._stats_error = None
+            self._stats_refresher = None
+            self.jobs = FreeNASJobTracker(
+                self.configuration.freenas_job_poll_interval,
+                self.configuration.freenas_job_poll_max_interval)
+            self.replicator = FreeNASReplicator(
+                self.configuration.freenas_replication_interval,
+                self.configuration.freenas_max_workers)
         else:
             raise exception.BadConfigurationException(
                 reason=_('FreeNAS configuration missing.'))
 
+    def _create_helpers(self):
+        """One request processor per manila pool, keyed by pool name.
+
+        The first is the freenas_dataset zpool on freenas_server_hostname,
+        followed by the freenas_pools entries.
+        """
+        helpers = collections.OrderedDict()
+        helpers[self.helper.pool_name] = self.helper
+        for entry in self.configuration.freenas_pools:
+            hostname, _sep, dataset = entry.rpartition(':')
+            if not dataset or entry in helpers:
+                raise exception.BadConfigurationException(
+                    reason=_('Invalid or duplicate FreeNAS pool %s.') % entry)
+            helpers[entry] = process_req.FreeNASProcessRequests(
+                self.configuration, hostname=hostname or None,
+                dataset=dataset, pool_name=entry)
+        return helpers
+
+    def _get_helper(self, share):
+        """Request processor of the pool a share was placed on."""
+        host = share.get('host')
+        if not host:
+            return self.helper
+        pool = share_utils.extract_host(host, level='pool')
+        if not pool:
+            return self.helper
+        if pool not in self.helpers:
+            raise exception.InvalidShare(
+                reason=_('Unknown FreeNAS pool %s.') % pool)
+        return self.helpers[pool]
+
+    def _run_per_helper(self, items, get_share, operation,
+                        unknown_pool=None):
+        """Run a bulk processor operation on every pool concurrently.
+
+        items are grouped by the pool of get_share(item) and the per pool
+        result dicts of operation(helper, items), keyed by item id, are
+        merged. Items on an unknown pool get unknown_pool(error) as result,
+        {'error': message} by default.
+        """
+        groups = collections.OrderedDict()
+        results = {}
+        for item in items:
+            try:
+                helper = self._get_helper(get_share(item))
+            except exception.InvalidShare as e:
+                results[item['id']] = (unknown_pool(e) if unknown_pool else
+                                       {'error': six.text_type(e)})
+                continue
+            groups.setdefault(helper, []).append(item)
+        pool = eventlet.GreenPool(len(groups) or 1)
+        for result in pool.starmap(operation, groups.items()):
+            results.update(result)
+        return results
+
     @property
     def share_backend_name(self):
         if not hasattr(self, '_share_backend_name'):
@@ -68,52 +151,418 @@ class FreeNasDriver(driver.ShareDriver):
     def do_setup(self, context):
         """Any initialization the FreeNAS driver does while starting."""
         LOG.debug('Setting up the FreeNAS plugin.')
-        return self.helper.do_setup()
+        handles = {}
+        for helper in self.helpers.values():
+            helper.do_setup(handle=handles.get(helper.hostname))
+            handles[helper.hostname] = helper.handle
 
     def check_for_setup_error(self):
         """check for after setup error"""
-        self.helper.check_for_setup_error()
+        for helper in self.helpers.values():
+            helper.check_for_setup_error()
 
     def create_share(self, context, share, share_server=None):
         """Create a NFS share."""
         LOG.debug('Creating share:  %s', share['name'])
-        return self.helper.create_dataset(share)
+        return self._get_helper(share).create_dataset(share)
+
+    def create_shares(self, context, shares, share_server=None):
+        """Create many NFS shares at once.
+
+        Returns a dict keyed by share id with either 'export_locations' or
+        'error' for each share.
+        """
+        LOG.debug('Creating %d shares', len(shares))
+        return self._run_per_helper(
+            shares, lambda share: share,
+            lambda helper, group: helper.create_datasets(group))
 
     def create_share_from_snapshot(self, context, share, snapshot,
                                    share_server=None):
         LOG.debug('Creating share: %s  from snapshot %s',
                   share['name'], snapshot['name'])
-        return self.helper.create_share_from_snapshot(share, snapshot)
+        # ZFS clones live in the zpool of their origin snapshot.
+        helper = self._get_helper(snapshot['share'])
+        if self.configuration.freenas_async_operations:
+            self._submit_job(helper, share,
+                             constants.STATUS_CREATING_FROM_SNAPSHOT,
+                             helper.create_share_from_snapshot, share,
+                             snapshot)
+            return {'status': constants.STATUS_CREATING_FROM_SNAPSHOT}
+        return helper.create_share_from_snapshot(share, snapshot)
 
     def delete_share(self, context, share, share_server=None):
         """Delete a share."""
         LOG.debug('Deleting share %s:', share['name'])
-        self.helper.delete_share(share)
+        self._get_helper(share).delete_share(share)
+
+    def _submit_job(self, helper, share, kind, func, *args):
+        """Run a share operation as a background job tracked by share id."""
+        LOG.debug('Starting %(kind)s job for share %(id)s',
+                  {'kind': kind, 'id': share['id']})
+        return self.jobs.track(share['id'], kind, helper.submit(func, *args))
+
+    def get_share_status(self, share, share_server=None):
+        """Status of a share created from a snapshot in the background.
+
+        manila polls it while the share is creating_from_snapshot. Finished
+        jobs are reported once and then forgotten. Without a job, e.g.
+        after a restart, the dataset on the appliance decides.
+        """
+        job = self.jobs.get(share['id'])
+        if job is None:
+            return self._get_helper(share).get_share_status(share)
+        if job.state == FreeNASJob.RUNNING:
+            return {'status': job.kind}
+        self.jobs.pop(share['id'])
+        if job.state == FreeNASJob.DONE:
+            return {'status': constants.STATUS_AVAILABLE,
+                    'export_locations': job.result}
+        return {'status': constants.STATUS_ERROR}
+
+    def ensure_shares(self, context, shares):
+        """Confirm all shares of the backend with bulk listings."""
+        LOG.debug('Ensuring %d shares', len(shares))
+        return self._run_per_helper(
+            shares, lambda share: share,
+            lambda helper, group: helper.ensure_shares(group),
+            unknown_pool=lambda e: {'status': constants.STATUS_ERROR})
+
+    def get_backend_info(self, context):
+        """Fingerprint of the settings export locations depend on.
+
+        manila skips ensure_shares after a restart while it is unchanged.
+        """
+        return {
+            'driver_version': VERSION,
+            'pools': ','.join('%s:%s=%s' % (helper.hostname, helper.dataset,
+                                            pool_name)
+                              for pool_name, helper in self.helpers.items()),
+            'nfs_mount_point_base':
+                self.configuration.freenas_mount_point_base,
+            'storage_protocol': self.configuration.freenas_storage_protocol,
+        }
 
     def extend_share(self, share, new_size, share_server=None):
         """Extends a share."""
         LOG.debug('Extending share %(name)s to %(size)sG.', {
             'name': share['name'], 'size': new_size})
-        self.helper.set_quota(share, new_size)
+        self._get_helper(share).set_quota(share, new_size)
+
+    def shrink_share(self, share, new_size, share_server=None):
+        """Shrinks a share, refusing to go below its used space."""
+        LOG.debug('Shrinking share %(name)s to %(size)sG.', {
+            'name': share['name'], 'size': new_size})
+        self._get_helper(share).shrink_share(share, new_size)
+
+    def shrink_shares(self, context, shrinks):
+        """Shrink or right-size many shares at once.
+
+        shrinks are dicts with 'id', 'share' and optionally 'new_size'.
+        Returns a dict keyed by id with either the new 'size' or 'error'.
+        """
+        LOG.debug('Shrinking %d shares', len(shrinks))
+        return self._run_per_helper(
+            shrinks, lambda shrink: shrink['share'],
+            lambda helper, group: helper.shrink_shares(group))
+
+    def prune_snapshots(self, context, dry_run=False):
+        """Prune expired snapshots on all pools concurrently.
+
+        Returns a dict keyed by pool name with the pruning report of each
+        pool, or 'error' for pools that could not be listed.
+        """
+        def _prune(helper):
+            try:
+                return helper.pool_name, helper.prune_snapshots(dry_run)
+            except Exception as e:
+                LOG.warning('Snapshot pruning of pool %(pool)s failed: '
+                            '%(err)s', {'pool': helper.pool_name, 'err': e})
+                return helper.pool_name, {'error': six.text_type(e)}
+
+        pool = eventlet.GreenPool(len(self.helpers) or 1)
+        return dict(pool.imap(_prune, self.helpers.values()))
 
     def create_snapshot(self, context, snapshot, share_server=None):
         """Create Snapshot"""
         LOG.debug('Creating a snapshot of share %s', snapshot['share_name'])
-        return self.helper.create_snapshot(snapshot)
+        return self._get_helper(snapshot['share']).create_snapshot(snapshot)
+
+    def create_snapshots(self, context, snapshots, share_server=None):
+        """Create snapshots of many shares at once.
+
+        Returns a dict keyed by snapshot id with either 'provider_location'
+        or 'error' for each snapshot.
+        """
+        LOG.debug('Creating %d snapshots', len(snapshots))
+        return self._run_per_helper(
+            snapshots, lambda snapshot: snapshot['share'],
+            lambda helper, group: helper.create_snapshots(group))
 
     def delete_snapshot(self, context, snapshot, share_server=None):
         LOG.debug('Deleting a snapshot of share %s.', snapshot['share_name'])
-        self.helper.delete_snapshot(snapshot)
+        self._get_helper(snapshot['share']).delete_snapshot(snapshot)
+
+    def revert_to_snapshot(self, context, snapshot, share_access_rules,
+                           snapshot_access_rules, share_server=None):
+        """Revert a share to its latest snapshot with a ZFS rollback."""
+        LOG.debug('Reverting share %(share)s to snapshot %(snap)s',
+                  {'share': snapshot['share_name'], 'snap': snapshot['name']})
+        self._get_helper(snapshot['share']).revert_to_snapshot(snapshot)
+
+    def manage_existing(self, share, driver_options):
+        """Adopt the dataset named by the share export location."""
+        LOG.debug('Managing share %s', share['name'])
+        return self._get_helper(share).manage_existing(share, driver_options)
+
+    def unmanage(self, share):
+        """Forget a share, its dataset is kept as is."""
+        LOG.debug('Unmanaging share %s', share['name'])
+        self._get_helper(share).unmanage(share)
+
+    def _get_replica_helper(self, replica):
+        try:
+            return self._get_helper(replica)
+        except exception.InvalidShare as e:
+            raise exception.ReplicationException(reason=six.text_type(e))
+
+    @staticmethod
+    def _get_active_replica(replica_list):
+        for replica in replica_list:
+            if replica['replica_state'] == constants.REPLICA_STATE_ACTIVE:
+                return replica
+        raise exception.ReplicationException(
+            reason=_('Share has no active replica.'))
+
+    def _get_replica(self, active, replica):
+        return FreeNASReplica(self._get_replica_helper(active),
+                              active['name'],
+                              self._get_replica_helper(replica),
+                              replica['name'])
+
+    def create_replica(self, context, replica_list, new_replica,
+                       access_rules, replica_snapshots, share_server=None):
+        """Replicate the active replica to a pool of this backend.
+
+        Replicas can be placed on any freenas_pools entry, including pools
+        of other appliances.
+        """
+        active = self._get_active_replica(replica_list)
+        replica = self._get_replica(active, new_replica)
+        LOG.debug('Creating replica %(replica)s of %(share)s',
+                  {'replica': new_replica['name'], 'share': active['name']})
+        replica.source.create_replication(active['name'], replica.target,
+                                          new_replica['name'])
+        self.replicator.track(replica)
+        return {
+            'export_locations': replica.target.get_export_locations(
+                new_replica),
+            'replica_state': constants.REPLICA_STATE_OUT_OF_SYNC,
+            'access_rules_status': constants.STATUS_ACTIVE,
+        }
+
+    def delete_replica(self, context, replica_list, replica_snapshots,
+                       replica, share_server=None):
+        active = self._get_active_replica(replica_list)
+        self.replicator.forget(replica['name'])
+        target = self._get_replica_helper(replica)
+        try:
+            self._get_replica_helper(active).delete_replication(
+                active['name'], target, replica['name'])
+        except FreeNASApiError as e:
+            # The site of the active replica may be down.
+            LOG.warning('Could not delete replication of %(share)s to '
+                        '%(replica)s: %(err)s',
+                        {'share': active['name'],
+                         'replica': replica['name'], 'err': e})
+        target.delete_share(replica)
+
+    def update_replica_state(self, context, replica_list, replica,
+                             access_rules, replica_snapshots,
+                             share_server=None):
+        """In sync while the replica lags at most freenas_replication_max_lag.
+        """
+        active = self._get_active_replica(replica_list)
+        replica_obj = self._get_replica(active, replica)
+        # Picks the replica up again after a restart.
+        self.replicator.track(replica_obj)
+        try:
+            if not self.configuration.freenas_replication_interval:
+                replica_obj.source.take_replication_snapshot(active['name'])
+            self.replicator.refresh(replica_obj)
+        except FreeNASApiError as e:
+            LOG.warning('Could not read state of replica %(replica)s: '
+                        '%(err)s', {'replica': replica['name'], 'err': e})
+            return constants.STATUS_ERROR
+        lag = self.replicator.get_lag(replica['name'])
+        if (lag is None or
+                lag > self.configuration.freenas_replication_max_lag):
+            return constants.REPLICA_STATE_OUT_OF_SYNC
+        return constants.REPLICA_STATE_IN_SYNC
+
+    def promote_replica(self, context, replica_list, replica, access_rules,
+                        share_server=None):
+        """Make a replica the active one and replicate from it.
+
+        The former active replica is unexported and becomes a replica. It
+        and the other replicas receive incremental sends from the new
+        active replica, starting from the newest snapshot they share.
+        """
+        old_active = self._get_active_replica(replica_list)
+        target = self._get_replica_helper(replica)
+        LOG.debug('Promoting replica %(replica)s of %(share)s',
+                  {'replica': replica['name'], 'share': old_active['name']})
+        for other in replica_list:
+            if other['id'] == old_active['id']:
+                continue
+            self.replicator.forget(other['name'])
+            try:
+                self._get_replica(old_active, other).source.\
+                    delete_replication(old_active['name'],
+                                       self._get_replica_helper(other),
+                                       other['name'])
+            except (FreeNASApiError, exception.ReplicationException) as e:
+                LOG.warning('Could not stop replication to %(replica)s: '
+                            '%(err)s', {'replica': other['name'], 'err': e})
+
+        target.set_read_only(replica['name'], False)
+        target.update_access(replica, access_rules)
+        updates = [{'id': replica['id'],
+                    'replica_state': constants.REPLICA_STATE_ACTIVE,
+                    'access_rules_status': constants.STATUS_ACTIVE}]
+        for other in replica_list:
+            if other['id'] == replica['id']:
+                continue
+            try:
+                new_replica = self._get_replica(replica, other)
+                if other['id'] == old_active['id']:
+                    new_replica.target.update_access(other, [])
+                new_replica.source.create_replication(
+                    replica['name'], new_replica.target, other['name'])
+                self.replicator.track(new_replica)
+                state = constants.REPLICA_STATE_OUT_OF_SYNC
+            except Exception as e:
+                LOG.warning('Could not replicate %(share)s to %(replica)s: '
+                            '%(err)s', {'share': replica['name'],
+                                        'replica': other['name'], 'err': e})
+                state = constants.STATUS_ERROR
+            updates.append({'id': other['id'], 'replica_state': state})
+        return updates
 
     def update_access(self, context, share, access_rules, add_rules,
                       delete_rules, share_server=None):
-        # TODO(RS-AGT): Need to add user specific access for share
-        # Currently passing default access permission for Share.
-        pass
+        """Update the NFS clients allowed to mount a share.
+
+        Only IP rules are supported, others are set to error and the rest
+        is applied. All rules of a share must have the same access level,
+        FreeNAS sets read-only per export.
+        """
+        LOG.debug('Updating access to share %(name)s: %(add)d added, '
+                  '%(del)d deleted', {'name': share['name'],
+                                      'add': len(add_rules or []),
+                                      'del': len(delete_rules or [])})
+        return self._get_helper(share).update_access(share, access_rules,
+                                                     add_rules, delete_rules)
+
+    def resync_shares_access(self, context, updates):
+        """Resync the access rules of many shares concurrently.
+
+        updates are dicts with 'id', 'share' and 'access_rules'. Returns a
+        dict keyed by id, with 'error' for each share that failed.
+        """
+        LOG.debug('Resyncing access to %d shares', len(updates))
+        return self._run_per_helper(
+            updates, lambda update: update['share'],
+            lambda helper, group: helper.resync_shares_access(group))
+
+    def _read_pool_stats(self, helper):
+        """Stats of one pool, bounded by freenas_stats_timeout."""
+        timeout = self.configuration.freenas_stats_timeout
+        timer = eventlet.Timeout(timeout)
+        try:
+            return helper.update_share_stats()
+        except eventlet.Timeout as t:
+            if t is not timer:
+                raise
+            raise FreeNASApiError('Timeout', 'stats of pool %s not read in '
+                                  '%ss' % (helper.pool_name, timeout))
+        finally:
+            timer.cancel()
+
+    def _refresh_share_stats(self):
+        """Read the stats of all pools from their appliances in parallel.
+
+        A pool that fails or misses the deadline keeps its last good stats.
+        """
+        def _read(helper):
+            try:
+                return helper, self._read_pool_stats(helper), None
+            except Exception as e:
+                LOG.warning('Could not read stats of FreeNAS pool %s: %s',
+                            helper.pool_name, e)
+                return helper, None, e
+
+        pool = eventlet.GreenPool(len(self.helpers))
+        for helper, stats, err in pool.imap(_read, self.helpers.values()):
+            if err:
+                self._stats_error = err
+            else:
+                self._pool_stats[helper.pool_name] = (time.time(), stats)
+
+    def _run_stats_refresher(self):
+        interval = self.configuration.freenas_stats_refresh_interval
+        while True:
+            eventlet.sleep(interval)
+            try:
+                self._refresh_share_stats()
+            except Exception:
+                LOG.exception('FreeNAS stats refresh failed.')
+
+    def _collect_share_stats(self):
+        """Last good stats of all pools, each with its age in seconds.
+
+        Pools that were never read are left out, the call only fails when
+        no pool has been read yet.
+        """
+        if self.configuration.freenas_stats_refresh_interval == 0:
+            self._refresh_share_stats()
+        elif self._stats_refresher is None:
+            # First call: read synchronously, then keep refreshing in the
+            # background.
+            self._refresh_share_stats()
+            self._stats_refresher = eventlet.spawn(self._run_stats_refresher)
+
+        data = None
+        pools = []
+        api_stats = {}
+        now = time.time()
+        # Replicas are placed on another pool of this backend, so a single
+        # pool backend cannot replicate.
+        replication = ({'replication_type': 'dr'}
+                       if len(self.helpers) > 1 else {})
+        for helper in self.helpers.values():
+            if helper.pool_name not in self._pool_stats:
+                continue
+            read_at, stats = self._pool_stats[helper.pool_name]
+            data = data or dict(stats)
+            for pool in stats['pools']:
+                pool = dict(pool, stats_age=int(now - read_at))
+                pool.update(replication)
+                pools.append(pool)
+            api_stats[helper.hostname] = helper.get_api_stats()
+        if data is None:
+            raise self._stats_error
+        data['pools'] = pools
+        data['freenas_api_stats'] = api_stats
+        data['freenas_replication'] = self.replicator.get_stats()
+        data['freenas_snapshot_retention'] = dict(
+            (helper.pool_name, helper.get_retention_stats())
+            for helper in self.helpers.values())
+        return data
 
     def _update_share_stats(self, data=None):
         super(FreeNasDriver, self)._update_share_stats()
-        data = self.helper.update_share_stats()
+        data = self._collect_share_stats()
         data['driver_version'] = VERSION
         data['share_backend_name'] = self.share_backend_name
         self._stats.update(data)
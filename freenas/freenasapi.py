@@ -12,13 +12,435 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import contextlib
+import errno
+import heapq
+import httplib
+import itertools
+import random
+import select
+import socket
+import threading
+import time
+
 from oslo_log import log as logging
 import simplejson as json
 import urllib2
 
+from manila.share.drivers.freenas.metrics import FreeNASMetrics
+from manila.share.drivers.freenas.metrics import LatencyHistogram
+from manila.share.drivers.freenas import utils
+
 LOG = logging.getLogger(__name__)
 
 
+class CommandResponse(collections.namedtuple(
+        'CommandResponse', ['status', 'code', 'response', 'body',
+                            'latency'])):
+    """Immutable result of one FreeNAS API call.
+
+    status is STATUS_OK or STATUS_ERROR, code the HTTP status (None when no
+    response was received), response the raw body or error message, body
+    the decoded JSON document (None if empty or not JSON) and latency the
+    call duration in seconds. Fields can also be read by key, as in
+    response['status'].
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return super(CommandResponse, self).__getitem__(key)
+
+    def get(self, key, default=None):
+        if key in self._fields:
+            return getattr(self, key)
+        return default
+
+
+# Records returned by the FreeNASProcessRequests list methods.
+FreeNASDataset = collections.namedtuple(
+    'FreeNASDataset', ['name', 'mountpoint', 'refquota'])
+FreeNASNFSShare = collections.namedtuple('FreeNASNFSShare',
+                                         ['id', 'paths'])
+FreeNASSnapshot = collections.namedtuple('FreeNASSnapshot',
+                                         ['dataset', 'name'])
+
+
+class FreeNASConnectionPool(object):
+    """Bounded pool of persistent keep-alive connections to one appliance.
+
+    Idle connections are handed out again most-recently-used first.
+    Connections idle for longer than idle_timeout, or whose socket was
+    closed by the appliance, are evicted instead of being reused.
+    """
+
+    def __init__(self, host, transport_type='http', max_size=8,
+                 idle_timeout=60, timeout=None):
+        self._host = host
+        self._transport_type = transport_type
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle = collections.deque()
+        self._in_use = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def connect(self):
+        """Open a new, unpooled connection to the appliance."""
+        if self._transport_type == 'https':
+            return httplib.HTTPSConnection(self._host, timeout=self._timeout)
+        return httplib.HTTPConnection(self._host, timeout=self._timeout)
+
+    @staticmethod
+    def _is_alive(conn):
+        """Health check for an idle keep-alive connection.
+
+        An idle socket has nothing to read; if it is readable the appliance
+        has closed it (or sent something we did not ask for).
+        """
+        if conn.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def _evict_expired(self, now):
+        # Least recently used connections sit at the left end.
+        while self._idle and now - self._idle[0][1] > self._idle_timeout:
+            conn, _ = self._idle.popleft()
+            conn.close()
+            self.evictions += 1
+
+    def acquire(self):
+        """Returns (connection, reused) and blocks while the pool is full."""
+        self._slots.acquire()
+        try:
+            with self._lock:
+                self._in_use += 1
+                self._evict_expired(time.time())
+                while self._idle:
+                    conn, _ = self._idle.pop()
+                    if self._is_alive(conn):
+                        self.hits += 1
+                        return conn, True
+                    conn.close()
+                    self.evictions += 1
+                self.misses += 1
+            return self.connect(), False
+        except BaseException:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+            raise
+
+    def release(self, conn, reusable=True):
+        """Give a connection back, closing it unless it can be reused."""
+        try:
+            with self._lock:
+                self._in_use -= 1
+                if reusable:
+                    self._idle.append((conn, time.time()))
+                    conn = None
+                self._evict_expired(time.time())
+            if conn is not None:
+                conn.close()
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                conn.close()
+
+    def get_stats(self):
+        with self._lock:
+            return {'max_size': self._max_size,
+                    'idle': len(self._idle),
+                    'in_use': self._in_use,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class FreeNASRetryPolicy(object):
+    """Decides whether a failed API call is retried and after how long.
+
+    Only transient failures are retried: 502/503/504 answers from the
+    FreeNAS middleware and connection level errors. GET, PUT and DELETE
+    are idempotent and retried on any of them. POST is retried only when
+    the appliance cannot have acted on it: the connection was refused or
+    unreachable, or the middleware answered 503.
+    """
+
+    TRANSIENT_HTTP_CODES = (502, 503, 504)
+    NOT_SENT_ERRNOS = (errno.ECONNREFUSED, errno.EHOSTUNREACH,
+                       errno.ENETUNREACH)
+    TRANSIENT_ERRNOS = NOT_SENT_ERRNOS + (errno.ECONNRESET, errno.ETIMEDOUT,
+                                          errno.EPIPE, errno.ECONNABORTED)
+    IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+    STALE_ERRNOS = (errno.ECONNRESET, errno.EPIPE)
+
+    def __init__(self, max_retries=3, backoff=0.5, max_backoff=10):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    @classmethod
+    def is_transient(cls, err):
+        """True if err means the appliance is down or overloaded."""
+        if isinstance(err, urllib2.HTTPError):
+            return err.code in cls.TRANSIENT_HTTP_CODES
+        if isinstance(err, socket.timeout):
+            return True
+        if isinstance(err, socket.error):
+            return err.errno in cls.TRANSIENT_ERRNOS
+        return isinstance(err, httplib.HTTPException)
+
+    def should_retry(self, method, err, attempt):
+        if attempt > self.max_retries or not self.is_transient(err):
+            return False
+        if method in self.IDEMPOTENT_METHODS:
+            return True
+        if isinstance(err, urllib2.HTTPError):
+            return err.code == 503
+        return (isinstance(err, socket.error) and
+                not isinstance(err, socket.timeout) and
+                err.errno in self.NOT_SENT_ERRNOS)
+
+    def can_resend(self, method, err, sent):
+        """Whether a request that failed on a reused keep-alive connection
+        is sent again at once on a fresh one.
+
+        Only when the appliance closed the connection without answering:
+        no status line, or a reset or broken pipe. Once the request was
+        fully sent the appliance may have acted on it, so only idempotent
+        methods are sent again. Timeouts never are.
+        """
+        if isinstance(err, socket.timeout):
+            return False
+        if not (isinstance(err, httplib.BadStatusLine) or
+                (isinstance(err, socket.error) and
+                 err.errno in self.STALE_ERRNOS)):
+            return False
+        return not sent or method in self.IDEMPOTENT_METHODS
+
+    def get_backoff(self, attempt):
+        """Full jitter exponential backoff for the given attempt number."""
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** (attempt - 1)))
+
+
+class FreeNASCircuitBreaker(object):
+    """Fails calls fast while an appliance keeps failing.
+
+    After threshold consecutive transient failures the breaker opens and
+    calls are rejected without touching the network. Once reset_timeout
+    seconds have passed one trial call is let through (half open); it
+    closes the breaker on success and re-opens it on failure.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self._threshold = threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._trial_running = False
+        self.times_opened = 0
+
+    def allow(self):
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if (self._state == self.OPEN and
+                    time.time() - self._opened_at >= self._reset_timeout):
+                self._state = self.HALF_OPEN
+                self._trial_running = False
+            if self._state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if (self._state == self.HALF_OPEN or
+                    self._failures >= self._threshold):
+                if self._state != self.OPEN:
+                    self.times_opened += 1
+                self._state = self.OPEN
+                self._opened_at = time.time()
+                self._trial_running = False
+
+    def record_interrupted(self):
+        """An allowed call was timed out or killed before it had a result.
+
+        This says nothing about the appliance, but a half open trial that
+        ends this way must let the next call be the trial.
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def get_state(self):
+        with self._lock:
+            return self._state
+
+    def get_stats(self):
+        with self._lock:
+            return {'state': self._state,
+                    'consecutive_failures': self._failures,
+                    'times_opened': self.times_opened}
+
+
+class FreeNASTokenBucket(object):
+    """Lets rate requests per second through, in bursts of up to burst.
+
+    Not thread safe on its own, FreeNASScheduler calls it under its lock.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = max(float(burst or rate), 1.0)
+        self._tokens = self.capacity
+        self._stamp = time.time()
+
+    def take(self):
+        """Take a token; returns 0, or the seconds until one is available."""
+        now = time.time()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+
+class FreeNASScheduler(object):
+    """Admits the API requests sent to an appliance by priority.
+
+    At most max_concurrency requests run at once (0 for no limit) and, with
+    a rate, at most rate requests per second are started. Waiting requests
+    are admitted lowest priority value first and in arrival order within a
+    priority, so interactive calls overtake queued bulk work.
+    """
+
+    INTERACTIVE = 0
+    NORMAL = 1
+    BULK = 2
+    PRIORITY_NAMES = {INTERACTIVE: 'interactive', NORMAL: 'normal',
+                      BULK: 'bulk'}
+
+    def __init__(self, max_concurrency=0, rate=0, burst=None):
+        self._max_concurrency = max_concurrency
+        self._bucket = FreeNASTokenBucket(rate, burst) if rate else None
+        self._cond = threading.Condition(threading.Lock())
+        self._queue = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._waits = dict((priority, LatencyHistogram())
+                           for priority in self.PRIORITY_NAMES)
+        self.max_queue_depth = 0
+
+    def _can_start(self, entry):
+        return (self._queue[0] == entry and
+                (not self._max_concurrency or
+                 self._running < self._max_concurrency))
+
+    def acquire(self, priority=NORMAL):
+        """Block until the request may run; returns the seconds waited."""
+        start = time.time()
+        entry = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._queue, entry)
+            self.max_queue_depth = max(self.max_queue_depth,
+                                       len(self._queue))
+            try:
+                while True:
+                    delay = None
+                    if self._can_start(entry):
+                        delay = self._bucket.take() if self._bucket else 0
+                        if not delay:
+                            break
+                    self._cond.wait(delay)
+            except BaseException:
+                # Timed out or killed while queued.
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+                raise
+            heapq.heappop(self._queue)
+            self._running += 1
+            waited = time.time() - start
+            self._waits[priority].observe(waited)
+            # The next request in line may be able to start as well.
+            self._cond.notify_all()
+        return waited
+
+    def release(self):
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, priority=NORMAL):
+        """Context manager running its block as one admitted request."""
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def get_stats(self):
+        """Running requests, queue depth and wait times per priority."""
+        with self._cond:
+            depth = dict((name, 0) for name in self.PRIORITY_NAMES.values())
+            for priority, _ in self._queue:
+                depth[self.PRIORITY_NAMES[priority]] += 1
+            return {'running': self._running,
+                    'max_concurrency': self._max_concurrency,
+                    'rate': self._bucket.rate if self._bucket else 0,
+                    'queue_depth': depth,
+                    'max_queue_depth': self.max_queue_depth,
+                    'wait': dict((self.PRIORITY_NAMES[priority],
+                                  histogram.to_dict())
+                                 for priority, histogram in
+                                 self._waits.items())}
+
+
+class FreeNASInFlightRead(object):
+    """A select shared by every caller asking for it while it runs."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
 # FreeNAS REST API Interfaces calling mechanism
 class FreeNASServer(object):
     """FreeNAS server connection details."""
@@ -26,6 +448,12 @@ class FreeNASServer(object):
     FREENAS_API_VERSION = "v1"
     TRANSPORT_TYPE = 'http'
     STYLE_LOGIN_PASSWORD = 'basic_auth'
+    POOL_SIZE = 8
+    POOL_IDLE_TIMEOUT = 60
+    API_TIMEOUT = 60
+    BREAKER_THRESHOLD = 5
+    BREAKER_RESET_TIMEOUT = 30
+    STREAM_CHUNK_SIZE = 65536
 
     # FreeNAS  REST API Commands
     SELECT_COMMAND = 'select'
@@ -38,26 +466,60 @@ class FreeNASServer(object):
     DATASET = "datasets"
     REST_API_SHARE = "/sharing/nfs"
     REST_API_SNAPSHOT = "/storage/snapshot"
+    REST_API_REPLICATION = "/storage/replication"
     CLONE = "clone"
+    ROLLBACK = "rollback"
     DS_NAME = "agattivol"
 
-    # FreeNAS Command response format
-    COMMAND_RESPONSE = {'status': '%s',
-                        'response': '%s'}
-
     # Status response values
     STATUS_OK = 'ok'
     STATUS_ERROR = 'error'
 
+    # Creates and updates serve users waiting on a share, deletes are
+    # mostly bulk cleanup.
+    COMMAND_PRIORITIES = {SELECT_COMMAND: FreeNASScheduler.NORMAL,
+                          CREATE_COMMAND: FreeNASScheduler.INTERACTIVE,
+                          UPDATE_COMMAND: FreeNASScheduler.INTERACTIVE,
+                          DELETE_COMMAND: FreeNASScheduler.BULK}
+
     def __init__(self, host, port,
                  username=None, password=None,
                  api_version=FREENAS_API_VERSION,
                  transport_type=TRANSPORT_TYPE,
-                 style=STYLE_LOGIN_PASSWORD):
+                 style=STYLE_LOGIN_PASSWORD,
+                 pool_size=POOL_SIZE,
+                 pool_idle_timeout=POOL_IDLE_TIMEOUT,
+                 timeout=API_TIMEOUT,
+                 retry_policy=None,
+                 breaker_threshold=BREAKER_THRESHOLD,
+                 breaker_reset_timeout=BREAKER_RESET_TIMEOUT,
+                 max_concurrency=None,
+                 rate_limit=0,
+                 rate_burst=None):
         self._host = host
         self._port = port
         self._username = username
         self._password = password
+        self._pool_size = pool_size
+        self._pool_idle_timeout = pool_idle_timeout
+        self._timeout = timeout
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._retry_policy = retry_policy or FreeNASRetryPolicy()
+        self._breaker = FreeNASCircuitBreaker(breaker_threshold,
+                                              breaker_reset_timeout)
+        if max_concurrency is None:
+            max_concurrency = pool_size
+        self._scheduler = FreeNASScheduler(max_concurrency, rate_limit,
+                                           rate_burst)
+        self._retry_stats = {'attempts': 0, 'retries': 0, 'rejected': 0,
+                             'coalesced': 0}
+        self._retry_stats_lock = threading.Lock()
+        # (request, params, write generation) -> FreeNASInFlightRead
+        self._inflight = {}
+        self._write_generation = 0
+        self._inflight_lock = threading.Lock()
+        self.metrics = FreeNASMetrics()
         self.set_api_version(api_version)
         self.set_transport_type(transport_type)
         self.set_style(style)
@@ -67,6 +529,7 @@ class FreeNASServer(object):
 
     def set_host(self, host):
         self._host = host
+        self._reset_pool()
 
     def get_port(self):
         return self._port
@@ -97,6 +560,62 @@ class FreeNASServer(object):
 
     def set_transport_type(self, transport_type):
         self._protocol = transport_type
+        self._reset_pool()
+
+    def _get_pool(self):
+        """Returns the keep-alive connection pool, creating it on first use."""
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = FreeNASConnectionPool(
+                    self._host, transport_type=self._protocol,
+                    max_size=self._pool_size,
+                    idle_timeout=self._pool_idle_timeout,
+                    timeout=self._timeout)
+            return self._pool
+
+    def _reset_pool(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+            self._pool = None
+
+    def get_pool_stats(self):
+        """Returns connection pool counters (hits, misses, evictions...)."""
+        return self._get_pool().get_stats()
+
+    def _count(self, counter):
+        with self._retry_stats_lock:
+            self._retry_stats[counter] += 1
+
+    def get_retry_stats(self):
+        """Returns request counters and the circuit breaker state."""
+        with self._retry_stats_lock:
+            stats = dict(self._retry_stats)
+        stats['circuit_breaker'] = self._breaker.get_stats()
+        return stats
+
+    def get_scheduler_stats(self):
+        """Returns queue depth and admission wait times per priority."""
+        return self._scheduler.get_stats()
+
+    def get_stats(self):
+        """Stats hook: request metrics, connection pool, retry counters and
+        request scheduling.
+        """
+        return {'requests': self.metrics.get_stats(),
+                'pool': self.get_pool_stats(),
+                'retries': self.get_retry_stats(),
+                'scheduler': self.get_scheduler_stats()}
+
+    def _get_endpoint(self, request_d):
+        """Metrics endpoint name for a request, e.g. '/sharing/nfs'."""
+        if '/%s/' % self.CLONE in request_d:
+            return self.CLONE
+        for endpoint in (self.REST_API_VOLUME, self.REST_API_SHARE,
+                         self.REST_API_SNAPSHOT, self.REST_API_REPLICATION):
+            if request_d.startswith(endpoint):
+                return endpoint
+        return '/'.join(request_d.split('/')[:3])
 
     def set_style(self, style):
         """Set the authorization style for communicating with the server.
@@ -116,18 +635,139 @@ class FreeNASServer(object):
                                    self._host,
                                    self._api_version)
 
-    def _create_request(self, request_d, param_list):
-        """Creates urllib2.Request object."""
+    def get_path(self):
+        """Returns the API base path used on pooled connections."""
+        return '/api/%s' % self._api_version
+
+    def _create_headers(self):
+        """Creates the HTTP headers sent with every request."""
         if not self._username or not self._password:
             raise ValueError("Invalid username/password combination")
         auth = ('%s:%s' % (self._username,
                            self._password)).encode('base64')[:-1]
-        headers = {'Content-Type': 'application/json',
-                   'Authorization': 'Basic %s' % (auth,)}
-        url = self.get_url() + request_d
-        LOG.debug('url : %s', url)
-        LOG.debug('param list : %s', param_list)
-        return urllib2.Request(url, param_list, headers)
+        return {'Content-Type': 'application/json',
+                'Authorization': 'Basic %s' % (auth,),
+                'Connection': 'keep-alive'}
+
+    def _open(self, pool, method, request_d, param_list, headers):
+        """Sends one request over a pooled keep-alive connection.
+
+        Returns (connection, response) with the body still unread; the
+        caller gives the connection back to the pool. On any failure,
+        including a timeout or kill of the green thread, the connection is
+        given back here.
+        """
+        path = self.get_path() + request_d
+        conn, reused = pool.acquire()
+        sent = False
+        try:
+            try:
+                conn.request(method, path, param_list, headers)
+                sent = True
+                return conn, conn.getresponse()
+            except (httplib.BadStatusLine, socket.error) as e:
+                if (not reused or
+                        not self._retry_policy.can_resend(method, e, sent)):
+                    raise
+                # The appliance closed the idle connection under us, send
+                # the request once more on a fresh one.
+                conn.close()
+                conn = pool.connect()
+                conn.request(method, path, param_list, headers)
+                return conn, conn.getresponse()
+        except BaseException:
+            pool.release(conn, False)
+            raise
+
+    def _send(self, method, request_d, param_list, headers):
+        """Sends one request and reads the whole response.
+
+        Returns (http status, response body). HTTP error statuses are
+        raised as urllib2.HTTPError.
+        """
+        pool = self._get_pool()
+        conn, response_d = self._open(pool, method, request_d, param_list,
+                                      headers)
+        reusable = False
+        try:
+            response_str = response_d.read()
+            reusable = not response_d.will_close
+        finally:
+            pool.release(conn, reusable)
+        if response_d.status >= 400:
+            raise urllib2.HTTPError(self.get_url() + request_d,
+                                    response_d.status, response_d.reason,
+                                    response_d.msg, None)
+        return response_d.status, response_str
+
+    def iter_command(self, request_d, fields=None,
+                     priority=FreeNASScheduler.NORMAL):
+        """Streams a select returning a JSON list, one record at a time.
+
+        The body is decoded while it is read, so memory stays bounded by
+        the largest record rather than the whole listing. fields restricts
+        each record to the given keys. Failures raise FreeNASApiError; the
+        request is not retried. Stopping the iteration early closes the
+        connection. The request holds its scheduler slot until the listing
+        is consumed.
+        """
+        headers = self._create_headers()
+        if not self._breaker.allow():
+            self._count('rejected')
+            raise FreeNASApiError('Unavailable', 'circuit breaker open for '
+                                  '%s' % self._host)
+        self._count('attempts')
+        LOG.debug('iter_command GET %s%s', self.get_url(), request_d)
+        start = time.time()
+        received = [0]
+        failed = True
+        pool = self._get_pool()
+        conn = None
+        reusable = False
+
+        def _read(size):
+            data = response_d.read(size)
+            received[0] += len(data)
+            return data
+
+        self._scheduler.acquire(priority)
+        try:
+            try:
+                conn, response_d = self._open(pool, 'GET', request_d, None,
+                                              headers)
+            except Exception as e:
+                if self._retry_policy.is_transient(e):
+                    self._breaker.record_failure()
+                raise FreeNASApiError('Unexpected error', e)
+            except BaseException:
+                self._breaker.record_interrupted()
+                raise
+            if (response_d.status in
+                    FreeNASRetryPolicy.TRANSIENT_HTTP_CODES):
+                self._breaker.record_failure()
+            else:
+                self._breaker.record_success()
+            if response_d.status >= 400:
+                _read(None)
+                reusable = not response_d.will_close
+                raise FreeNASApiError(response_d.status, response_d.reason)
+            try:
+                for record in utils.iter_json_list(_read,
+                                                   self.STREAM_CHUNK_SIZE):
+                    yield utils.project(record, fields)
+            except (ValueError, httplib.HTTPException, socket.error) as e:
+                raise FreeNASApiError('Unexpected error', e)
+            reusable = not response_d.will_close
+            failed = False
+        finally:
+            # A failed _open has given its connection back already.
+            if conn is not None:
+                pool.release(conn, reusable)
+            self._scheduler.release()
+            self.metrics.record(self.SELECT_COMMAND,
+                                self._get_endpoint(request_d),
+                                time.time() - start, error=failed,
+                                bytes_received=received[0])
 
     def _get_method(self, command_d):
         """Select http method based on FreeNAS command."""
@@ -142,71 +782,189 @@ class FreeNASServer(object):
         else:
             return None
 
-    def _parse_result(self, command_d, response_d):
-        """parses the response upon execution of FREENAS API. COMMAND_RESPONSE is
+    def _parse_result(self, command_d, code, response_str, latency):
+        """parses the response upon execution of FREENAS API into a
 
-        the dictionary object with result status and response fields.
+        CommandResponse with result status and response fields.
         If error, set status to ERROR else set it to OK
         """
 
-        response_str = response_d.read()
-        status = None
-        if command_d == self.SELECT_COMMAND:
+        body = None
+        if command_d in (self.SELECT_COMMAND, self.CREATE_COMMAND,
+                         self.DELETE_COMMAND, self.UPDATE_COMMAND):
             status = self.STATUS_OK
             response_obj = response_str
-        elif (command_d == self.CREATE_COMMAND or
-              command_d == self.DELETE_COMMAND or
-              command_d == self.UPDATE_COMMAND):
-            response_obj = response_str
-            status = self.STATUS_OK
+            if response_str:
+                try:
+                    body = json.loads(response_str)
+                except ValueError:
+                    body = None
         else:
             status = self.STATUS_ERROR
             response_obj = None
 
-        self.COMMAND_RESPONSE['status'] = status
-        self.COMMAND_RESPONSE['response'] = response_obj
-        return self.COMMAND_RESPONSE
+        return CommandResponse(status, code, response_obj, body, latency)
 
-    def _get_error_info(self, err):
+    def _get_error_info(self, err, latency=None):
         """Collects error response message."""
-        self.COMMAND_RESPONSE['status'] = self.STATUS_ERROR
+        code = None
         if isinstance(err, urllib2.HTTPError):
-            self.COMMAND_RESPONSE['response'] = '%d:%s' % (err.code, err.msg)
+            code = err.code
+            response_obj = '%d:%s' % (err.code, err.msg)
         elif isinstance(err, urllib2.URLError):
-            self.COMMAND_RESPONSE['response'] = '%s:%s' % \
-                                                (str(err.reason.errno),
-                                                 err.reason.strerror)
+            response_obj = '%s:%s' % (str(err.reason.errno),
+                                      err.reason.strerror)
+        elif isinstance(err, socket.error):
+            if err.errno is None:
+                # e.g. socket.timeout carries only a message.
+                response_obj = '%s:%s' % (err.__class__.__name__, err)
+            else:
+                response_obj = '%s:%s' % (str(err.errno), err.strerror)
+        elif isinstance(err, httplib.HTTPException):
+            response_obj = '%s:%s' % (err.__class__.__name__, err)
         else:
             return None
-        return self.COMMAND_RESPONSE
+        return CommandResponse(self.STATUS_ERROR, code, response_obj, None,
+                               latency)
+
+    def invoke_command(self, command_d, request_d, param_list,
+                       priority=None):
+        """Invokes FreeNAS api's and returns response object.
 
-    def invoke_command(self, command_d, request_d, param_list):
-        """Invokes FreeNAS api's and returns response object."""
-        LOG.debug('invoke_command')
-        request = self._create_request(request_d, param_list)
+        priority defaults to the COMMAND_PRIORITIES entry of the command.
+        Identical selects running at the same time are sent once and share
+        the response, which callers must not modify.
+        """
+        headers = self._create_headers()
         method = self._get_method(command_d)
         if not method:
             raise FreeNASApiError("Invalid FREENAS command")
-        request.get_method = lambda: method
+        if priority is None:
+            priority = self.COMMAND_PRIORITIES[command_d]
+        if command_d == self.SELECT_COMMAND:
+            return self._coalesce(command_d, method, request_d, param_list,
+                                  headers, priority)
         try:
-            response_d = urllib2.urlopen(request)
-            response = self._parse_result(command_d, response_d)
-            LOG.debug("invoke_command : response for request %s : %s",
-                      request_d, json.dumps(response))
-        except urllib2.HTTPError as e:
-            error_d = self._get_error_info(e)
-            if error_d:
-                return error_d
-            else:
-                raise FreeNASApiError(e.code, e.msg)
+            return self._run_command(command_d, method, request_d,
+                                     param_list, headers, priority)
+        finally:
+            # Selects started before this write may miss its effect, later
+            # callers must not join them.
+            with self._inflight_lock:
+                self._write_generation += 1
+
+    def _coalesce(self, command_d, method, request_d, param_list, headers,
+                  priority):
+        """Runs a select, or waits for the identical one already running.
+
+        Only selects started after the last write through this handle
+        completed are joined, so no caller gets data older than its own
+        changes.
+        """
+        with self._inflight_lock:
+            key = (request_d, param_list, self._write_generation)
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = FreeNASInFlightRead()
+        if not leader:
+            self._count('coalesced')
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            if flight.response is not None:
+                return flight.response
+            # The first caller was interrupted (e.g. by a timeout), send
+            # the request ourselves.
+            return self._run_command(command_d, method, request_d,
+                                     param_list, headers, priority)
+        try:
+            flight.response = self._run_command(command_d, method,
+                                                request_d, param_list,
+                                                headers, priority)
         except Exception as e:
-            error_d = self._get_error_info(e)
-            if error_d:
-                return error_d
-            else:
-                raise FreeNASApiError('Unexpected error', e)
+            flight.error = e
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+            flight.done.set()
+        return flight.response
+
+    def _run_command(self, command_d, method, request_d, param_list,
+                     headers, priority):
+        """Sends one command and records its metrics."""
+        LOG.debug('invoke_command %s %s%s param list : %s', method,
+                  self.get_url(), request_d, param_list)
+        start = time.time()
+        response = None
+        try:
+            response = self._invoke(command_d, method, request_d,
+                                    param_list, headers, start, priority)
+        finally:
+            self.metrics.record(
+                command_d, self._get_endpoint(request_d), time.time() - start,
+                error=(response is None or
+                       response.status != self.STATUS_OK),
+                bytes_sent=len(param_list or ''),
+                bytes_received=len((response and response.response) or ''))
+        LOG.debug("invoke_command : response for request %s : %s",
+                  request_d, utils.LazyJSON(response))
         return response
 
+    def _invoke(self, command_d, method, request_d, param_list, headers,
+                start, priority):
+        """Runs one command with retries behind the circuit breaker.
+
+        Every attempt waits for its own scheduler slot, so backoff delays
+        do not hold one.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            if not self._breaker.allow():
+                self._count('rejected')
+                return CommandResponse(
+                    self.STATUS_ERROR, None,
+                    'circuit breaker open for %s' % self._host, None,
+                    time.time() - start)
+            self._count('attempts')
+            try:
+                with self._scheduler.slot(priority):
+                    code, response_str = self._send(method, request_d,
+                                                    param_list, headers)
+            except Exception as e:
+                if self._retry_policy.is_transient(e):
+                    self._breaker.record_failure()
+                else:
+                    self._breaker.record_success()
+                if not self._retry_policy.should_retry(method, e, attempt):
+                    return self._handle_error(e, time.time() - start)
+                delay = self._retry_policy.get_backoff(attempt)
+                LOG.warning('FreeNAS %(method)s %(req)s failed: %(err)s, '
+                            'retrying in %(delay).2fs',
+                            {'method': method, 'req': request_d, 'err': e,
+                             'delay': delay})
+                self._count('retries')
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self._breaker.record_interrupted()
+                raise
+            self._breaker.record_success()
+            return self._parse_result(command_d, code, response_str,
+                                      time.time() - start)
+
+    def _handle_error(self, e, latency):
+        """Turn a failed call into an error response or FreeNASApiError."""
+        error_d = self._get_error_info(e, latency)
+        if error_d:
+            return error_d
+        elif isinstance(e, urllib2.HTTPError):
+            raise FreeNASApiError(e.code, e.msg)
+        else:
+            raise FreeNASApiError('Unexpected error', e)
+
 
 class FreeNASApiError(Exception):
     """Base exceptions class for FREENAS api errors."""
@@ -0,0 +1,280 @@
+# Copyright (c) 2017 Agatti Software Labs. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+from oslo_log import log
+
+from manila.share.drivers.freenas.freenasapi import FreeNASApiError
+from manila.share.drivers.freenas.freenasapi import FreeNASScheduler
+from manila.share.drivers.freenas.freenasapi import FreeNASServer
+from manila.share.drivers.freenas import utils
+
+LOG = log.getLogger(__name__)
+
+
+# Local index of what the driver owns on the FreeNAS appliance
+class FreeNASInventory(object):
+    """In-process index of datasets, NFS shares and snapshots.
+
+    Covers the datasets directly under the parent dataset (pool), the NFS
+    shares exporting them keyed by mountpoint, and their snapshots. The
+    index is loaded in bulk, kept up to date by the request processor after
+    each create/delete and periodically reconciled with the appliance.
+
+    provisioned_gb is the sum of the dataset refquotas. It is adjusted on
+    each dataset change and recomputed only from bulk listings.
+    """
+
+    DATASET_FIELDS = ('name', 'mountpoint', 'refquota', 'comments')
+    NFS_SHARE_FIELDS = ('id', 'nfs_paths', 'nfs_hosts', 'nfs_network',
+                        'nfs_ro')
+    SNAPSHOT_FIELDS = ('name', 'filesystem')
+
+    def __init__(self, handle, pool):
+        self.handle = handle
+        self.pool = pool
+        self.datasets = {}
+        self.nfs_shares = {}
+        self.snapshots = {}
+        self.provisioned_gb = 0
+        # Share name -> dataset adopted by manage_existing.
+        self.managed = {}
+        self.loaded = False
+        self.last_sync = 0
+        self._lock = threading.Lock()
+        self._syncing = False
+        self._touched = set()
+
+    def _select(self, request_d, fields):
+        """Stream a listing, keeping only the fields the index needs.
+
+        Listings run at bulk priority, behind share operations.
+        """
+        try:
+            for record in self.handle.iter_command(
+                    request_d, fields, priority=FreeNASScheduler.BULK):
+                yield record
+        except FreeNASApiError as e:
+            msg = 'Error while listing %s: %s' % (request_d, e)
+            raise FreeNASApiError('Unexpected error', msg)
+
+    def _fetch(self):
+        """Read the full inventory from the appliance."""
+        datasets = {}
+        ds_req = '%s/%s/%s/?limit=0' % (FreeNASServer.REST_API_VOLUME,
+                                        self.pool, FreeNASServer.DATASET)
+        prefix = self.pool + '/'
+        for dataset in self._select(ds_req, self.DATASET_FIELDS):
+            name = dataset['name']
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+            # Only the shares directly under the pool are indexed.
+            if name != self.pool and '/' not in name:
+                datasets[name] = dataset
+
+        nfs_shares = {}
+        nfs_req = '%s/?limit=0' % FreeNASServer.REST_API_SHARE
+        for nfs_share in self._select(nfs_req, self.NFS_SHARE_FIELDS):
+            for path in nfs_share.get('nfs_paths', []):
+                nfs_shares[path] = nfs_share
+
+        snapshots = {}
+        snap_req = '%s/?limit=0' % FreeNASServer.REST_API_SNAPSHOT
+        for snapshot in self._select(snap_req, self.SNAPSHOT_FIELDS):
+            filesystem = snapshot.get('filesystem', '')
+            if filesystem.startswith(prefix):
+                dataset = filesystem[len(prefix):]
+                snapshots.setdefault(dataset, {})[snapshot['name']] = snapshot
+        return datasets, nfs_shares, snapshots
+
+    def load(self):
+        """Replace the index with a bulk listing from the appliance."""
+        datasets, nfs_shares, snapshots = self._fetch()
+        with self._lock:
+            self.datasets = datasets
+            self.nfs_shares = nfs_shares
+            self.snapshots = snapshots
+            self.provisioned_gb = self._sum_quotas(datasets)
+            self.managed = self._index_managed(datasets)
+            self.loaded = True
+            self.last_sync = time.time()
+        LOG.info('FreeNAS inventory loaded: %d datasets, %d NFS shares, '
+                 '%d snapshots', len(datasets), len(nfs_shares),
+                 sum(len(snaps) for snaps in snapshots.values()))
+
+    def sync_due(self, interval):
+        return time.time() - self.last_sync >= interval
+
+    @staticmethod
+    def _merge(local, remote, touched):
+        """Apply the key-level diff of remote onto local in place.
+
+        Keys changed locally while the listing was in flight are kept.
+        Returns (added, removed) counts.
+        """
+        added = removed = 0
+        for key in set(local) - set(remote) - touched:
+            del local[key]
+            removed += 1
+        for key, value in remote.items():
+            if key in touched:
+                continue
+            if key not in local:
+                added += 1
+            local[key] = value
+        return added, removed
+
+    def reconcile(self):
+        """Bring the index in line with the appliance.
+
+        Returns a dict of (added, removed) counts per object type.
+        """
+        if not self.loaded:
+            self.load()
+            return {}
+        with self._lock:
+            self._syncing = True
+            self._touched = set()
+        try:
+            datasets, nfs_shares, snapshots = self._fetch()
+        finally:
+            with self._lock:
+                self._syncing = False
+        with self._lock:
+            touched = self._touched
+            diff = {
+                'datasets': self._merge(self.datasets, datasets, touched),
+                'nfs_shares': self._merge(self.nfs_shares, nfs_shares,
+                                          touched),
+                'snapshots': self._merge(self.snapshots, snapshots, touched),
+            }
+            self.provisioned_gb = self._sum_quotas(self.datasets)
+            self.managed = self._index_managed(self.datasets)
+            self.last_sync = time.time()
+        if any(sum(counts) for counts in diff.values()):
+            LOG.info('FreeNAS inventory reconciled: %s', diff)
+        return diff
+
+    @staticmethod
+    def _sum_quotas(datasets):
+        return sum(utils.get_quota_in_gb(dataset.get('refquota'))
+                   for dataset in datasets.values())
+
+    @staticmethod
+    def _get_managed_share(dataset):
+        comments = dataset.get('comments') or ''
+        if comments.startswith(utils.MANAGED_PREFIX):
+            return comments[len(utils.MANAGED_PREFIX):]
+        return None
+
+    @classmethod
+    def _index_managed(cls, datasets):
+        managed = {}
+        for name, dataset in datasets.items():
+            share_name = cls._get_managed_share(dataset)
+            if share_name:
+                managed[share_name] = name
+        return managed
+
+    def _touch(self, key):
+        if self._syncing:
+            self._touched.add(key)
+
+    def _replace_dataset(self, name, dataset):
+        """Swap a dataset entry and adjust provisioned_gb and the managed
+        shares, under _lock.
+        """
+        old = self.datasets.pop(name, None)
+        if old is not None:
+            self.provisioned_gb -= utils.get_quota_in_gb(old.get('refquota'))
+            self.managed.pop(self._get_managed_share(old), None)
+        if dataset is not None:
+            self.datasets[name] = dataset
+            self.provisioned_gb += utils.get_quota_in_gb(
+                dataset.get('refquota'))
+            share_name = self._get_managed_share(dataset)
+            if share_name:
+                self.managed[share_name] = name
+
+    def add_dataset(self, name, dataset=None, size=None):
+        """Index a dataset, size (GB) overrides its listed refquota."""
+        dataset = dict(dataset or {'name': name})
+        if size is not None:
+            dataset['refquota'] = '%sG' % size
+        with self._lock:
+            self._touch(name)
+            self._replace_dataset(name, dataset)
+
+    def update_dataset(self, name, **props):
+        with self._lock:
+            self._touch(name)
+            dataset = dict(self.datasets.get(name) or {'name': name})
+            dataset.update(props)
+            self._replace_dataset(name, dataset)
+
+    def remove_dataset(self, name):
+        with self._lock:
+            self._touch(name)
+            self._replace_dataset(name, None)
+            self.snapshots.pop(name, None)
+
+    def has_dataset(self, name):
+        return name in self.datasets
+
+    def get_managed_dataset(self, share_name):
+        """Dataset of a managed share, None for driver created shares."""
+        return self.managed.get(share_name)
+
+    def add_nfs_share(self, path, nfs_share):
+        with self._lock:
+            self._touch(path)
+            self.nfs_shares[path] = nfs_share
+
+    def remove_nfs_share(self, path):
+        with self._lock:
+            self._touch(path)
+            self.nfs_shares.pop(path, None)
+
+    def update_nfs_share(self, path, **props):
+        with self._lock:
+            self._touch(path)
+            nfs_share = dict(self.nfs_shares.get(path) or {})
+            nfs_share.update(props)
+            self.nfs_shares[path] = nfs_share
+
+    def get_nfs_share(self, path):
+        return self.nfs_shares.get(path)
+
+    def get_nfs_share_id(self, path):
+        nfs_share = self.nfs_shares.get(path)
+        return nfs_share.get('id') if nfs_share else None
+
+    def add_snapshot(self, dataset, name, snapshot=None):
+        with self._lock:
+            self._touch(dataset)
+            self.snapshots.setdefault(dataset, {})[name] = (
+                snapshot or {'name': name})
+
+    def remove_snapshot(self, dataset, name):
+        with self._lock:
+            self._touch(dataset)
+            self.snapshots.get(dataset, {}).pop(name, None)
+
+    def has_snapshot(self, dataset, name):
+        return name in self.snapshots.get(dataset, {})
+
+    def get_snapshot_names(self, dataset):
+        return list(self.snapshots.get(dataset, {}))
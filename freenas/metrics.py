@@ -0,0 +1,108 @@
+# Copyright (c) 2017 Agatti Software Labs. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import bisect
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket
+# catches everything slower.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30)
+
+
+class LatencyHistogram(object):
+    """Fixed bucket latency histogram."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, pct):
+        """Upper bound of the bucket holding the given percentile."""
+        if not self.count:
+            return 0.0
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                if index < len(self.buckets):
+                    return min(self.buckets[index], self.max)
+                return self.max
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'sum': self.total,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'buckets': dict(('le_%s' % bound, count) for bound, count in
+                                zip(self.buckets + ('inf',), self.counts))}
+
+
+class FreeNASMetrics(object):
+    """Request counters, latency histograms and payload byte counts.
+
+    Series are kept per (command, endpoint) pair, e.g. ('select',
+    '/storage/volume').
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._started = time.time()
+
+    def record(self, command, endpoint, latency, error=False, bytes_sent=0,
+               bytes_received=0):
+        with self._lock:
+            series = self._series.get((command, endpoint))
+            if series is None:
+                series = {'requests': 0, 'errors': 0, 'bytes_sent': 0,
+                          'bytes_received': 0,
+                          'latency': LatencyHistogram()}
+                self._series[(command, endpoint)] = series
+            series['requests'] += 1
+            if error:
+                series['errors'] += 1
+            series['bytes_sent'] += bytes_sent
+            series['bytes_received'] += bytes_received
+            series['latency'].observe(latency)
+
+    def get_stats(self):
+        """Returns a JSON serializable snapshot keyed 'command endpoint'."""
+        with self._lock:
+            elapsed = max(time.time() - self._started, 1e-6)
+            stats = {}
+            for (command, endpoint), series in self._series.items():
+                entry = dict(series)
+                entry['latency'] = series['latency'].to_dict()
+                entry['requests_per_second'] = series['requests'] / elapsed
+                stats['%s %s' % (command, endpoint)] = entry
+            return stats
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+            self._started = time.time()
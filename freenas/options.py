@@ -48,7 +48,75 @@ freenas_connection_opts = [
 freenas_transport_opts = [
     cfg.StrOpt('freenas_transport_type',
                default='http',
-               help='Transport type protocol'), ]
+               help='Transport type protocol'),
+    cfg.IntOpt('freenas_api_pool_size',
+               default=8,
+               min=1,
+               help='Maximum number of keep-alive connections kept open '
+                    'to the FreeNAS appliance.'),
+    cfg.IntOpt('freenas_api_pool_idle_timeout',
+               default=60,
+               help='Seconds an idle keep-alive connection is kept before '
+                    'it is closed.'),
+    cfg.IntOpt('freenas_api_timeout',
+               default=60,
+               help='Socket timeout in seconds for FreeNAS API requests.'),
+    cfg.IntOpt('freenas_max_workers',
+               default=8,
+               min=1,
+               help='Maximum number of FreeNAS API requests bulk operations '
+                    'run concurrently.'),
+    cfg.IntOpt('freenas_api_max_concurrency',
+               default=8,
+               min=0,
+               help='Maximum number of requests sent to one FreeNAS '
+                    'appliance at once, 0 for no limit. Waiting requests '
+                    'are admitted creates and updates first, then reads, '
+                    'then deletes and inventory reconciliation.'),
+    cfg.FloatOpt('freenas_api_rate_limit',
+                 default=0,
+                 min=0,
+                 help='Maximum number of requests started per second on one '
+                      'FreeNAS appliance, 0 for no limit.'),
+    cfg.IntOpt('freenas_api_rate_burst',
+               default=10,
+               min=1,
+               help='Number of requests that may be started at once above '
+                    'freenas_api_rate_limit after an idle period.'),
+    cfg.IntOpt('freenas_api_max_retries',
+               default=3,
+               min=0,
+               help='Number of times a FreeNAS API request failing with a '
+                    'transient error is retried.'),
+    cfg.FloatOpt('freenas_api_retry_backoff',
+                 default=0.5,
+                 help='Base delay in seconds of the jittered exponential '
+                      'backoff between retries.'),
+    cfg.FloatOpt('freenas_api_retry_max_backoff',
+                 default=10,
+                 help='Maximum delay in seconds between retries.'),
+    cfg.IntOpt('freenas_circuit_breaker_threshold',
+               default=5,
+               min=1,
+               help='Consecutive transient failures after which requests to '
+                    'the appliance fail fast.'),
+    cfg.IntOpt('freenas_circuit_breaker_reset_timeout',
+               default=30,
+               help='Seconds requests fail fast before a trial request is '
+                    'sent to the appliance again.'),
+    cfg.BoolOpt('freenas_async_operations',
+                default=False,
+                help='Create shares from snapshots as background jobs. '
+                     'The share is reported creating_from_snapshot until '
+                     'its job finished.'),
+    cfg.FloatOpt('freenas_job_poll_interval',
+                 default=0.5,
+                 help='Shortest delay in seconds between two checks of the '
+                      'running background jobs.'),
+    cfg.FloatOpt('freenas_job_poll_max_interval',
+                 default=10,
+                 help='Longest delay in seconds between two checks of the '
+                      'running background jobs.'), ]
 
 # FreeNAS appliance nfs related options
 freenas_nfs_opts = [
@@ -72,8 +140,108 @@ freenas_dataset_opts = [
                default='off',
                choices=['on', 'off', 'inherit'],
                help='Deduplication value for new ZFS folders.'),
+    cfg.ListOpt('freenas_pools',
+                default=[],
+                help='Further zpools managed by this backend, each reported '
+                     'as its own manila pool. An entry is either a zpool '
+                     'name on freenas_server_hostname or '
+                     '<hostname>:<zpool> for a zpool on another appliance '
+                     'using the same credentials.'),
     cfg.BoolOpt('freenas_thin_provisioning',
                 default=True,
                 help=('If True shares will not be space guaranteed and '
                       'overprovisioning will be enabled.')),
+    cfg.IntOpt('freenas_stats_cache_ttl',
+               default=30,
+               min=0,
+               help='Seconds the pool capacity read from FreeNAS is reused '
+                    'for share stats updates. 0 disables the cache.'),
+    cfg.IntOpt('freenas_stats_refresh_interval',
+               default=60,
+               min=0,
+               help='Seconds between pool stats reads of the background '
+                    'refresher. 0 reads them on each stats update '
+                    'instead.'),
+    cfg.IntOpt('freenas_stats_timeout',
+               default=10,
+               min=1,
+               help='Seconds a pool stats read may take before the last '
+                    'stats read in time are reported again.'),
+    cfg.IntOpt('freenas_list_page_size',
+               default=500,
+               min=1,
+               help='Number of records requested per page when listing '
+                    'datasets, NFS shares or snapshots.'),
+    cfg.IntOpt('freenas_inventory_sync_interval',
+               default=600,
+               min=0,
+               help='Seconds between reconciliations of the local dataset, '
+                    'NFS share and snapshot inventory with FreeNAS.'),
+]
+
+# ZFS replication between FreeNAS pools
+freenas_replication_opts = [
+    cfg.IntOpt('freenas_replication_interval',
+               default=300,
+               min=0,
+               help='Seconds between the replication snapshots taken of '
+                    'replicated shares, which FreeNAS then sends to their '
+                    'replicas. 0 takes one on each replica state update '
+                    'instead.'),
+    cfg.IntOpt('freenas_replication_max_lag',
+               default=900,
+               min=0,
+               help='Age in seconds of the newest received snapshot up to '
+                    'which a replica is reported in sync.'),
+    cfg.IntOpt('freenas_replication_ssh_port',
+               default=22,
+               help='SSH port of the receiving appliance used by FreeNAS '
+                    'replication tasks.'),
+    cfg.StrOpt('freenas_replication_compression',
+               default='lz4',
+               choices=['off', 'lz4', 'pigz', 'plzip'],
+               help='Compression of the replication streams.'),
+]
+
+# Snapshot retention
+freenas_retention_opts = [
+    cfg.IntOpt('freenas_snapshot_retention_interval',
+               default=0,
+               min=0,
+               help='Seconds between snapshot pruning runs in the '
+                    'background. 0 disables pruning.'),
+    cfg.StrOpt('freenas_snapshot_retention_prefix',
+               default='auto-',
+               help='Only snapshots whose names start with this prefix are '
+                    'pruned. Snapshots of manila (agtsnap-) are better '
+                    'deleted through manila, which otherwise keeps their '
+                    'records.'),
+    cfg.IntOpt('freenas_snapshot_keep_last',
+               default=0,
+               min=0,
+               help='Number of newest snapshots of each share kept.'),
+    cfg.IntOpt('freenas_snapshot_keep_daily',
+               default=0,
+               min=0,
+               help='Number of most recent days with snapshots for which '
+                    'the newest snapshot of the day is kept.'),
+    cfg.IntOpt('freenas_snapshot_keep_weekly',
+               default=0,
+               min=0,
+               help='Number of most recent weeks with snapshots for which '
+                    'the newest snapshot of the week is kept.'),
+    cfg.IntOpt('freenas_snapshot_prune_workers',
+               default=4,
+               min=1,
+               help='Maximum number of snapshot deletes in flight per pool '
+                    'while pruning.'),
+    cfg.BoolOpt('freenas_snapshot_range_delete',
+                default=False,
+                help='Delete runs of consecutive expired snapshots with one '
+                     'ZFS range delete (first%last). Runs the appliance '
+                     'refuses are deleted one by one.'),
+    cfg.BoolOpt('freenas_snapshot_prune_dry_run',
+                default=False,
+                help='Only log and count what background pruning would '
+                     'delete.'),
 ]
@@ -14,14 +14,31 @@
 
 
 # Helper utility for manila nfs driver
+import math
+import threading
+import time
+
+import eventlet
+import netaddr
 from oslo_log import log
 
+from manila.common import constants
 from manila import exception
 from manila.i18n import _
+from manila.share.drivers.freenas.asyncapi import FreeNASAsyncServer
 from manila.share.drivers.freenas.freenasapi import FreeNASApiError
+from manila.share.drivers.freenas.freenasapi import FreeNASDataset
+from manila.share.drivers.freenas.freenasapi import FreeNASNFSShare
+from manila.share.drivers.freenas.freenasapi import FreeNASRetryPolicy
+from manila.share.drivers.freenas.freenasapi import FreeNASScheduler
 from manila.share.drivers.freenas.freenasapi import FreeNASServer
+from manila.share.drivers.freenas.freenasapi import FreeNASSnapshot
+from manila.share.drivers.freenas.inventory import FreeNASInventory
+from manila.share.drivers.freenas.requestbuilder import FreeNASRequestBuilder
+from manila.share.drivers.freenas.retention import FreeNASRetentionPolicy
 from manila.share.drivers.freenas import utils
 import simplejson as json
+import six
 
 LOG = log.getLogger(__name__)
 
@@ -31,43 +48,108 @@ LOG = log.getLogger(__name__)
 
 class FreeNASProcessRequests(object):
 
-    def __init__(self, configuration):
+    def __init__(self, configuration, hostname=None, dataset=None,
+                 pool_name=None):
         self.config = configuration
+        self.hostname = hostname or self.config.freenas_server_hostname
+        self.dataset = dataset or self.config.freenas_dataset
+        self.pool_name = pool_name or self.dataset
         self.nfs_mount_point_base = (
             self.config.freenas_mount_point_base)
         self.dataset_compression = (
             self.config.freenas_dataset_compression)
         self.dataset_dedupe = self.config.freenas_dataset_dedupe
         self.storage_protocol = 'NFS'
+        self.requests = FreeNASRequestBuilder(self.dataset,
+                                              self._get_mount_path())
         self.handle = None
+        self.async_handle = None
+        self.inventory = None
+        self._inventory_active = False
+        self._volume_stat = None
+        self._volume_stat_expiry = 0
+        self._volume_props = {}
+        self._volume_stat_generation = 0
+        self._volume_stat_lock = threading.Lock()
+        self._retention_stats = {'runs': 0, 'last_run': None, 'deleted': 0,
+                                 'failed': 0, 'range_deletes': 0,
+                                 'reclaimed_bytes': 0}
+        self._retention_lock = threading.Lock()
+        self._pruning = False
+        self._last_prune = 0
+        self._inventory_sync_lock = threading.Lock()
+        self._syncing_inventory = False
+        self._last_inventory_sync = 0
 
-    def _create_handle(self, **kwargs):
+    def _create_handle(self, handle=None, **kwargs):
         """Instantiate handle (client) for API communication with
 
-           FreeNAS server
+           FreeNAS server, unless a handle to it is passed in.
         """
-        host_system = kwargs['hostname']
-        LOG.debug('FreeNAS server: %s', host_system)
-        self.handle = FreeNASServer(host=host_system,
-                                    port=kwargs['port'],
-                                    username=kwargs['login'],
-                                    password=kwargs['password'],
-                                    api_version=kwargs['api_version'],
-                                    transport_type=kwargs['transport_type'],
-                                    style=FreeNASServer.STYLE_LOGIN_PASSWORD)
+        if handle is None:
+            host_system = kwargs['hostname']
+            LOG.debug('FreeNAS server: %s', host_system)
+            handle = FreeNASServer(host=host_system,
+                                   port=kwargs['port'],
+                                   username=kwargs['login'],
+                                   password=kwargs['password'],
+                                   api_version=kwargs['api_version'],
+                                   transport_type=kwargs['transport_type'],
+                                   style=FreeNASServer.STYLE_LOGIN_PASSWORD,
+                                   pool_size=kwargs['pool_size'],
+                                   pool_idle_timeout=kwargs[
+                                       'pool_idle_timeout'],
+                                   timeout=kwargs['timeout'],
+                                   retry_policy=kwargs['retry_policy'],
+                                   breaker_threshold=kwargs[
+                                       'breaker_threshold'],
+                                   breaker_reset_timeout=kwargs[
+                                       'breaker_reset_timeout'],
+                                   max_concurrency=kwargs[
+                                       'max_concurrency'],
+                                   rate_limit=kwargs['rate_limit'],
+                                   rate_burst=kwargs['rate_burst'])
+        self.handle = handle
         if not self.handle:
             raise FreeNASApiError("Failed to create handle for \
                                    FREENAS server")
+        self.async_handle = FreeNASAsyncServer(
+            self.handle, max_concurrency=kwargs['max_workers'],
+            timeout=kwargs['timeout'])
+        self.inventory = FreeNASInventory(self.handle, self.dataset)
+
+    def do_setup(self, handle=None):
+        """Create REST API handle to FreeNAS Server.
 
-    def do_setup(self):
-        """Create REST API handle to FreeNAS Server."""
+           Pools on the same appliance pass the handle of the first one in,
+           so they share its connection pool and circuit breaker.
+        """
 
-        self._create_handle(hostname=self.config.freenas_server_hostname,
+        self._create_handle(handle=handle,
+                            hostname=self.hostname,
                             port=self.config.freenas_server_port,
                             login=self.config.freenas_login,
                             password=self.config.freenas_password,
                             api_version=self.config.freenas_api_version,
-                            transport_type=self.config.freenas_transport_type)
+                            transport_type=self.config.freenas_transport_type,
+                            pool_size=self.config.freenas_api_pool_size,
+                            pool_idle_timeout=(
+                                self.config.freenas_api_pool_idle_timeout),
+                            timeout=self.config.freenas_api_timeout,
+                            max_workers=self.config.freenas_max_workers,
+                            retry_policy=FreeNASRetryPolicy(
+                                self.config.freenas_api_max_retries,
+                                self.config.freenas_api_retry_backoff,
+                                self.config.freenas_api_retry_max_backoff),
+                            breaker_threshold=(
+                                self.config.freenas_circuit_breaker_threshold),
+                            breaker_reset_timeout=(
+                                self.config.
+                                freenas_circuit_breaker_reset_timeout),
+                            max_concurrency=(
+                                self.config.freenas_api_max_concurrency),
+                            rate_limit=self.config.freenas_api_rate_limit,
+                            rate_burst=self.config.freenas_api_rate_burst)
         if not self.handle:
                 raise FreeNASApiError("Failed to create handle \
                                        for FREENAS server")
@@ -75,97 +157,277 @@ class FreeNASProcessRequests(object):
     def check_for_setup_error(self):
         """Check prerequisite to met for driver functionality"""
 
-        if self.config.freenas_dataset != FreeNASServer.DS_NAME:
-            raise FreeNASApiError("Volume name must be agattivol \
-                                  for creating share")
+        vol_resp = self.handle.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                              self.requests.volume_url, None)
 
-        vol_req = ('%s/%s') % (FreeNASServer.REST_API_VOLUME,
-                               self.config.freenas_dataset)
+        if (vol_resp.get('status') != FreeNASServer.STATUS_OK or
+                (vol_resp.get('body') or {}).get('name') != self.dataset):
+            raise FreeNASApiError('Volume %s does not exist on %s' %
+                                  (self.dataset, self.hostname))
 
-        vol_resp = self.handle.invoke_command(FreeNASServer.SELECT_COMMAND,
-                                              vol_req, None)
+        self._inventory_active = True
+        self._sync_inventory()
 
-        if (json.loads(vol_resp['response'])['name'] !=
-                FreeNASServer.DS_NAME):
-            raise FreeNASApiError("Top Level volume name \
-                                   must be agattivol")
+    def _sync_inventory(self):
+        """Load or reconcile the local inventory, never failing the caller."""
+        try:
+            self.inventory.reconcile()
+        except Exception as e:
+            LOG.warning('Could not refresh FreeNAS inventory: %s', e)
 
-    def _create_nfs_share(self, mountpoint):
-        nfsparams = {}
-        nfsparams['nfs_paths'] = mountpoint.split()
+    def _inventory_sync_due(self):
+        """Whether to start a reconcile, at most one per sync interval.
+
+           The interval counts from the start of the last attempt, so a
+           failing reconcile is not retried on every stats refresh.
+        """
+        interval = self.config.freenas_inventory_sync_interval
+        with self._inventory_sync_lock:
+            if (not self._inventory_active or self._syncing_inventory or
+                    not self.inventory.sync_due(interval) or
+                    time.time() - self._last_inventory_sync < interval):
+                return False
+            self._syncing_inventory = True
+            self._last_inventory_sync = time.time()
+            return True
 
-        nfs_req = ('%s/') % (FreeNASServer.REST_API_SHARE)
+    def _run_inventory_sync(self):
+        try:
+            self._sync_inventory()
+        finally:
+            with self._inventory_sync_lock:
+                self._syncing_inventory = False
 
-        LOG.debug('create share parmas : %s', json.dumps(nfsparams))
+    def _is_not_found(self, resp):
+        return resp.get('code') == 404
+
+    def _create_nfs_share(self, mountpoint, access=None):
+        if self.inventory.get_nfs_share_id(mountpoint) is not None:
+            LOG.debug('NFS share for %s already exists', mountpoint)
+            return
+        nfsparams = dict(access or {})
+        nfsparams['nfs_paths'] = mountpoint.split()
+        body = json.dumps(nfsparams)
+
+        LOG.debug('create share parmas : %s', body)
         nfs_resp = self.handle.invoke_command(FreeNASServer.CREATE_COMMAND,
-                                              nfs_req, json.dumps(nfsparams))
+                                              self.requests.nfs_shares_url,
+                                              body)
 
-        LOG.debug('create NFS share response : %s', json.dumps(nfs_resp))
+        LOG.debug('create NFS share response : %s', utils.LazyJSON(nfs_resp))
         if nfs_resp['status'] != FreeNASServer.STATUS_OK:
             msg = ('Error while creating dataset: %s' % nfs_resp['response'])
             raise FreeNASApiError('Unexpected error', msg)
+        self.inventory.add_nfs_share(mountpoint,
+                                     nfs_resp.get('body') or nfsparams)
 
-    def create_dataset(self, share):
-        """Create dataset on FreeNAS
+    def _delete_nfs_share(self, mountpoint):
+        nfs_id = self.inventory.get_nfs_share_id(mountpoint)
+        if nfs_id is None:
+            return
+        nfs_resp = self.handle.invoke_command(
+            FreeNASServer.DELETE_COMMAND, self.requests.nfs_share_url(nfs_id),
+            None)
+        if (nfs_resp['status'] != FreeNASServer.STATUS_OK and
+                not self._is_not_found(nfs_resp)):
+            msg = ('Error while deleting NFS share: %s' %
+                   nfs_resp['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+        self.inventory.remove_nfs_share(mountpoint)
 
-           Export dataset as NFS share.
-           Return export nfs share path.
-        """
+    def _create_dataset(self, share):
+        """Create dataset on FreeNAS and return its name/mountpoint."""
         LOG.debug('create share: %s', share['name'])
-        dataset = utils.generate_share_name(share['name'],
-                                            self._get_mount_path())
-        dataset['refquote'] = str(share['size']) + "G"
-        dataset['dedup'] = self.dataset_dedupe
-        dataset['compression'] = self.dataset_dedupe
-
-        LOG.debug('create dataset parmas : %s', json.dumps(dataset))
-        ds_req = ('%s/%s/%s/') % (FreeNASServer.REST_API_VOLUME,
-                                  self.config.freenas_dataset,
-                                  FreeNASServer.DATASET)
+        dataset = self.requests.get_share(share['name'])
+        if self.inventory.has_dataset(dataset.name):
+            LOG.debug('Dataset %s already exists', dataset.name)
+            return dataset
+        body = json.dumps({'name': dataset.name,
+                           'mountpoint': dataset.mountpoint,
+                           'refquota': str(share['size']) + "G",
+                           'dedup': self.dataset_dedupe,
+                           'compression': self.dataset_compression})
 
+        LOG.debug('create dataset parmas : %s', body)
         ds_resp = self.handle.invoke_command(FreeNASServer.CREATE_COMMAND,
-                                             ds_req, json.dumps(dataset))
+                                             self.requests.datasets_url,
+                                             body)
 
-        LOG.debug('create dataset response : %s', json.dumps(ds_resp))
+        LOG.debug('create dataset response : %s', utils.LazyJSON(ds_resp))
         if ds_resp['status'] != FreeNASServer.STATUS_OK:
             msg = ('Error while creating dataset: %s' % ds_resp)
             raise FreeNASApiError('Unexpected error', msg)
+        self._invalidate_volume_stat()
+        self.inventory.add_dataset(dataset.name, ds_resp.get('body'),
+                                   size=share['size'])
 
         LOG.info('Created share %s for shareID %s',
-                 dataset['name'], share['share_id'])
-        self._create_nfs_share(dataset['mountpoint'])
-        path = self._get_share_path(dataset['name'])
-        return [self._get_location_path(path, share['share_proto'])]
+                 dataset.name, share['share_id'])
+        return dataset
+
+    def create_dataset(self, share):
+        """Create dataset on FreeNAS
+
+           The dataset is exported once access rules are added.
+           Return export nfs share path.
+        """
+        if share['share_proto'] != self.config.freenas_storage_protocol:
+            raise exception.InvalidShare(
+                reason=(_('Only NFS protocol is currently supported.')))
+        dataset = self._create_dataset(share)
+        return [self._get_location_path(dataset.mountpoint,
+                                        share['share_proto'])]
+
+    def submit(self, func, *args, **kwargs):
+        """Start a share or snapshot operation without blocking.
+
+           func is one of the operations of this class, e.g.
+           self.delete_snapshot. Returns a FreeNASFuture whose wait()
+           gives the operation result.
+        """
+        return self.async_handle.spawn(func, *args, **kwargs)
+
+    def _run_concurrently(self, func, items):
+        """Run func over items on a bounded green thread pool.
+
+           Yields (item, result, error) tuples in the order of items.
+        """
+        def _call(item):
+            try:
+                return item, func(item), None
+            except Exception as e:
+                LOG.exception('FreeNAS bulk operation failed for %s', item)
+                return item, None, e
+
+        pool = eventlet.GreenPool(self.config.freenas_max_workers)
+        return pool.imap(_call, items)
+
+    def create_datasets(self, shares):
+        """Create datasets for many shares concurrently.
+
+           Returns a dict keyed by share id holding either
+           'export_locations' or 'error' for that share.
+        """
+        results = {}
+        pending = []
+        for share in shares:
+            if share['share_proto'] != self.config.freenas_storage_protocol:
+                results[share['id']] = {
+                    'error': _('Only NFS protocol is currently supported.')}
+            else:
+                pending.append(share)
+
+        for share, dataset, err in self._run_concurrently(
+                self._create_dataset, pending):
+            if err:
+                results[share['id']] = {'error': six.text_type(err)}
+            else:
+                results[share['id']] = {'export_locations': [
+                    self._get_location_path(dataset.mountpoint,
+                                            share['share_proto'])]}
+        return results
 
     def set_quota(self, share, new_size):
         """Update quota size for freenas share. """
 
-        qt_params = utils.generate_share_name(share['name'],
-                                              self._get_mount_path())
-        qt_params['refquote'] = '%sG' % new_size
-
-        qt_req = ('%s/%s/%s/%s') % (FreeNASServer.REST_API_VOLUME,
-                                    self.config.freenas_dataset,
-                                    FreeNASServer.DATASET, qt_params['name'])
+        dataset = self._get_share_dataset(share['name'])
+        self._update_dataset(dataset.name, {'refquota': '%sG' % new_size})
+        self._invalidate_volume_stat()
 
-        qt_resp = self.handle.invoke_command(FreeNASServer.CREATE_COMMAND,
-                                             qt_req, json.dumps(qt_params))
+    @staticmethod
+    def _get_usage_in_gb(dataset):
+        # refquota limits the referenced space, snapshots do not count.
+        usage = dataset.get('refer')
+        if usage is None:
+            usage = dataset.get('used')
+        return utils.get_quota_in_gb(usage)
 
-        LOG.debug('Update dataset response : %s', json.dumps(qt_resp))
-        if qt_resp['status'] != FreeNASServer.STATUS_OK:
-            msg = ('Error while creating dataset: %s' % qt_resp['response'])
+    def _get_dataset_usage(self, name):
+        """GB referenced by a dataset, read with a single GET."""
+        ds_resp = self.handle.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                             self.requests.dataset_url(name),
+                                             None)
+        if ds_resp['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while reading dataset: %s' % ds_resp['response'])
             raise FreeNASApiError('Unexpected error', msg)
+        return self._get_usage_in_gb(ds_resp.get('body') or {})
+
+    def _get_datasets_usage(self):
+        """GB referenced by each dataset under the pool, from one listing."""
+        parent = self.dataset + '/'
+        usage = {}
+        for dataset in self._paginate(self.requests.datasets_url,
+                                      ('name', 'used', 'refer')):
+            name = dataset['name']
+            if name.startswith(parent) and '/' not in name[len(parent):]:
+                usage[name[len(parent):]] = self._get_usage_in_gb(dataset)
+        return usage
+
+    def _shrink(self, share, name, new_size, usage):
+        if usage > new_size:
+            raise exception.ShareShrinkingPossibleDataLoss(
+                share_id=share['id'])
+        try:
+            self.set_quota(share, new_size)
+        except FreeNASApiError:
+            # ZFS refuses a refquota below the referenced size, so data
+            # written since usage was read fails the update itself.
+            if self._get_dataset_usage(name) > new_size:
+                raise exception.ShareShrinkingPossibleDataLoss(
+                    share_id=share['id'])
+            raise
+
+    def shrink_share(self, share, new_size):
+        """Lower the refquota of a share, never below its usage."""
+        name = self._get_share_dataset(share['name']).name
+        self._shrink(share, name, new_size, self._get_dataset_usage(name))
+
+    def shrink_shares(self, shrinks):
+        """Shrink many shares concurrently with one dataset listing.
+
+           shrinks are dicts with 'id', 'share' and optionally 'new_size',
+           without it a share is right-sized to its usage rounded up to
+           whole GB. Returns a dict keyed by id holding either the new
+           'size' or 'error'.
+        """
+        usage = self._get_datasets_usage()
+
+        def _shrink(shrink):
+            name = self._get_share_dataset(shrink['share']['name']).name
+            if name not in usage:
+                raise exception.ShareResourceNotFound(
+                    share_id=shrink['share']['id'])
+            new_size = shrink.get('new_size')
+            if new_size is None:
+                new_size = max(int(math.ceil(usage[name])), 1)
+            self._shrink(shrink['share'], name, new_size, usage[name])
+            return new_size
+
+        results = {}
+        for shrink, new_size, err in self._run_concurrently(_shrink,
+                                                            shrinks):
+            results[shrink['id']] = ({'error': six.text_type(err)} if err
+                                     else {'size': new_size})
+        return results
 
     def _get_mount_path(self):
-        return (self.nfs_mount_point_base + "/"
-                + self.config.freenas_dataset)
+        return self.nfs_mount_point_base + "/" + self.dataset
+
+    def _get_share_dataset(self, share_name):
+        """FreeNASDatasetId of the dataset of a share.
+
+           Managed shares keep the name their dataset had, others use the
+           generated agtshare- name.
+        """
+        name = self.inventory.get_managed_dataset(share_name)
+        if name is None:
+            return self.requests.get_share(share_name)
+        return self.requests.get_dataset(name)
 
     def _get_location_path(self, path, protocol):
         location = None
         if protocol == self.config.freenas_storage_protocol:
-            location = {'path': '%s:%s' %
-                        (self.config.freenas_server_hostname,
-                         path)}
+            location = {'path': '%s:%s' % (self.hostname, path)}
         else:
             raise exception.InvalidShare(
                 reason=(_('Only NFS protocol is currently supported.')))
@@ -173,136 +435,853 @@ class FreeNASProcessRequests(object):
 
     def delete_share(self, share):
         """Delete share."""
-        share_name = utils.generate_share_name(share['name'],
-                                               self._get_mount_path())
+        dataset = self._get_share_dataset(share['name'])
 
-        del_req = ("%s/%s/%s/%s/") % (FreeNASServer.REST_API_VOLUME,
-                                      self.config.freenas_dataset,
-                                      FreeNASServer.DATASET,
-                                      share_name['name'])
+        self._delete_nfs_share(dataset.mountpoint)
 
-        LOG.debug('Delete dataset request : %s', del_req)
+        LOG.debug('Delete dataset request : %s', dataset.url)
         del_resp = self.handle.invoke_command(FreeNASServer.DELETE_COMMAND,
-                                              del_req, None)
+                                              dataset.url, None)
 
-        LOG.debug('Delete dataset response : %s', json.dumps(del_resp))
-        if del_resp['status'] != FreeNASServer.STATUS_OK:
+        LOG.debug('Delete dataset response : %s', utils.LazyJSON(del_resp))
+        if (del_resp['status'] != FreeNASServer.STATUS_OK and
+                not (self._is_not_found(del_resp) and
+                     self.inventory.loaded and
+                     not self.inventory.has_dataset(dataset.name))):
             msg = ('Error while creating dataset: %s' % del_resp['response'])
             raise FreeNASApiError('Unexpected error', msg)
+        self._invalidate_volume_stat()
+        self.inventory.remove_dataset(dataset.name)
 
     def _get_share_path(self, share_name):
-        return '%s/%s/%s' % (self.nfs_mount_point_base,
-                             self.config.freenas_dataset,
-                             share_name)
+        return self.requests.get_dataset(share_name).mountpoint
+
+    def _invalidate_volume_stat(self):
+        """Drop cached pool capacity after an operation changed usage."""
+        with self._volume_stat_lock:
+            self._volume_stat = None
+            self._volume_stat_generation += 1
 
     def _get_volume_stat(self):
+        """Returns (total, free, allocated) pool capacity in GB.
 
-        request_urn = ('%s/%s/') % (FreeNASServer.REST_API_VOLUME,
-                                    self.config.freenas_dataset)
+           The result is cached for freenas_stats_cache_ttl seconds. The
+           same request also refreshes the pool properties returned by
+           _get_volume_properties.
+        """
+        with self._volume_stat_lock:
+            if (self._volume_stat is not None and
+                    time.time() < self._volume_stat_expiry):
+                return self._volume_stat
+            generation = self._volume_stat_generation
+
+        request_urn = self.requests.volume_url
 
         LOG.debug('request_urn : %s', request_urn)
         ret = self.handle.invoke_command(FreeNASServer.SELECT_COMMAND,
                                          request_urn, None)
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while reading volume stats: %s' % ret['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+
+        volume = ret['body']
+        stat = (utils.get_size_in_gb(volume['avail'] + volume['used']),
+                utils.get_size_in_gb(volume['avail']),
+                utils.get_size_in_gb(volume['used']))
+
+        with self._volume_stat_lock:
+            self._volume_props = utils.get_volume_properties(volume)
+            # Do not cache numbers read while a share operation changed usage.
+            if generation == self._volume_stat_generation:
+                self._volume_stat = stat
+                self._volume_stat_expiry = (
+                    time.time() + self.config.freenas_stats_cache_ttl)
+        return stat
 
-        return ((utils.get_size_in_gb(json.loads(ret['response'])['avail']
-                + json.loads(ret['response'])['used'])),
-                utils.get_size_in_gb(json.loads(ret['response'])['avail']),
-                utils.get_size_in_gb(json.loads(ret['response'])['used']))
+    def _get_volume_properties(self):
+        """Pool properties from the last volume stats request."""
+        with self._volume_stat_lock:
+            return dict(self._volume_props)
 
     def update_share_stats(self):
         """Update driver capabilities."""
 
+        # Both run on their own green thread, the bulk listings must not
+        # count against the stats deadline.
+        if self._inventory_sync_due():
+            self.submit(self._run_inventory_sync)
+        if self._prune_due():
+            self.submit(self._run_pruning)
         total, free, allocated = self._get_volume_stat()
         compression = not self.dataset_compression == 'off'
         dedupe = not self.dataset_dedupe == 'off'
+        pool = {
+            'pool_name': self.pool_name,
+            'total_capacity_gb': total,
+            'free_capacity_gb': free,
+            'used_capacity_gb': allocated,
+            'snapshot_support': True,
+            'create_share_from_snapshot_support': True,
+            'revert_to_snapshot_support': True,
+            'reserved_percentage': self.config.reserved_share_percentage,
+            'compression': compression,
+            'dedupe': dedupe,
+            'thin_provisioning': self.config.freenas_thin_provisioning,
+        }
+        pool.update(self._get_volume_properties())
+        if self.inventory and self.inventory.loaded:
+            pool['provisioned_capacity_gb'] = round(
+                self.inventory.provisioned_gb, 2)
+            pool['max_over_subscription_ratio'] = (
+                self.config.max_over_subscription_ratio)
         return {
             'vendor_name': 'FreeNAS',
             'storage_protocol': self.storage_protocol,
             'nfs_mount_point_base': self.nfs_mount_point_base,
-            'pools': [{
-                'pool_name': self.config.freenas_dataset,
-                'total_capacity_gb': total,
-                'free_capacity_gb': free,
-                'snapshot_support': True,
-                'create_share_from_snapshot_support': True,
-                'reserved_percentage':
-                    self.config.reserved_share_percentage,
-                'compression': compression,
-                'dedupe': dedupe,
-                'thin_provisioning': self.config.freenas_thin_provisioning,
-            }],
+            'pools': [pool],
         }
 
-    def create_snapshot(self, snapshot):
-        """Create snapshot of given share. """
+    def _paginate(self, request_d, fields):
+        return self.async_handle.paginate(
+            request_d, self.config.freenas_list_page_size, fields)
+
+    def list_datasets(self, prefix=utils.SHARE_PREFIX):
+        """Yield FreeNASDataset for the datasets directly under the pool.
+
+           Only names starting with prefix are returned, None returns all.
+        """
+        parent = self.dataset + '/'
+        for dataset in self._paginate(self.requests.datasets_url,
+                                      ('name', 'mountpoint', 'refquota')):
+            name = dataset['name']
+            if not name.startswith(parent) or '/' in name[len(parent):]:
+                continue
+            name = name[len(parent):]
+            if prefix is None or name.startswith(prefix):
+                yield FreeNASDataset(name, dataset.get('mountpoint'),
+                                     dataset.get('refquota'))
+
+    def list_nfs_shares(self, prefix=utils.SHARE_PREFIX):
+        """Yield FreeNASNFSShare for the exports of datasets in the pool.
+
+           Only exports of datasets whose name starts with prefix are
+           returned, None returns all.
+        """
+        parent = self._get_mount_path() + '/' + (prefix or '')
+        for nfs_share in self._paginate(self.requests.nfs_shares_url,
+                                        ('id', 'nfs_paths')):
+            paths = nfs_share.get('nfs_paths') or []
+            if any(path.startswith(parent) for path in paths):
+                yield FreeNASNFSShare(nfs_share['id'], paths)
+
+    def list_snapshots(self, prefix=utils.SNAPSHOT_PREFIX):
+        """Yield FreeNASSnapshot for snapshots of datasets in the pool.
+
+           Only snapshot names starting with prefix are returned, None
+           returns all.
+        """
+        parent = self.dataset + '/'
+        for snapshot in self._paginate(self.requests.snapshots_url,
+                                       ('name', 'filesystem')):
+            filesystem = snapshot.get('filesystem', '')
+            if not filesystem.startswith(parent):
+                continue
+            if prefix is None or snapshot['name'].startswith(prefix):
+                yield FreeNASSnapshot(filesystem[len(parent):],
+                                      snapshot['name'])
+
+    def ensure_shares(self, shares):
+        """Check many shares against two bulk listings.
+
+           Returns a dict keyed by share id with the export locations of
+           each share found. Access rules are reapplied to shares without
+           an NFS export, which exports those that have rules; a share
+           whose dataset is missing is flagged with error status.
+        """
+        # Managed shares keep their dataset name, list all exports.
+        exports = eventlet.spawn(
+            lambda: set(path for nfs_share in self.list_nfs_shares(None)
+                        for path in nfs_share.paths))
+        datasets = set(dataset.name for dataset in self.list_datasets(None))
+        exported = exports.wait()
+
+        results = {}
+        for share in shares:
+            dataset = self._get_share_dataset(share['name'])
+            if dataset.name not in datasets:
+                LOG.warning('Dataset %(ds)s of share %(id)s is missing',
+                            {'ds': dataset.name, 'id': share['id']})
+                results[share['id']] = {'status': constants.STATUS_ERROR}
+                continue
+            try:
+                location = self._get_location_path(dataset.mountpoint,
+                                                   share['share_proto'])
+            except Exception as e:
+                LOG.warning('Could not ensure share %(id)s: %(err)s',
+                            {'id': share['id'], 'err': e})
+                results[share['id']] = {'status': constants.STATUS_ERROR}
+                continue
+            results[share['id']] = {
+                'export_locations': [location],
+                'reapply_access_rules': dataset.mountpoint not in exported}
+        return results
+
+    @staticmethod
+    def _parse_access_rule(rule):
+        """Returns the /sharing/nfs field and value of an IP rule.
+
+           Single addresses go to nfs_hosts, networks to nfs_network.
+        """
+        if rule['access_type'] != 'ip':
+            raise exception.InvalidShareAccess(
+                reason=_('Only IP access type is supported.'))
+        try:
+            network = netaddr.IPNetwork(rule['access_to'])
+        except (netaddr.AddrFormatError, ValueError):
+            raise exception.InvalidShareAccess(
+                reason=_('Invalid IP address or network %s.') %
+                rule['access_to'])
+        if network.size == 1:
+            return 'nfs_hosts', str(network.ip)
+        return 'nfs_network', str(network.cidr)
+
+    def _get_unsupported_rules(self, rules):
+        """access_id -> error state of the rules that cannot be applied."""
+        failed = {}
+        for rule in rules:
+            try:
+                self._parse_access_rule(rule)
+            except exception.InvalidShareAccess as e:
+                LOG.warning('Skipping access rule %(id)s: %(err)s',
+                            {'id': rule['access_id'], 'err': e})
+                failed[rule['access_id']] = {'state': 'error'}
+        return failed
+
+    @staticmethod
+    def _get_read_only(access_rules):
+        """nfs_ro of an export, which holds for all of its clients."""
+        levels = set(rule['access_level'] for rule in access_rules)
+        if len(levels) > 1:
+            raise exception.InvalidShareAccessLevel(
+                level=constants.ACCESS_LEVEL_RO)
+        return levels == set([constants.ACCESS_LEVEL_RO])
+
+    @staticmethod
+    def _get_export_clients(export):
+        return dict((field, set((export.get(field) or '').split()))
+                    for field in ('nfs_hosts', 'nfs_network'))
+
+    def _get_access_clients(self, export, access_rules, add_rules,
+                            delete_rules):
+        """Clients the export must allow, by /sharing/nfs field.
+
+           Changes are applied to the indexed export, the full rule list is
+           only walked when there is no export yet or for a resync.
+        """
+        if export is None or not (add_rules or delete_rules):
+            clients = {'nfs_hosts': set(), 'nfs_network': set()}
+            add_rules = access_rules
+        else:
+            clients = self._get_export_clients(export)
+        for rule in delete_rules:
+            try:
+                field, value = self._parse_access_rule(rule)
+            except exception.InvalidShareAccess:
+                # Never applied.
+                continue
+            clients[field].discard(value)
+        for rule in add_rules:
+            field, value = self._parse_access_rule(rule)
+            clients[field].add(value)
+        return clients
 
-        share_params = utils.generate_share_name(snapshot['share']['name'],
-                                                 self._get_mount_path())
-        snap_params = {}
-        snap_params['dataset'] = ('%s/%s') % (self.config.freenas_dataset,
-                                              share_params['name'])
-        snap_params['name'] = utils.generate_snapshot_name(snapshot['name'])
-        request_urn = ('%s/') % (FreeNASServer.REST_API_SNAPSHOT)
+    def update_access(self, share, access_rules, add_rules=None,
+                      delete_rules=None):
+        """Apply manila access rules to the NFS export of a share.
 
-        LOG.debug('Snaps params %s', json.dumps(snap_params))
+           Only the fields that change are sent, with one request: the
+           export is created with the first rule, updated with a PUT and
+           removed with the last rule, as FreeNAS exports to everyone when
+           no client is listed. Without add_rules and delete_rules the
+           export is resynced to access_rules.
+           Rules that are not valid IP rules are skipped, the others are
+           applied. Returns the access_id -> {'state': 'error'} of those
+           skipped.
+        """
+        add_rules = add_rules or []
+        delete_rules = delete_rules or []
+        failed = self._get_unsupported_rules(access_rules + add_rules)
+        if failed:
+            access_rules = [rule for rule in access_rules
+                            if rule['access_id'] not in failed]
+            add_rules = [rule for rule in add_rules
+                         if rule['access_id'] not in failed]
+        mountpoint = self._get_share_dataset(share['name']).mountpoint
+        export = self.inventory.get_nfs_share(mountpoint)
+        clients = self._get_access_clients(export, access_rules, add_rules,
+                                           delete_rules)
+        if not (clients['nfs_hosts'] or clients['nfs_network']):
+            if export is not None:
+                LOG.debug('Unexporting share %s', share['name'])
+                self._delete_nfs_share(mountpoint)
+            return failed
+
+        read_only = self._get_read_only(access_rules)
+        access = dict((field, ' '.join(sorted(values)))
+                      for field, values in clients.items())
+        access['nfs_ro'] = read_only
+        if export is None:
+            self._create_nfs_share(mountpoint, access)
+            return failed
+
+        current = self._get_export_clients(export)
+        changes = dict((field, access[field]) for field in clients
+                       if clients[field] != current[field])
+        if bool(export.get('nfs_ro')) != read_only:
+            changes['nfs_ro'] = read_only
+        if not changes:
+            LOG.debug('Access to share %s is up to date', share['name'])
+            return failed
+        body = json.dumps(changes)
+        LOG.debug('update NFS share params : %s', body)
+        nfs_resp = self.handle.invoke_command(
+            FreeNASServer.UPDATE_COMMAND,
+            self.requests.nfs_share_url(export['id']), body)
+        if nfs_resp['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while updating NFS share: %s' %
+                   nfs_resp['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+        self.inventory.update_nfs_share(mountpoint, **changes)
+        return failed
+
+    def resync_shares_access(self, updates):
+        """Resync the exports of many shares concurrently.
+
+           FreeNAS v1.0 has no bulk NFS share update, each share gets its
+           own update_access requests on the bounded worker pool.
+           updates are dicts with 'id', 'share' and 'access_rules'. Returns
+           a dict keyed by id, with 'error' for each failed share.
+        """
+        results = {}
+        for update, _result, err in self._run_concurrently(
+                lambda update: self.update_access(update['share'],
+                                                  update['access_rules']),
+                updates):
+            results[update['id']] = ({'error': six.text_type(err)} if err
+                                     else {})
+        return results
+
+    def get_api_stats(self):
+        """Request metrics, pool and retry counters of the API handle."""
+        if not self.handle:
+            return {}
+        return self.handle.get_stats()
+
+    def _create_snapshot(self, dataset_name, snap_name):
+        """Snapshot a dataset of the pool, unless the inventory has it."""
+        if self.inventory.has_snapshot(dataset_name, snap_name):
+            LOG.debug('Snapshot %s already exists', snap_name)
+            return
+        body = json.dumps({'dataset': '%s/%s' % (self.dataset, dataset_name),
+                           'name': snap_name})
+        LOG.debug('Snaps params %s', body)
         ret = self.handle.invoke_command(FreeNASServer.CREATE_COMMAND,
-                                         request_urn, json.dumps(snap_params))
+                                         self.requests.snapshots_url, body)
         if ret['status'] != FreeNASServer.STATUS_OK:
             msg = ('Error while creating snapshot: %s' % ret['response'])
             raise FreeNASApiError('Unexpected error', msg)
+        self.inventory.add_snapshot(dataset_name, snap_name, ret.get('body'))
+
+    def _get_retention_policy(self):
+        return FreeNASRetentionPolicy(self.config.freenas_snapshot_keep_last,
+                                      self.config.freenas_snapshot_keep_daily,
+                                      self.config.freenas_snapshot_keep_weekly)
+
+    def _list_snapshot_records(self):
+        """Snapshot records of the datasets directly under the pool.
+
+           Returns a dict of dataset name -> list of records, read with one
+           paginated listing.
+        """
+        parent = self.dataset + '/'
+        snapshots = {}
+        for snapshot in self._paginate(
+                self.requests.snapshots_url,
+                ('name', 'filesystem', 'creation', 'used')):
+            filesystem = snapshot.get('filesystem', '')
+            dataset_name = filesystem[len(parent):]
+            if filesystem.startswith(parent) and '/' not in dataset_name:
+                snapshots.setdefault(dataset_name, []).append(snapshot)
+        return snapshots
+
+    def _get_prune_batches(self, snapshots, expired):
+        """Split the expired snapshots of a dataset into delete batches.
+
+           With range deletes, each run of expired snapshots not broken by
+           a kept one is one batch. ZFS destroys a range in creation order,
+           so that needs the distinct creation times of all snapshots.
+        """
+        if not self.config.freenas_snapshot_range_delete:
+            return [[name] for name in expired]
+        created = [(utils.get_snapshot_time(
+                        {'creation': snapshot.get('creation')}),
+                    snapshot['name']) for snapshot in snapshots]
+        times = [taken for taken, _name in created]
+        if None in times or len(set(times)) != len(times):
+            return [[name] for name in expired]
+        expired = set(expired)
+        batches = []
+        run = []
+        for _taken, name in sorted(created):
+            if name in expired:
+                run.append(name)
+            elif run:
+                batches.append(run)
+                run = []
+        if run:
+            batches.append(run)
+        return batches
+
+    def _delete_snapshot_batch(self, dataset_name, names):
+        """Delete snapshots of a dataset at bulk priority.
+
+           Returns (names deleted, whether one range delete did it).
+        """
+        if len(names) > 1:
+            ret = self.handle.invoke_command(
+                FreeNASServer.DELETE_COMMAND,
+                self.requests.snapshot_range_url(dataset_name, names[0],
+                                                 names[-1]),
+                None, priority=FreeNASScheduler.BULK)
+            if ret['status'] == FreeNASServer.STATUS_OK:
+                for name in names:
+                    self.inventory.remove_snapshot(dataset_name, name)
+                return names, True
+            LOG.debug('Range delete of %(first)s to %(last)s refused, '
+                      'deleting one by one', {'first': names[0],
+                                              'last': names[-1]})
+        deleted = []
+        for name in names:
+            ret = self.handle.invoke_command(
+                FreeNASServer.DELETE_COMMAND,
+                self.requests.snapshot_url(dataset_name, name), None,
+                priority=FreeNASScheduler.BULK)
+            if (ret['status'] != FreeNASServer.STATUS_OK and
+                    not self._is_not_found(ret)):
+                LOG.warning('Could not delete snapshot %(ds)s@%(snap)s: '
+                            '%(err)s', {'ds': dataset_name, 'snap': name,
+                                        'err': ret.get('response')})
+                continue
+            self.inventory.remove_snapshot(dataset_name, name)
+            deleted.append(name)
+        return deleted, False
+
+    def prune_snapshots(self, dry_run=False):
+        """Delete the snapshots expired under the retention policy.
+
+           Only snapshots named with freenas_snapshot_retention_prefix are
+           pruned. Deletes run at bulk priority, at most
+           freenas_snapshot_prune_workers at a time. A dry run only reports
+           what would be deleted.
+
+           Returns a dict with the full names of the 'expired' snapshots,
+           the 'deleted' and 'failed' counts and 'reclaimed_bytes', the sum
+           of the space used by the deleted snapshots alone.
+        """
+        policy = self._get_retention_policy()
+        prefix = self.config.freenas_snapshot_retention_prefix
+        report = {'dry_run': dry_run, 'expired': [], 'deleted': 0,
+                  'failed': 0, 'reclaimed_bytes': 0}
+        reclaimable = {}
+        batches = []
+        for dataset_name, snapshots in sorted(
+                self._list_snapshot_records().items()):
+            candidates = [snapshot for snapshot in snapshots
+                          if snapshot['name'].startswith(prefix)]
+            expired = policy.get_expired(
+                [(snapshot['name'], utils.get_snapshot_time(snapshot))
+                 for snapshot in candidates])
+            if not expired:
+                continue
+            for snapshot in candidates:
+                reclaimable[(dataset_name, snapshot['name'])] = int(
+                    utils.get_quota_in_gb(snapshot.get('used')) * utils.GB)
+            report['expired'].extend('%s/%s@%s' % (self.dataset,
+                                                   dataset_name, name)
+                                     for name in expired)
+            batches.extend((dataset_name, batch) for batch in
+                           self._get_prune_batches(snapshots, expired))
+
+        if dry_run:
+            report['reclaimed_bytes'] = sum(
+                reclaimable[(dataset_name, name)]
+                for dataset_name, batch in batches for name in batch)
+            LOG.info('Snapshot pruning dry run on %(pool)s: %(count)d '
+                     'expired', {'pool': self.pool_name,
+                                 'count': len(report['expired'])})
+            return report
+
+        def _delete(item):
+            dataset_name, names = item
+            try:
+                return item, self._delete_snapshot_batch(dataset_name,
+                                                         names)
+            except Exception as e:
+                LOG.warning('Could not delete snapshots of %(ds)s: '
+                            '%(err)s', {'ds': dataset_name, 'err': e})
+                return item, ([], False)
+
+        range_deletes = 0
+        pool = eventlet.GreenPool(self.config.freenas_snapshot_prune_workers)
+        for (dataset_name, names), (deleted, ranged) in pool.imap(_delete,
+                                                                 batches):
+            report['deleted'] += len(deleted)
+            report['failed'] += len(names) - len(deleted)
+            report['reclaimed_bytes'] += sum(
+                reclaimable[(dataset_name, name)] for name in deleted)
+            range_deletes += ranged
+        if report['deleted']:
+            self._invalidate_volume_stat()
+        with self._retention_lock:
+            stats = self._retention_stats
+            stats['runs'] += 1
+            stats['last_run'] = time.time()
+            stats['deleted'] += report['deleted']
+            stats['failed'] += report['failed']
+            stats['range_deletes'] += range_deletes
+            stats['reclaimed_bytes'] += report['reclaimed_bytes']
+        LOG.info('Pruned %(deleted)d snapshots on %(pool)s, %(failed)d '
+                 'failed, %(bytes)d bytes reclaimed',
+                 {'deleted': report['deleted'], 'pool': self.pool_name,
+                  'failed': report['failed'],
+                  'bytes': report['reclaimed_bytes']})
+        return report
+
+    def _prune_due(self):
+        interval = self.config.freenas_snapshot_retention_interval
+        with self._retention_lock:
+            if (not interval or self._pruning or
+                    time.time() - self._last_prune < interval):
+                return False
+            self._pruning = True
+            self._last_prune = time.time()
+            return True
+
+    def _run_pruning(self):
+        try:
+            self.prune_snapshots(self.config.freenas_snapshot_prune_dry_run)
+        except Exception:
+            LOG.exception('FreeNAS snapshot pruning failed.')
+        finally:
+            with self._retention_lock:
+                self._pruning = False
+
+    def get_retention_stats(self):
+        """Counters of the snapshot pruning runs of this pool."""
+        with self._retention_lock:
+            return dict(self._retention_stats)
+
+    def create_snapshot(self, snapshot):
+        """Create snapshot of given share. """
+
+        dataset = self._get_share_dataset(snapshot['share']['name'])
+        snap_name = self.requests.get_snapshot_name(snapshot['name'])
+        self._create_snapshot(dataset.name, snap_name)
 
         model_update = {'provider_location': '%s@%s' %
-                        (self._get_share_path(share_params['name']),
-                         snap_params['name'])}
+                        (dataset.mountpoint, snap_name)}
         return model_update
 
-    def delete_snapshot(self, snapshot):
-        """delete snapshot of given share. """
+    def create_snapshots(self, snapshots):
+        """Create snapshots of many shares concurrently.
 
-        snap_params = utils.generate_share_name(snapshot['share']['name'],
-                                                self._get_mount_path())
-        snap_name = utils.generate_snapshot_name(snapshot['name'])
+           Returns a dict keyed by snapshot id holding either
+           'provider_location' or 'error' for that snapshot.
+        """
+        results = {}
+        for snapshot, model_update, err in self._run_concurrently(
+                self.create_snapshot, snapshots):
+            if err:
+                results[snapshot['id']] = {'error': six.text_type(err)}
+            else:
+                results[snapshot['id']] = model_update
+        return results
 
-        request_urn = ('%s/%s/%s@%s/') % (FreeNASServer.REST_API_SNAPSHOT,
-                                          self.config.freenas_dataset,
-                                          snap_params['name'], snap_name)
+    def _delete_snapshot(self, dataset_name, snap_name):
+        """Delete a snapshot, already deleted ones count as success."""
+        request_urn = self.requests.snapshot_url(dataset_name, snap_name)
         LOG.debug('Snaps del req %s', request_urn)
 
         ret = self.handle.invoke_command(FreeNASServer.DELETE_COMMAND,
                                          request_urn, None)
-        if ret['status'] != FreeNASServer.STATUS_OK:
+        if (ret['status'] != FreeNASServer.STATUS_OK and
+                not (self._is_not_found(ret) and self.inventory.loaded and
+                     not self.inventory.has_snapshot(dataset_name,
+                                                     snap_name))):
             msg = ('Error while creating snapshot: %s' % ret['response'])
             raise FreeNASApiError('Unexpected error', msg)
+        self.inventory.remove_snapshot(dataset_name, snap_name)
+
+    def delete_snapshot(self, snapshot):
+        """delete snapshot of given share. """
+
+        dataset = self._get_share_dataset(snapshot['share']['name'])
+        self._delete_snapshot(dataset.name, self.requests.get_snapshot_name(
+            snapshot['name']))
 
     def create_share_from_snapshot(self, share, snapshot):
         """Create Cloned dataset on freenas
 
-           Export dataset as NFS share.
+           The clone is exported once access rules are added.
            Return exported path of NFS share.
         """
-        base_ds = utils.generate_share_name(snapshot['share_name'],
-                                            self._get_mount_path())
-        snap_name = utils.generate_snapshot_name(snapshot['name'])
-        clone_ds = utils.generate_share_name(share['name'],
-                                             self._get_mount_path())
-        clone_ds['refquota'] = str(share['size']) + 'G'
-        clone_args = {}
-        clone_args['name'] = ("%s/%s") % (self.config.freenas_dataset,
-                                          clone_ds['name'])
-
-        clone_req = ('%s/%s/%s@%s/%s/') % (FreeNASServer.REST_API_SNAPSHOT,
-                                           self.config.freenas_dataset,
-                                           base_ds['name'], snap_name,
-                                           FreeNASServer.CLONE)
-
-        clone_resp = self.handle.invoke_command(FreeNASServer.CREATE_COMMAND,
-                                                clone_req,
-                                                json.dumps(clone_args))
+        base_ds = self._get_share_dataset(snapshot['share_name'])
+        snap_name = self.requests.get_snapshot_name(snapshot['name'])
+        clone_ds = self.requests.get_share(share['name'])
+        clone_req = self.requests.snapshot_url(base_ds.name, snap_name,
+                                               FreeNASServer.CLONE)
+
+        clone_resp = self.handle.invoke_command(
+            FreeNASServer.CREATE_COMMAND, clone_req,
+            json.dumps({'name': '%s/%s' % (self.dataset, clone_ds.name)}))
         if clone_resp['status'] != FreeNASServer.STATUS_OK:
             msg = ('Error while creating snapshot: %s' %
                    clone_resp['response'])
             raise FreeNASApiError('Unexpected error', msg)
+        self._invalidate_volume_stat()
+        self.inventory.add_dataset(clone_ds.name)
+        # A clone has no refquota of its own, give it the share size.
+        self._update_dataset(clone_ds.name,
+                             {'refquota': '%sG' % share['size']})
+
+        return [self._get_location_path(clone_ds.mountpoint,
+                                        share['share_proto'])]
+
+    def get_share_status(self, share):
+        """Status of a share from its dataset on the appliance.
+
+           Used when no clone job is tracked, e.g. after a restart. A clone
+           that exists but missed its refquota gets it now.
+        """
+        dataset = self._get_share_dataset(share['name'])
+        ds_resp = self.handle.invoke_command(
+            FreeNASServer.SELECT_COMMAND,
+            self.requests.dataset_url(dataset.name), None)
+        if self._is_not_found(ds_resp):
+            return {'status': constants.STATUS_ERROR}
+        if ds_resp['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while reading dataset: %s' % ds_resp['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+        body = ds_resp.get('body') or {}
+        self.inventory.add_dataset(dataset.name, body)
+        if not utils.get_quota_in_gb(body.get('refquota')):
+            self._update_dataset(dataset.name,
+                                 {'refquota': '%sG' % share['size']})
+        return {'status': constants.STATUS_AVAILABLE,
+                'export_locations': [self._get_location_path(
+                    dataset.mountpoint, share['share_proto'])]}
+
+    def _get_newer_snapshots(self, dataset_name, snap_name):
+        """Names of the snapshots of a dataset taken after snap_name."""
+        records = self._list_snapshot_records().get(dataset_name, [])
+        taken = dict((record['name'], utils.get_snapshot_time(record))
+                     for record in records)
+        since = taken.get(snap_name)
+        if since is None:
+            return []
+        return sorted(name for name, time_taken in taken.items()
+                      if time_taken is not None and time_taken > since)
+
+    def revert_to_snapshot(self, snapshot):
+        """Roll the dataset of a share back to its latest snapshot.
+
+           ZFS rolls back in place, no data is copied. It only rolls back
+           to the newest snapshot of the dataset, so newer ones (e.g. taken
+           by FreeNAS periodic tasks or replication) fail the revert
+           instead of being destroyed with it.
+        """
+        dataset = self._get_share_dataset(snapshot['share_name'])
+        snap_name = self.requests.get_snapshot_name(snapshot['name'])
+        newer = self._get_newer_snapshots(dataset.name, snap_name)
+        if newer:
+            raise exception.InvalidShareSnapshot(
+                reason=_('Cannot revert to snapshot %(snap)s, dataset '
+                         '%(name)s has newer snapshots: %(newer)s.') %
+                {'snap': snap_name, 'name': dataset.name,
+                 'newer': ', '.join(newer)})
+        rollback_req = self.requests.snapshot_url(dataset.name, snap_name,
+                                                  FreeNASServer.ROLLBACK)
+        LOG.debug('Rollback request : %s', rollback_req)
+        ret = self.handle.invoke_command(FreeNASServer.CREATE_COMMAND,
+                                         rollback_req, json.dumps({}))
+        if ret['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while reverting to snapshot: %s' % ret['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+        self._invalidate_volume_stat()
+
+    def _update_dataset(self, name, props):
+        ds_resp = self.handle.invoke_command(FreeNASServer.UPDATE_COMMAND,
+                                             self.requests.dataset_url(name),
+                                             json.dumps(props))
+        if ds_resp['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while updating dataset: %s' % ds_resp['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+        self.inventory.update_dataset(name, **props)
+
+    def _get_managed_dataset_name(self, share):
+        """Dataset named by the export location of a share to manage."""
+        if share['share_proto'] != self.config.freenas_storage_protocol:
+            raise exception.ManageInvalidShare(
+                reason=_('Only NFS protocol is currently supported.'))
+        locations = share.get('export_locations') or []
+        path = locations[0]['path'] if locations else ''
+        parent = self._get_mount_path() + '/'
+        path = path.split(':', 1)[-1].rstrip('/')
+        name = path[len(parent):]
+        if not path.startswith(parent) or not name or '/' in name:
+            raise exception.ManageInvalidShare(
+                reason=_('Export location %(path)s is not a dataset '
+                         'directly under %(parent)s.') %
+                {'path': path, 'parent': parent})
+        return name
+
+    def manage_existing(self, share, driver_options):
+        """Adopt an existing dataset as a share, in place.
+
+           The dataset is tagged with the share name in its comments, which
+           the inventory reads back after a restart. A dataset without a
+           refquota gets one of its used size, rounded up to whole GB.
+        """
+        name = self._get_managed_dataset_name(share)
+        ds_resp = self.handle.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                             self.requests.dataset_url(name),
+                                             None)
+        if self._is_not_found(ds_resp):
+            raise exception.ManageInvalidShare(
+                reason=_('Dataset %s does not exist.') % name)
+        if ds_resp['status'] != FreeNASServer.STATUS_OK:
+            msg = ('Error while reading dataset: %s' % ds_resp['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+        dataset = ds_resp.get('body') or {}
+        comments = dataset.get('comments') or ''
+        if (comments.startswith(utils.MANAGED_PREFIX) and
+                comments != utils.MANAGED_PREFIX + share['name']):
+            raise exception.ManageInvalidShare(
+                reason=_('Dataset %(name)s is already managed as '
+                         '%(share)s.') %
+                {'name': name, 'share': comments[len(utils.MANAGED_PREFIX):]})
+
+        props = {'comments': utils.MANAGED_PREFIX + share['name']}
+        size = int(math.ceil(utils.get_quota_in_gb(dataset.get('refquota'))))
+        if not size:
+            size = max(int(math.ceil(utils.get_quota_in_gb(
+                dataset.get('used')))), 1)
+            props['refquota'] = '%sG' % size
+        self._update_dataset(name, props)
+        self._invalidate_volume_stat()
+        LOG.info('Managing dataset %(name)s as share %(share)s',
+                 {'name': name, 'share': share['name']})
+        path = self._get_share_path(name)
+        return {'size': size,
+                'export_locations': [
+                    self._get_location_path(path, share['share_proto'])]}
+
+    def unmanage(self, share):
+        """Stop tracking a share, leaving its dataset and export alone."""
+        name = self.inventory.get_managed_dataset(share['name'])
+        if name is not None:
+            self._update_dataset(name, {'comments': ''})
+
+    def get_export_locations(self, share):
+        """Export locations of a share of this pool."""
+        return [self._get_location_path(
+            self._get_share_dataset(share['name']).mountpoint,
+            share['share_proto'])]
+
+    def set_read_only(self, share_name, read_only):
+        """Set the ZFS readonly property of the dataset of a share."""
+        self._update_dataset(self._get_share_dataset(share_name).name,
+                             {'readonly': 'on' if read_only else 'off'})
+
+    def _get_replication_params(self, share_name, target, replica_name):
+        source = self._get_share_dataset(share_name).name
+        dest = target._get_share_dataset(replica_name).name
+        return {'repl_filesystem': '%s/%s' % (self.dataset, source),
+                'repl_zfs': '%s/%s' % (target.dataset, dest),
+                'repl_remote_hostname': target.hostname}
+
+    def get_replication(self, share_name, target, replica_name):
+        """Replication task sending a share to a replica, None if none.
+
+           target is the processor of the pool holding the replica.
+        """
+        params = self._get_replication_params(share_name, target,
+                                              replica_name)
+        repl_req = self.requests.replications_url + '?limit=0'
+        for task in self.handle.iter_command(
+                repl_req, ('id', 'repl_filesystem', 'repl_zfs',
+                           'repl_remote_hostname', 'repl_lastsnapshot',
+                           'repl_status')):
+            if all(task.get(key) == value for key, value in params.items()):
+                return task
+        return None
+
+    def create_replication(self, share_name, target, replica_name):
+        """Start replicating a share to a replica on the target pool.
+
+           The FreeNAS replication task sends the replication snapshots of
+           the share, each incrementally from the newest snapshot the
+           replica already has. A first snapshot is taken right away.
+        """
+        if self.get_replication(share_name, target, replica_name) is None:
+            repl_params = self._get_replication_params(share_name, target,
+                                                       replica_name)
+            repl_params['repl_remote_port'] = (
+                self.config.freenas_replication_ssh_port)
+            repl_params['repl_compression'] = (
+                self.config.freenas_replication_compression)
+            repl_params['repl_enabled'] = True
+            body = json.dumps(repl_params)
+            LOG.debug('create replication params : %s', body)
+            repl_resp = self.handle.invoke_command(
+                FreeNASServer.CREATE_COMMAND, self.requests.replications_url,
+                body)
+            if repl_resp['status'] != FreeNASServer.STATUS_OK:
+                msg = ('Error while creating replication: %s' %
+                       repl_resp['response'])
+                raise FreeNASApiError('Unexpected error', msg)
+        self.take_replication_snapshot(share_name)
+
+    def delete_replication(self, share_name, target, replica_name):
+        """Stop replicating a share to a replica."""
+        task = self.get_replication(share_name, target, replica_name)
+        if task is None:
+            return
+        repl_resp = self.handle.invoke_command(
+            FreeNASServer.DELETE_COMMAND,
+            self.requests.replication_url(task['id']), None)
+        if (repl_resp['status'] != FreeNASServer.STATUS_OK and
+                not self._is_not_found(repl_resp)):
+            msg = ('Error while deleting replication: %s' %
+                   repl_resp['response'])
+            raise FreeNASApiError('Unexpected error', msg)
+
+    def take_replication_snapshot(self, share_name):
+        """Snapshot a replicated share for the next incremental send."""
+        snap_name = utils.generate_replica_snapshot_name(time.time())
+        self._create_snapshot(self._get_share_dataset(share_name).name,
+                              snap_name)
+        return snap_name
+
+    def prune_replication_snapshots(self, share_name, received):
+        """Delete the replication snapshots older than epoch received.
+
+           The snapshot taken at received, the newest all replicas have,
+           is kept as the base of the next incremental send.
+        """
+        name = self._get_share_dataset(share_name).name
+        for snap_name in self.inventory.get_snapshot_names(name):
+            taken = utils.get_replica_snapshot_time(snap_name)
+            if taken is not None and taken < received:
+                self._delete_snapshot(name, snap_name)
 
-        self._create_nfs_share(clone_ds['mountpoint'])
-        path = self._get_share_path(clone_ds['name'])
-        return [self._get_location_path(path, share['share_proto'])]
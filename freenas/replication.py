@@ -0,0 +1,136 @@
+# Copyright (c) 2017 Agatti Software Labs. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import threading
+import time
+
+import eventlet
+from oslo_log import log as logging
+
+from manila.share.drivers.freenas.freenasapi import FreeNASApiError
+from manila.share.drivers.freenas import utils
+
+LOG = logging.getLogger(__name__)
+
+
+class FreeNASReplica(collections.namedtuple(
+        'FreeNASReplica', ['source', 'share_name', 'target',
+                           'replica_name'])):
+    """A replica of a share, with the request processors of both pools.
+
+    source holds the active replica share_name, target the replica.
+    """
+
+
+class FreeNASReplicator(object):
+    """Keeps share replicas in sync from one background green thread.
+
+    Every interval seconds each replicated share gets a new replication
+    snapshot, up to max_workers shares in parallel. The FreeNAS replication
+    task of each replica sends it incrementally from the newest snapshot
+    both sides have; older replication snapshots no replica needs anymore
+    are then deleted. The lag of each replica is kept for the stats.
+    """
+
+    def __init__(self, interval=300, max_workers=8):
+        self._interval = interval
+        self._max_workers = max_workers
+        self._replicas = {}
+        self._lag = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.last_sync = None
+
+    def track(self, replica):
+        """Keep a FreeNASReplica in sync, starting the thread if needed."""
+        with self._lock:
+            self._replicas[replica.replica_name] = replica
+            if self._interval and self._thread is None:
+                self._thread = eventlet.spawn(self._run)
+
+    def forget(self, replica_name):
+        with self._lock:
+            self._replicas.pop(replica_name, None)
+            self._lag.pop(replica_name, None)
+
+    def get_lag(self, replica_name):
+        """Seconds the replica is behind, None if it has no snapshot yet."""
+        return self._lag.get(replica_name)
+
+    def refresh(self, replica):
+        """Read the replication task of a replica and update its lag.
+
+        Returns the epoch time of the newest snapshot the replica received,
+        None if it has received none yet.
+        """
+        task = replica.source.get_replication(
+            replica.share_name, replica.target, replica.replica_name)
+        if task is None:
+            raise FreeNASApiError('Not found', 'No replication task for '
+                                  'replica %s' % replica.replica_name)
+        received = utils.get_replica_snapshot_time(
+            task.get('repl_lastsnapshot'))
+        lag = None if received is None else max(time.time() - received, 0)
+        with self._lock:
+            if replica.replica_name in self._replicas:
+                self._lag[replica.replica_name] = lag
+        return received
+
+    def _sync_share(self, source, share_name, replicas):
+        source.take_replication_snapshot(share_name)
+        received = [self.refresh(replica) for replica in replicas]
+        if None not in received:
+            source.prune_replication_snapshots(share_name, min(received))
+
+    def sync(self):
+        """Take the next replication snapshot of every replicated share.
+
+        Returns the number of shares that failed.
+        """
+        groups = collections.OrderedDict()
+        with self._lock:
+            replicas = list(self._replicas.values())
+        for replica in replicas:
+            groups.setdefault((replica.source, replica.share_name),
+                              []).append(replica)
+
+        def _sync(item):
+            (source, share_name), group = item
+            try:
+                self._sync_share(source, share_name, group)
+                return True
+            except Exception as e:
+                LOG.warning('Replication of share %(share)s failed: '
+                            '%(err)s', {'share': share_name, 'err': e})
+                return False
+
+        pool = eventlet.GreenPool(self._max_workers)
+        failed = sum(1 for ok in pool.imap(_sync, groups.items()) if not ok)
+        self.last_sync = time.time()
+        return failed
+
+    def _run(self):
+        while True:
+            eventlet.sleep(self._interval)
+            try:
+                self.sync()
+            except Exception:
+                LOG.exception('FreeNAS replication round failed.')
+
+    def get_stats(self):
+        """Lag in seconds of each replica, keyed by replica share name."""
+        with self._lock:
+            return {'last_sync': self.last_sync,
+                    'lag': dict(self._lag)}
@@ -0,0 +1,86 @@
+# Copyright (c) 2017 Agatti Software Labs. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+
+from manila.share.drivers.freenas.freenasapi import FreeNASServer
+from manila.share.drivers.freenas import utils
+
+# Dataset of a share: name under the pool, NFS mountpoint and REST URL.
+FreeNASDatasetId = collections.namedtuple('FreeNASDatasetId',
+                                          ['name', 'mountpoint', 'url'])
+
+
+class FreeNASRequestBuilder(object):
+    """REST URLs and share identities of one pool.
+
+    The URL prefixes of the pool are built once, requests only append the
+    dataset, snapshot or export to them. The dataset identities of shares
+    and the FreeNAS names of snapshots are memoized in bounded LRU caches
+    keyed by the manila share and snapshot names, which carry their IDs.
+    """
+
+    def __init__(self, pool, mount_path, cache_size=4096):
+        self.pool = pool
+        self.mount_path = mount_path
+        self.volume_url = '%s/%s/' % (FreeNASServer.REST_API_VOLUME, pool)
+        self.datasets_url = '%s%s/' % (self.volume_url,
+                                       FreeNASServer.DATASET)
+        self.nfs_shares_url = '%s/' % FreeNASServer.REST_API_SHARE
+        self.snapshots_url = '%s/' % FreeNASServer.REST_API_SNAPSHOT
+        self.replications_url = '%s/' % FreeNASServer.REST_API_REPLICATION
+        self._snapshot_prefix = '%s%s/' % (self.snapshots_url, pool)
+        self._mount_prefix = mount_path + '/'
+        self._datasets = utils.LRUCache(cache_size)
+        self._shares = utils.LRUCache(cache_size)
+        self._snapshots = utils.LRUCache(cache_size)
+
+    def _make_dataset(self, name):
+        return FreeNASDatasetId(name, self._mount_prefix + name,
+                                self.datasets_url + name + '/')
+
+    def get_dataset(self, name):
+        """FreeNASDatasetId of a dataset directly under the pool."""
+        return self._datasets.get(name, self._make_dataset)
+
+    def get_share(self, share_name):
+        """FreeNASDatasetId of the generated dataset of a share."""
+        return self._shares.get(share_name, lambda key: self._make_dataset(
+            utils.generate_share_name(key, self.mount_path)['name']))
+
+    def get_snapshot_name(self, snapshot_name):
+        """FreeNAS name of a manila snapshot."""
+        return self._snapshots.get(snapshot_name,
+                                   utils.generate_snapshot_name)
+
+    def dataset_url(self, name):
+        return self.datasets_url + name + '/'
+
+    def nfs_share_url(self, nfs_id):
+        return '%s%s/' % (self.nfs_shares_url, nfs_id)
+
+    def snapshot_url(self, dataset_name, snap_name, action=None):
+        """URL of a snapshot, or of an action (clone, rollback) on it."""
+        url = self._snapshot_prefix + dataset_name + '@' + snap_name + '/'
+        if action:
+            url += action + '/'
+        return url
+
+    def snapshot_range_url(self, dataset_name, first, last):
+        """URL of the snapshots from first to last, ZFS first%last."""
+        return '%s%s@%s%%25%s/' % (self._snapshot_prefix, dataset_name,
+                                   first, last)
+
+    def replication_url(self, task_id):
+        return '%s%s/' % (self.replications_url, task_id)
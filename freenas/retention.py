@@ -0,0 +1,68 @@
+# Copyright (c) 2017 Agatti Software Labs. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+
+class FreeNASRetentionPolicy(object):
+    """Picks the snapshots of a dataset that have expired.
+
+    keep_last keeps the newest snapshots, keep_daily and keep_weekly the
+    newest snapshot of each of that many most recent days (UTC) and ISO
+    weeks that have snapshots. A snapshot is kept if any rule keeps it.
+    Snapshots of unknown age are always kept, and a policy without rules
+    keeps everything.
+    """
+
+    def __init__(self, keep_last=0, keep_daily=0, keep_weekly=0):
+        self.keep_last = keep_last
+        self.keep_daily = keep_daily
+        self.keep_weekly = keep_weekly
+
+    @property
+    def enabled(self):
+        return bool(self.keep_last or self.keep_daily or self.keep_weekly)
+
+    @staticmethod
+    def _keep_newest_per(snapshots, count, bucket):
+        kept = set()
+        buckets = set()
+        for name, taken in snapshots:
+            key = bucket(datetime.datetime.utcfromtimestamp(taken))
+            if key in buckets:
+                continue
+            if len(buckets) == count:
+                break
+            buckets.add(key)
+            kept.add(name)
+        return kept
+
+    def get_expired(self, snapshots):
+        """Names of the expired snapshots, oldest first.
+
+        snapshots is a list of (name, epoch time taken or None).
+        """
+        if not self.enabled:
+            return []
+        dated = sorted(((name, taken) for name, taken in snapshots
+                        if taken is not None),
+                       key=lambda snapshot: snapshot[1], reverse=True)
+        kept = set(name for name, _taken in dated[:self.keep_last])
+        kept |= self._keep_newest_per(dated, self.keep_daily,
+                                      lambda when: when.date())
+        kept |= self._keep_newest_per(
+            dated, self.keep_weekly,
+            lambda when: when.isocalendar()[:2])
+        return [name for name, _taken in reversed(dated)
+                if name not in kept]
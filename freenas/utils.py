@@ -12,21 +12,214 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import calendar
+import collections
+import re
+import threading
+import time
+
+import simplejson as json
+
+SHARE_PREFIX = 'agtshare-'
+SNAPSHOT_PREFIX = 'agtsnap-'
+# Comments of a managed dataset, followed by the manila share name.
+MANAGED_PREFIX = 'manila-share:'
+# Replication snapshots, followed by the epoch time they were taken at.
+REPLICA_SNAPSHOT_PREFIX = 'agtrepl-'
+# FreeNAS periodic snapshots, e.g. auto-20170904.1200-2w.
+PERIODIC_SNAPSHOT_RE = re.compile(r'^auto-(\d{8}\.\d{4})')
+GB = 1024 * 1024 * 1024
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': GB, 'T': 1024 * GB,
+              'P': 1024 ** 2 * GB}
+
 
 # Helper utility module for freenas manila driver.
+class LazyJSON(object):
+    """Serializes obj to JSON only when a log record is actually emitted."""
+
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj)
+
+
+class LRUCache(object):
+    """Bounded memo dropping the least recently used entry when full."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, create):
+        """Cached value of key, computed with create(key) on a miss."""
+        with self._lock:
+            value = self._entries.pop(key, self)
+            if value is not self:
+                self._entries[key] = value
+                return value
+        value = create(key)
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def iter_json_list(read, chunk_size=65536):
+    """Decode a JSON list from read(size) and yield its items one by one.
+
+    Only the item being decoded and about one chunk of input are held in
+    memory, however long the list is.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    in_list = False
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf) and not in_list:
+            if buf[pos] != '[':
+                raise ValueError('Expected a JSON list')
+            in_list = True
+            pos += 1
+            continue
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        if pos < len(buf):
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                end = None
+            # A number at the end of the buffer may continue in the next
+            # chunk.
+            if end is not None and (end < len(buf) or eof):
+                yield item
+                pos = end
+                continue
+        elif eof:
+            if in_list:
+                raise ValueError('Truncated JSON list')
+            return
+        # Grow the read size with the pending item so decoding a large item
+        # takes a logarithmic number of attempts.
+        chunk = read(max(chunk_size, len(buf) - pos))
+        buf = buf[pos:] + chunk
+        pos = 0
+        eof = not chunk
+
+
+def project(record, fields=None):
+    """Copy of record restricted to fields, record itself if fields is None."""
+    if fields is None:
+        return record
+    return dict((key, record[key]) for key in fields if key in record)
+
+
 def get_size_in_gb(size_in_bytes):
     "convert size in gbss"
     return size_in_bytes/(1024*1024*1024)
 
 
+def get_quota_in_gb(quota):
+    """Size in GB of a refquota given in bytes or as e.g. '10G'.
+
+    Unset ('none', 0 or missing) or unreadable quotas count as 0.
+    """
+    if isinstance(quota, dict):
+        quota = quota.get('rawvalue', quota.get('value'))
+    if not quota or quota == 'none':
+        return 0
+    quota = str(quota).strip().upper()
+    if quota.endswith('IB'):
+        quota = quota[:-2]
+    quota = quota.rstrip('B')
+    try:
+        if quota and quota[-1] in SIZE_UNITS:
+            return float(quota[:-1]) * SIZE_UNITS[quota[-1]] / GB
+        return float(quota) / GB
+    except ValueError:
+        return 0
+
+
+def get_volume_properties(volume):
+    """Collect zpool fragmentation, compressratio and dedupratio as floats.
+
+    Values may be reported as '12%' or '1.50x', or as a property dict with
+    a 'value' key. Properties missing from the volume are left out.
+    """
+    props = {}
+    for key in ('fragmentation', 'compressratio', 'dedupratio'):
+        value = volume.get(key)
+        if isinstance(value, dict):
+            value = value.get('value')
+        try:
+            props[key] = float(str(value).rstrip('%x'))
+        except ValueError:
+            pass
+    return props
+
+
 def generate_share_name(name, mntpoint):
     """Create FreeNAS volume / share name mapping"""
-    backend_share = 'agtshare-' + name.split('-')[1]
+    backend_share = SHARE_PREFIX + name.split('-')[1]
     backend_mntpnt = mntpoint + "/" + backend_share
     return {'name': backend_share, 'mountpoint': backend_mntpnt}
 
 
+def generate_replica_snapshot_name(now):
+    """Create the name of a replication snapshot taken at epoch now."""
+    return '%s%d' % (REPLICA_SNAPSHOT_PREFIX, now)
+
+
+def get_replica_snapshot_time(snapshot):
+    """Epoch time of a replication snapshot given as name or full name.
+
+    Returns None for other snapshots or an empty value.
+    """
+    name = (snapshot or '').rpartition('@')[2]
+    if not name.startswith(REPLICA_SNAPSHOT_PREFIX):
+        return None
+    try:
+        return int(name[len(REPLICA_SNAPSHOT_PREFIX):])
+    except ValueError:
+        return None
+
+
+def get_snapshot_time(snapshot):
+    """Epoch time a snapshot listing record was taken at.
+
+    Uses the creation property when listed, else the time in the names of
+    replication and FreeNAS periodic snapshots. Returns None if unknown.
+    """
+    creation = snapshot.get('creation')
+    if isinstance(creation, dict):
+        creation = creation.get('rawvalue', creation.get('value'))
+    try:
+        return int(creation)
+    except (TypeError, ValueError):
+        pass
+    name = snapshot.get('name') or ''
+    taken = get_replica_snapshot_time(name)
+    if taken is not None:
+        return taken
+    match = PERIODIC_SNAPSHOT_RE.match(name)
+    if match:
+        return calendar.timegm(time.strptime(match.group(1), '%Y%m%d.%H%M'))
+    return None
+
+
 def generate_snapshot_name(name):
     """Create FREENAS snapshot name. """
-    snap_name = 'agtsnap-' + name.split('-')[2]
+    snap_name = SNAPSHOT_PREFIX + name.split('-')[2]
     return snap_name
@@ -0,0 +1,325 @@
+# Copyright (c) 2017 Agatti Software Labs. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Throughput and latency benchmark of the FreeNAS driver hot paths.
+
+Drives a real FreeNasDriver, transport and JSON handling included, against
+the local REST stand-in in fake_freenas.py (or any appliance given with
+--server) and prints one JSON document with ops/sec and p50/p99 latency
+per operation and concurrency level:
+
+    python -m manila.tests.share.drivers.freenas.benchmark \\
+        --concurrency 1 8 32 --ops 200 --latency 0.005 --output run.json
+
+Pass --baseline with the output of an earlier run to get the relative
+change of ops/sec and p99 latency against it. --micro instead times the
+CPU cost of building one share request, ad-hoc versus with the request
+builder, without any I/O.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+import uuid
+
+import eventlet
+from oslo_config import cfg
+
+from manila.share import configuration
+from manila.share.drivers.freenas import driver
+from manila.share.drivers.freenas.freenasapi import FreeNASServer
+from manila.share.drivers.freenas.requestbuilder import FreeNASRequestBuilder
+from manila.share.drivers.freenas import utils
+from manila.tests.share.drivers.freenas import fake_freenas
+
+CONF = cfg.CONF
+
+OPERATIONS = ('create_share', 'extend_share', 'create_snapshot',
+              'create_share_from_snapshot', 'delete_snapshot',
+              'delete_share', 'update_share_stats')
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return 0.0
+    rank = max(int(round(pct / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def summarize(operation, concurrency, latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {'operation': operation,
+            'concurrency': concurrency,
+            'ops': count,
+            'errors': errors,
+            'elapsed': elapsed,
+            'ops_per_sec': count / elapsed if elapsed else 0.0,
+            'mean': sum(latencies) / count if count else 0.0,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else 0.0}
+
+
+def compare(results, baseline):
+    """Relative change of ops/sec and p99 against a baseline run."""
+    previous = dict(((r['operation'], r['concurrency']), r)
+                    for r in baseline['results'])
+    deltas = []
+    for result in results:
+        old = previous.get((result['operation'], result['concurrency']))
+        if not old:
+            continue
+        deltas.append({
+            'operation': result['operation'],
+            'concurrency': result['concurrency'],
+            'ops_per_sec': (result['ops_per_sec'] / old['ops_per_sec'] - 1
+                            if old['ops_per_sec'] else None),
+            'p99': result['p99'] / old['p99'] - 1 if old['p99'] else None})
+    return deltas
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_driver(server, args):
+    config = configuration.Configuration(None)
+    # freenasapi connects to the host name, which may carry the port.
+    config.freenas_server_hostname = server
+    config.freenas_login = 'root'
+    config.freenas_password = 'password'
+    config.freenas_dataset = args.pool
+    config.freenas_api_pool_size = max(args.concurrency)
+    config.freenas_max_workers = max(args.concurrency)
+    config.freenas_api_max_retries = args.max_retries
+    config.freenas_stats_cache_ttl = args.stats_cache_ttl
+    # Read the appliance on each stats update instead of in the background.
+    config.freenas_stats_refresh_interval = 0
+    config.share_backend_name = 'benchmark'
+    CONF.set_default('driver_handles_share_servers', False)
+    bench_driver = driver.FreeNasDriver(configuration=config)
+    bench_driver.do_setup(None)
+    bench_driver.check_for_setup_error()
+    return bench_driver
+
+
+class Workload(object):
+    """Shares and snapshots flowing through the benchmark phases."""
+
+    def __init__(self, bench_driver, count):
+        self.driver = bench_driver
+        self.shares = []
+        for _ in range(count):
+            share_id = uuid.uuid4().hex
+            self.shares.append({'id': share_id, 'share_id': share_id,
+                                'name': 'share-%s' % share_id, 'size': 1,
+                                'share_proto': 'NFS'})
+        self.snapshots = [{'share': share, 'share_name': share['name'],
+                           'name': 'share-snap-%s' % share['id']}
+                          for share in self.shares]
+        self.clones = []
+        for share in self.shares:
+            clone_id = uuid.uuid4().hex
+            self.clones.append({'id': clone_id, 'share_id': clone_id,
+                                'name': 'share-%s' % clone_id, 'size': 1,
+                                'share_proto': 'NFS'})
+
+    def items(self, operation):
+        """Returns (callable, args) for every call of an operation."""
+        drv = self.driver
+        if operation == 'create_share':
+            return [(drv.create_share, (None, s)) for s in self.shares]
+        if operation == 'extend_share':
+            return [(drv.extend_share, (s, 2)) for s in self.shares]
+        if operation == 'create_snapshot':
+            return [(drv.create_snapshot, (None, s)) for s in self.snapshots]
+        if operation == 'create_share_from_snapshot':
+            return [(drv.create_share_from_snapshot, (None, c, s))
+                    for c, s in zip(self.clones, self.snapshots)]
+        if operation == 'delete_snapshot':
+            return [(drv.delete_snapshot, (None, s)) for s in self.snapshots]
+        if operation == 'delete_share':
+            return [(drv.delete_share, (None, s))
+                    for s in self.shares + self.clones]
+        if operation == 'update_share_stats':
+            return [(drv._update_share_stats, ())] * len(self.shares)
+        raise ValueError('Unknown operation %s' % operation)
+
+
+def run_phase(operation, items, concurrency):
+    def _timed(item):
+        func, args = item
+        start = time.time()
+        try:
+            func(*args)
+            failed = False
+        except Exception:
+            failed = True
+        return time.time() - start, failed
+
+    pool = eventlet.GreenPool(concurrency)
+    start = time.time()
+    outcomes = list(pool.imap(_timed, items))
+    elapsed = time.time() - start
+    return summarize(operation, concurrency,
+                     [latency for latency, _ in outcomes],
+                     sum(1 for _, failed in outcomes if failed), elapsed)
+
+
+def _build_request_adhoc(share_name, pool, mount_path):
+    # How process_req built a request before the request builder.
+    params = utils.generate_share_name(share_name, mount_path)
+    params['refquota'] = '2G'
+    url = '%s/%s/%s/%s/' % (FreeNASServer.REST_API_VOLUME, pool,
+                            FreeNASServer.DATASET, params['name'])
+    body = json.dumps(params)
+    # The debug log serialized the payload again.
+    json.dumps(params)
+    return url, body
+
+
+def _build_request(share_name, builder):
+    dataset = builder.get_share(share_name)
+    body = json.dumps({'name': dataset.name,
+                       'mountpoint': dataset.mountpoint,
+                       'refquota': '2G'})
+    return dataset.url, body
+
+
+def run_micro(args):
+    """Microseconds per request built, over args.ops distinct shares."""
+    pool = args.pool
+    mount_path = '/mnt/' + pool
+    names = ['share-%s' % uuid.uuid4().hex for _ in range(args.ops)]
+    builder = FreeNASRequestBuilder(pool, mount_path)
+    rounds = max(args.micro_iterations // len(names), 1)
+    timings = {}
+    for label, build in (
+            ('adhoc', lambda name: _build_request_adhoc(name, pool,
+                                                        mount_path)),
+            ('builder', lambda name: _build_request(name, builder))):
+        start = time.time()
+        for _ in range(rounds):
+            for name in names:
+                build(name)
+        timings[label] = (time.time() - start) * 1e6 / (rounds * len(names))
+    return {'request_building': {
+        'requests': rounds * len(names),
+        'adhoc_us': timings['adhoc'],
+        'builder_us': timings['builder'],
+        'speedup': (timings['adhoc'] / timings['builder']
+                    if timings['builder'] else None)}}
+
+
+def run(args):
+    server = args.server
+    stand_in = None
+    if not server:
+        state = fake_freenas.FakeFreeNASState(
+            pool=args.pool, latency=args.latency, jitter=args.jitter,
+            error_rate=args.error_rate, error_code=args.error_code)
+        stand_in = fake_freenas.FakeFreeNASServer(state)
+        stand_in.start()
+        server = stand_in.address
+    try:
+        bench_driver = make_driver(server, args)
+        results = []
+        for concurrency in args.concurrency:
+            workload = Workload(bench_driver, args.ops)
+            for operation in args.operations:
+                results.append(run_phase(operation,
+                                         workload.items(operation),
+                                         concurrency))
+        api_stats = bench_driver.helper.get_api_stats()
+    finally:
+        if stand_in:
+            stand_in.shutdown()
+            stand_in.server_close()
+    return {'revision': _git_revision(),
+            'timestamp': time.time(),
+            'python': sys.version.split()[0],
+            'parameters': {'server': args.server or 'stand-in',
+                           'ops': args.ops,
+                           'concurrency': args.concurrency,
+                           'latency': args.latency,
+                           'jitter': args.jitter,
+                           'error_rate': args.error_rate,
+                           'error_code': args.error_code,
+                           'max_retries': args.max_retries,
+                           'stats_cache_ttl': args.stats_cache_ttl},
+            'results': results,
+            'api_stats': api_stats}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server',
+                        help='host:port of a FreeNAS appliance or stand-in; '
+                             'by default one is started in process.')
+    parser.add_argument('--pool', default='agattivol')
+    parser.add_argument('--ops', type=int, default=100,
+                        help='Calls per operation and concurrency level.')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 8, 32])
+    parser.add_argument('--operations', nargs='+', default=OPERATIONS,
+                        choices=OPERATIONS)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Stand-in delay per request in seconds.')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='Stand-in maximum extra random delay.')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of stand-in requests that fail.')
+    parser.add_argument('--error-code', type=int, default=503)
+    parser.add_argument('--max-retries', type=int, default=3)
+    parser.add_argument('--stats-cache-ttl', type=int, default=0,
+                        help='freenas_stats_cache_ttl used for the run.')
+    parser.add_argument('--micro', action='store_true',
+                        help='Time request building only, --ops is the '
+                             'number of distinct shares.')
+    parser.add_argument('--micro-iterations', type=int, default=100000,
+                        help='Requests built per variant with --micro.')
+    parser.add_argument('--baseline',
+                        help='JSON output of an earlier run to compare to.')
+    parser.add_argument('--output', help='File to write the JSON to.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    eventlet.monkey_patch()
+    args = parse_args(argv)
+    if args.micro:
+        print(json.dumps(run_micro(args), indent=2, sort_keys=True))
+        return
+    report = run(args)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['baseline'] = compare(report['results'], json.load(f))
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
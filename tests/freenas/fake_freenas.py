@@ -0,0 +1,280 @@
+# Copyright (c) 2017 Agatti Software Labs. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Local stand-in for the FreeNAS v1.0 REST API.
+
+Emulates the endpoints used by freenasapi.py with an in-memory pool,
+datasets, NFS shares and snapshots. Every request can be delayed and a
+share of requests can be failed, to measure the driver against a slow or
+flaky appliance. Run it standalone with:
+
+    python fake_freenas.py --port 8000 --latency 0.005 --error-rate 0.01
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import random
+import SocketServer
+import threading
+import time
+import urlparse
+
+GB = 1024 * 1024 * 1024
+
+
+class FakeFreeNASState(object):
+    """In-memory appliance state and request router."""
+
+    def __init__(self, pool='agattivol', size_gb=10240, latency=0,
+                 jitter=0, error_rate=0, error_code=503):
+        self.pool = pool
+        self.size = size_gb * GB
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.datasets = {}
+        self.nfs_shares = {}
+        self.snapshots = {}
+        self.requests = 0
+        self.errors = 0
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def _used(self):
+        return sum(ds['used'] for ds in self.datasets.values())
+
+    def _dataset(self, name, quota='0'):
+        return {'name': name,
+                'mountpoint': '/mnt/%s/%s' % (self.pool, name),
+                'refquota': quota,
+                'used': GB,
+                'refer': GB,
+                'avail': self.size}
+
+    def handle(self, method, path, body=None):
+        """Returns (http status, response document) for one request."""
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        with self._lock:
+            self.requests += 1
+            if self.error_rate and random.random() < self.error_rate:
+                self.errors += 1
+                return self.error_code, {'error': 'injected failure'}
+            try:
+                params = json.loads(body) if body else {}
+            except ValueError:
+                return 400, {'error': 'invalid JSON'}
+            url = urlparse.urlparse(path)
+            parts = [p for p in url.path.split('/') if p]
+            # Drop the 'api/<version>' prefix.
+            if parts[:1] == ['api']:
+                parts = parts[2:]
+            status, doc = self._route(method, parts, params)
+            if isinstance(doc, list):
+                doc = self._page(doc, urlparse.parse_qs(url.query))
+            return status, doc
+
+    @staticmethod
+    def _page(records, query):
+        """Apply limit/offset, limit=0 returns everything."""
+        records = sorted(records, key=lambda record: (
+            record.get('id'), record.get('name')))
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', ['0'])[0])
+        return records[offset:offset + limit if limit else None]
+
+    def _route(self, method, parts, params):
+        if parts[:2] == ['storage', 'volume']:
+            return self._volume(method, parts[2:], params)
+        if parts[:2] == ['sharing', 'nfs']:
+            return self._nfs(method, parts[2:], params)
+        if parts[:2] == ['storage', 'snapshot']:
+            return self._snapshot(method, parts[2:], params)
+        return 404, {'error': 'unknown endpoint'}
+
+    def _volume(self, method, parts, params):
+        if not parts or parts[0] != self.pool:
+            return 404, {'error': 'no such volume'}
+        if len(parts) == 1 and method == 'GET':
+            used = self._used()
+            return 200, {'name': self.pool, 'used': used,
+                         'avail': self.size - used}
+        if len(parts) == 2 and parts[1] == 'datasets':
+            if method == 'GET':
+                return 200, [dict(ds, name='%s/%s' % (self.pool, name))
+                             for name, ds in self.datasets.items()]
+            if method == 'POST':
+                name = params.get('name')
+                if not name or name in self.datasets:
+                    return 409, {'error': 'dataset exists'}
+                self.datasets[name] = self._dataset(
+                    name, params.get('refquota', '0'))
+                return 201, self.datasets[name]
+        if len(parts) == 3 and parts[1] == 'datasets':
+            dataset = self.datasets.get(parts[2])
+            if dataset is None:
+                return 404, {'error': 'no such dataset'}
+            if method == 'DELETE':
+                del self.datasets[parts[2]]
+                self.snapshots.pop(parts[2], None)
+                return 204, None
+            if method == 'GET':
+                return 200, dataset
+            if method == 'PUT':
+                quota = params.get('refquota', dataset['refquota'])
+                # Like ZFS, refuse a refquota below the referenced size.
+                if (str(quota).endswith('G') and
+                        float(quota[:-1]) * GB < dataset['refer']):
+                    return 400, {'error': 'size is less than current used'}
+                dataset.update(params)
+                return 200, dataset
+        return 405, {'error': 'method not allowed'}
+
+    def _nfs(self, method, parts, params):
+        if not parts:
+            if method == 'GET':
+                return 200, list(self.nfs_shares.values())
+            if method == 'POST':
+                nfs_share = {'id': self._next_id,
+                             'nfs_paths': params.get('nfs_paths', []),
+                             'nfs_hosts': params.get('nfs_hosts', ''),
+                             'nfs_network': params.get('nfs_network', ''),
+                             'nfs_ro': params.get('nfs_ro', False)}
+                self.nfs_shares[self._next_id] = nfs_share
+                self._next_id += 1
+                return 201, nfs_share
+        elif method == 'DELETE':
+            if self.nfs_shares.pop(int(parts[0]), None) is None:
+                return 404, {'error': 'no such NFS share'}
+            return 204, None
+        elif method == 'PUT':
+            nfs_share = self.nfs_shares.get(int(parts[0]))
+            if nfs_share is None:
+                return 404, {'error': 'no such NFS share'}
+            nfs_share.update(params)
+            return 200, nfs_share
+        return 405, {'error': 'method not allowed'}
+
+    def _snapshot(self, method, parts, params):
+        if not parts:
+            if method == 'GET':
+                return 200, [snap for snaps in self.snapshots.values()
+                             for snap in snaps.values()]
+            if method == 'POST':
+                name = params.get('name')
+                dataset = params.get('dataset', '').split('/')[-1]
+                if dataset not in self.datasets:
+                    return 404, {'error': 'no such dataset'}
+                snap = {'name': name,
+                        'filesystem': '%s/%s' % (self.pool, dataset),
+                        'fullname': '%s/%s@%s' % (self.pool, dataset, name),
+                        'creation': int(time.time()),
+                        'used': 0}
+                self.snapshots.setdefault(dataset, {})[name] = snap
+                return 201, snap
+            return 405, {'error': 'method not allowed'}
+        # <pool>/<dataset>@<snapshot>[/clone|/rollback]
+        if len(parts) < 2 or '@' not in parts[1]:
+            return 404, {'error': 'no such snapshot'}
+        dataset, name = parts[1].split('@', 1)
+        snap = self.snapshots.get(dataset, {}).get(name)
+        if snap is None:
+            return 404, {'error': 'no such snapshot'}
+        if parts[2:] == ['clone'] and method == 'POST':
+            clone = params.get('name', '').split('/')[-1]
+            if not clone or clone in self.datasets:
+                return 409, {'error': 'dataset exists'}
+            self.datasets[clone] = self._dataset(clone)
+            return 202, self.datasets[clone]
+        if parts[2:] == ['rollback'] and method == 'POST':
+            return 202, None
+        if not parts[2:] and method == 'DELETE':
+            del self.snapshots[dataset][name]
+            return 204, None
+        return 405, {'error': 'method not allowed'}
+
+
+class FakeFreeNASHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """HTTP/1.1 keep-alive front end of FakeFreeNASState."""
+
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write; header by header writes stall on
+    # Nagle and delayed ACKs for ~40ms per keep-alive request.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def _dispatch(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        status, doc = self.server.state.handle(self.command, self.path, body)
+        payload = json.dumps(doc) if doc is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeFreeNASServer(SocketServer.ThreadingMixIn,
+                        BaseHTTPServer.HTTPServer):
+    """Threaded stand-in appliance, port 0 picks a free port."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, state, host='127.0.0.1', port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port),
+                                           FakeFreeNASHandler)
+        self.state = state
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address
+
+    def start(self):
+        """Serve on a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--pool', default='agattivol')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds every request is delayed.')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='Maximum random extra delay in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of requests answered with an error.')
+    parser.add_argument('--error-code', type=int, default=503)
+    args = parser.parse_args()
+    state = FakeFreeNASState(pool=args.pool, latency=args.latency,
+                             jitter=args.jitter, error_rate=args.error_rate,
+                             error_code=args.error_code)
+    FakeFreeNASServer(state, args.host, args.port).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# Copyright (c) 2017 Agatti Software Labs. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+
+from manila.share.drivers.freenas.asyncapi import FreeNASAsyncServer
+from manila.share.drivers.freenas.asyncapi import FreeNASJob
+from manila.share.drivers.freenas.asyncapi import FreeNASJobTracker
+from manila.share.drivers.freenas.freenasapi import FreeNASApiError
+from manila.share.drivers.freenas.freenasapi import FreeNASServer
+from manila import test
+from mock import MagicMock
+from mock import patch
+
+
+class TestFreeNASAsyncServer(test.TestCase):
+
+    def setUp(self):
+        super(TestFreeNASAsyncServer, self).setUp()
+        FreeNASAsyncServer._host_limits.clear()
+        self.server = FreeNASServer('1.1.1.1', 80, username='user',
+                                    password='password')
+        self.client = FreeNASAsyncServer(self.server, max_concurrency=2)
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_submit(self, mock_rest_cmd):
+        mock_rest_cmd.return_value = {'status': 'ok'}
+
+        future = self.client.delete('/storage/snapshot/testvol@snap/')
+
+        self.assertEqual({'status': 'ok'}, future.wait())
+        self.assertTrue(future.done())
+        mock_rest_cmd.assert_called_once_with(
+            FreeNASServer.DELETE_COMMAND, '/storage/snapshot/testvol@snap/',
+            None)
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_per_host_concurrency_limit(self, mock_rest_cmd):
+        running = []
+        peak = []
+
+        def _invoke(*args):
+            running.append(1)
+            peak.append(len(running))
+            eventlet.sleep(0.01)
+            running.pop()
+            return {'status': 'ok'}
+        mock_rest_cmd.side_effect = _invoke
+        other = FreeNASAsyncServer(self.server, max_concurrency=2)
+
+        futures = [client.select('/storage/volume/testvol/')
+                   for client in (self.client, other) * 4]
+        FreeNASAsyncServer.wait_all(futures)
+
+        self.assertEqual(2, max(peak))
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_host_limit_is_smallest_max_concurrency(self, mock_rest_cmd):
+        running = []
+        peak = []
+
+        def _invoke(*args):
+            running.append(1)
+            peak.append(len(running))
+            eventlet.sleep(0.01)
+            running.pop()
+            return {'status': 'ok'}
+        mock_rest_cmd.side_effect = _invoke
+        FreeNASAsyncServer._host_limits.clear()
+        wide = FreeNASAsyncServer(self.server, max_concurrency=10)
+        narrow = FreeNASAsyncServer(self.server, max_concurrency=2)
+
+        self.assertIs(wide._limit, narrow._limit)
+        futures = [client.select('/storage/volume/testvol/')
+                   for client in (wide, narrow) * 4]
+        FreeNASAsyncServer.wait_all(futures)
+
+        self.assertEqual(2, max(peak))
+        self.assertEqual(2, wide._limit.balance)
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_submit_timeout(self, mock_rest_cmd):
+        mock_rest_cmd.side_effect = lambda *args: eventlet.sleep(1)
+
+        future = self.client.select('/storage/volume/testvol/', timeout=0.01)
+
+        self.assertRaises(FreeNASApiError, future.wait)
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_cancel(self, mock_rest_cmd):
+        mock_rest_cmd.side_effect = lambda *args: eventlet.sleep(1)
+
+        future = self.client.select('/storage/volume/testvol/')
+        eventlet.sleep(0)
+
+        self.assertTrue(future.cancel())
+        self.assertTrue(future.cancelled())
+        self.assertRaises(FreeNASApiError, future.wait)
+
+    @patch.object(FreeNASServer, 'iter_command')
+    def test_paginate(self, mock_iter_cmd):
+        records = list(range(7))
+
+        def _page(request, fields):
+            query = dict(arg.split('=') for arg in
+                         request.split('?')[1].split('&'))
+            offset, limit = int(query['offset']), int(query['limit'])
+            return iter(records[offset:offset + limit])
+        mock_iter_cmd.side_effect = _page
+
+        result = list(self.client.paginate('/sharing/nfs/', 3, ('id',)))
+
+        self.assertEqual(records, result)
+        mock_iter_cmd.assert_called_with(
+            '/sharing/nfs/?limit=3&offset=6', ('id',))
+        self.assertEqual(3, mock_iter_cmd.call_count)
+
+
+class TestFreeNASJobTracker(test.TestCase):
+
+    def setUp(self):
+        super(TestFreeNASJobTracker, self).setUp()
+        self.tracker = FreeNASJobTracker(min_interval=0.01,
+                                         max_interval=0.02)
+
+    def _future(self, done, result=None, error=None):
+        future = MagicMock()
+        future.done.return_value = done
+        future.wait.return_value = result
+        future.wait.side_effect = error
+        return future
+
+    @patch.object(eventlet, 'spawn')
+    def test_poll(self, mock_spawn):
+        running = self.tracker.track('share-1', 'deleting',
+                                     self._future(False))
+        done = self.tracker.track('share-2', 'creating',
+                                  self._future(True, result=['loc']))
+        failed = self.tracker.track(
+            'share-3', 'creating',
+            self._future(True, error=FreeNASApiError('Unexpected error')))
+
+        self.assertEqual(2, self.tracker.poll())
+
+        self.assertEqual(1, mock_spawn.call_count)
+        self.assertEqual(FreeNASJob.RUNNING, running.state)
+        self.assertEqual(FreeNASJob.DONE, done.state)
+        self.assertEqual(['loc'], done.result)
+        self.assertEqual(FreeNASJob.FAILED, failed.state)
+        self.assertEqual([running], self.tracker.running())
+
+    def test_poller_follows_job_to_completion(self):
+        client = FreeNASAsyncServer(FreeNASServer('1.1.1.1', 80))
+        job = self.tracker.track('share-1', 'deleting',
+                                 client.spawn(eventlet.sleep, 0.05))
+
+        eventlet.sleep(0.2)
+
+        self.assertEqual(FreeNASJob.DONE, job.state)
+        self.assertIsNone(self.tracker._poller)
@@ -0,0 +1,118 @@
+# Copyright (c) 2017 Agatti Software Labs. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+
+from manila import test
+from manila.tests.share.drivers.freenas import benchmark
+from manila.tests.share.drivers.freenas.fake_freenas import FakeFreeNASState
+
+
+class TestFakeFreeNASState(test.TestCase):
+
+    def setUp(self):
+        super(TestFakeFreeNASState, self).setUp()
+        self.state = FakeFreeNASState(pool='agattivol')
+
+    def test_share_lifecycle(self):
+        status, _ = self.state.handle(
+            'POST', '/api/v1.0/storage/volume/agattivol/datasets/',
+            json.dumps({'name': 'agtshare-1', 'refquota': '1G'}))
+        self.assertEqual(201, status)
+        status, nfs_share = self.state.handle(
+            'POST', '/api/v1.0/sharing/nfs/',
+            json.dumps({'nfs_paths': ['/mnt/agattivol/agtshare-1']}))
+        self.assertEqual(201, status)
+        status, _ = self.state.handle(
+            'POST', '/api/v1.0/storage/snapshot/',
+            json.dumps({'dataset': 'agattivol/agtshare-1',
+                        'name': 'agtsnap-1'}))
+        self.assertEqual(201, status)
+        status, _ = self.state.handle(
+            'POST',
+            '/api/v1.0/storage/snapshot/agattivol/agtshare-1@agtsnap-1/'
+            'clone/', json.dumps({'name': 'agattivol/agtshare-2'}))
+        self.assertEqual(202, status)
+
+        status, datasets = self.state.handle(
+            'GET', '/api/v1.0/storage/volume/agattivol/datasets/?limit=0')
+        self.assertEqual(['agattivol/agtshare-1', 'agattivol/agtshare-2'],
+                         sorted(ds['name'] for ds in datasets))
+        status, _ = self.state.handle(
+            'DELETE', '/api/v1.0/sharing/nfs/%s/' % nfs_share['id'])
+        self.assertEqual(204, status)
+        status, _ = self.state.handle(
+            'DELETE', '/api/v1.0/storage/volume/agattivol/datasets/'
+            'agtshare-3/')
+        self.assertEqual(404, status)
+
+    def test_refquota_update(self):
+        self.state.handle(
+            'POST', '/api/v1.0/storage/volume/agattivol/datasets/',
+            json.dumps({'name': 'agtshare-1', 'refquota': '4G'}))
+        url = '/api/v1.0/storage/volume/agattivol/datasets/agtshare-1/'
+
+        status, dataset = self.state.handle(
+            'PUT', url, json.dumps({'refquota': '2G'}))
+        self.assertEqual(200, status)
+        self.assertEqual('2G', dataset['refquota'])
+        # One GB is referenced, ZFS refuses to go below it.
+        status, _ = self.state.handle('PUT', url,
+                                      json.dumps({'refquota': '0.5G'}))
+        self.assertEqual(400, status)
+
+    def test_error_injection(self):
+        self.state.error_rate = 1
+
+        status, _ = self.state.handle('GET',
+                                      '/api/v1.0/storage/volume/agattivol')
+
+        self.assertEqual(503, status)
+        self.assertEqual(1, self.state.errors)
+
+
+class TestBenchmark(test.TestCase):
+
+    def test_summarize(self):
+        result = benchmark.summarize('create_share', 4,
+                                     [0.1 * i for i in range(1, 101)], 2, 5)
+
+        self.assertEqual(100, result['ops'])
+        self.assertEqual(20, result['ops_per_sec'])
+        self.assertAlmostEqual(5.0, result['p50'])
+        self.assertAlmostEqual(9.9, result['p99'])
+        self.assertEqual(2, result['errors'])
+
+    def test_compare(self):
+        baseline = {'results': [{'operation': 'delete_share',
+                                 'concurrency': 8, 'ops_per_sec': 100.0,
+                                 'p99': 0.2}]}
+        results = [{'operation': 'delete_share', 'concurrency': 8,
+                    'ops_per_sec': 150.0, 'p99': 0.1}]
+
+        delta = benchmark.compare(results, baseline)[0]
+
+        self.assertAlmostEqual(0.5, delta['ops_per_sec'])
+        self.assertAlmostEqual(-0.5, delta['p99'])
+
+    def test_run_micro(self):
+        args = benchmark.parse_args(['--micro', '--ops', '10',
+                                     '--micro-iterations', '2000'])
+
+        result = benchmark.run_micro(args)['request_building']
+
+        self.assertEqual(2000, result['requests'])
+        self.assertTrue(result['builder_us'] > 0)
+        # Repeated shares are served from the builder caches.
+        self.assertTrue(result['builder_us'] <= result['adhoc_us'])
@@ -14,16 +14,25 @@
 #    under the License.
 
 import ddt
+import eventlet
 import json
+import time
 from oslo_config import cfg
 
+from manila.common import constants
 from manila import context
 from manila import exception
 from manila.share import configuration
 from manila.share.drivers.freenas import driver
 from manila.share.drivers.freenas.freenasapi import FreeNASApiError
+from manila.share.drivers.freenas.freenasapi import FreeNASDataset
+from manila.share.drivers.freenas.freenasapi import FreeNASNFSShare
+from manila.share.drivers.freenas.freenasapi import FreeNASScheduler
 from manila.share.drivers.freenas.freenasapi import FreeNASServer
+from manila.share.drivers.freenas.inventory import FreeNASInventory
 from manila.share.drivers.freenas.process_req import FreeNASProcessRequests
+from manila.share.drivers.freenas.retention import FreeNASRetentionPolicy
+from manila.share.drivers.freenas import utils
 from manila import test
 from mock import patch
 from mock import PropertyMock
@@ -42,7 +51,9 @@ test_config.freenas_dataset = 'testvol'
 test_config.freenas_dataset_compression = 'on'
 test_config.freenas_dataset_dedupe = 'on'
 test_config.freenas_thin_provisioning = False
+test_config.freenas_stats_refresh_interval = 0
 test_config.share_backend_name = 'AgattiL'
+test_config.freenas_replication_interval = 0
 FAKE_SHARE_NAME = 'agtshare-1234'
 FAKE_SNAPSHOT_NAME = 'agtsnap-1234'
 
@@ -88,7 +99,8 @@ class TestFreeNasDriver(test.TestCase):
     @patch.object(FreeNASServer, 'invoke_command')
     def test_check_setup_error__volume_does_not_exist(self, mock_rest_cmd):
         test_config.freenas_dataset = 'agattivol'
-        mock_rest_cmd.return_value = {'response': json.dumps({'name': 'adsfsdf'})}
+        mock_rest_cmd.return_value = {'status': 'ok',
+                                      'body': {'name': 'adsfsdf'}}
         self.assertRaises(
             FreeNASApiError, self._driver.check_for_setup_error)
 
@@ -111,6 +123,62 @@ class TestFreeNasDriver(test.TestCase):
         self.assertEqual([location],
                          self._driver.create_share(self._ctx, share))
 
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_create_share_dataset_properties(self, mock_rest_cmd):
+        share = {'name': 'share-1234-4567-78787', 'size': 1,
+                 'share_proto': test_config.freenas_storage_protocol}
+        mock_rest_cmd.return_value = {'status': 'ok'}
+        self._driver.helper.dataset_compression = 'lz4'
+        self._driver.helper.dataset_dedupe = 'off'
+
+        self._driver.create_share(self._ctx, share)
+
+        command, request, params = mock_rest_cmd.call_args_list[0][0]
+        self.assertEqual(self._driver.helper.requests.datasets_url, request)
+        self.assertEqual('lz4', json.loads(params)['compression'])
+        self.assertEqual('off', json.loads(params)['dedup'])
+
+    @patch.object(FreeNASServer, 'iter_command')
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_reconcile_keeps_provisioned_capacity(self, mock_rest_cmd,
+                                                  mock_iter_cmd):
+        helper = self._driver.helper
+        pool = test_config.freenas_dataset
+        listed = {}
+
+        def _invoke(command, request, params, priority=None):
+            # Keep the datasets and refquotas the appliance would list.
+            body = json.loads(params or '{}')
+            if request == helper.requests.datasets_url:
+                listed[body['name']] = {'name': '%s/%s' % (pool,
+                                                           body['name']),
+                                        'refquota': body['refquota']}
+            elif command == FreeNASServer.UPDATE_COMMAND:
+                name = request.rstrip('/').rsplit('/', 1)[-1]
+                listed.setdefault(name, {'name': '%s/%s' % (pool, name)})
+                listed[name].update(body)
+            return {'status': 'ok'}
+        mock_rest_cmd.side_effect = _invoke
+        mock_iter_cmd.side_effect = (
+            lambda request, fields=None, priority=None:
+            iter(listed.values() if request.startswith(
+                FreeNASServer.REST_API_VOLUME) else []))
+        share = {'id': 'id-1', 'name': 'share-1234-4567', 'size': 1,
+                 'share_proto': test_config.freenas_storage_protocol}
+        clone = {'id': 'id-2', 'name': 'share-5678-4567', 'size': 2,
+                 'share_proto': test_config.freenas_storage_protocol}
+        snapshot = {'share': share, 'share_name': share['name'],
+                    'name': 'share-snap-1234-4567'}
+
+        self._driver.create_share(self._ctx, share)
+        self._driver.create_share_from_snapshot(self._ctx, clone, snapshot)
+        self.assertEqual(3, helper.inventory.provisioned_gb)
+        helper.inventory.reconcile()
+
+        self.assertEqual(['agtshare-1234', 'agtshare-5678'],
+                         sorted(helper.inventory.datasets))
+        self.assertEqual(3, helper.inventory.provisioned_gb)
+
     @patch.object(FreeNASServer, 'invoke_command')
     def test_create_share_wrong_proto(self, mock_rest_cmd):
 
@@ -171,22 +239,17 @@ class TestFreeNasDriver(test.TestCase):
             'share_proto': test_config.freenas_storage_protocol
         }
         new_size = 4
-        extend_params = {}
-        extend_params['name'] = FAKE_SHARE_NAME
-        extend_params['mountpoint'] = (test_config.freenas_mount_point_base
-                                       + "/" + test_config.freenas_dataset
-                                       + "/" + FAKE_SHARE_NAME)
-        extend_params['refquote'] = '%sG' % new_size
-
-        extend_req = ('%s/%s/%s/%s') % (FreeNASServer.REST_API_VOLUME,
-                                        test_config.freenas_dataset,
-                                        FreeNASServer.DATASET,
-                                        FAKE_SHARE_NAME)
+        extend_params = {'refquota': '%sG' % new_size}
+
+        extend_req = ('%s/%s/%s/%s/') % (FreeNASServer.REST_API_VOLUME,
+                                         test_config.freenas_dataset,
+                                         FreeNASServer.DATASET,
+                                         FAKE_SHARE_NAME)
 
         mock_rest_cmd.return_value = {'status': 'ok'}
         self._driver.extend_share(share, new_size)
 
-        mock_rest_cmd.assert_called_with(FreeNASServer.CREATE_COMMAND,
+        mock_rest_cmd.assert_called_with(FreeNASServer.UPDATE_COMMAND,
                                          extend_req, json.dumps(extend_params))
 
     @patch.object(FreeNASServer, 'invoke_command')
@@ -207,6 +270,67 @@ class TestFreeNasDriver(test.TestCase):
                           self._driver.extend_share,
                           share, new_size)
 
+    def _shrink_share(self, name='share-1234-4567-78787'):
+        return {'id': 'id-' + name, 'name': name, 'size': 4,
+                'share_proto': test_config.freenas_storage_protocol}
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_shrink_share(self, mock_rest_cmd):
+        mock_rest_cmd.return_value = {'status': 'ok',
+                                      'body': {'used': 5 * utils.GB,
+                                               'refer': 2 * utils.GB}}
+
+        self._driver.shrink_share(self._shrink_share(), 3)
+
+        self.assertEqual(2, mock_rest_cmd.call_count)
+        command, request, params = mock_rest_cmd.call_args[0]
+        self.assertEqual(FreeNASServer.UPDATE_COMMAND, command)
+        self.assertEqual({'refquota': '3G'}, json.loads(params))
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_shrink_share_below_usage(self, mock_rest_cmd):
+        mock_rest_cmd.return_value = {'status': 'ok',
+                                      'body': {'refer': 2 * utils.GB}}
+
+        self.assertRaises(exception.ShareShrinkingPossibleDataLoss,
+                          self._driver.shrink_share,
+                          self._shrink_share(), 1)
+        self.assertEqual(1, mock_rest_cmd.call_count)
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_shrink_share_refused_by_appliance(self, mock_rest_cmd):
+        mock_rest_cmd.side_effect = [
+            {'status': 'ok', 'body': {'refer': 2 * utils.GB}},
+            {'status': 'error', 'response': 'size is less than used'},
+            {'status': 'ok', 'body': {'refer': 4 * utils.GB}}]
+
+        self.assertRaises(exception.ShareShrinkingPossibleDataLoss,
+                          self._driver.shrink_share,
+                          self._shrink_share(), 3)
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    @patch.object(FreeNASProcessRequests, '_paginate')
+    def test_shrink_shares(self, mock_paginate, mock_rest_cmd):
+        dataset = self._driver.helper.dataset
+        mock_paginate.return_value = iter([
+            {'name': '%s/agtshare-1' % dataset, 'refer': 2.5 * utils.GB},
+            {'name': '%s/agtshare-2' % dataset, 'refer': 2 * utils.GB}])
+        mock_rest_cmd.return_value = {'status': 'ok'}
+        shrinks = [{'id': 'id-1', 'share': self._shrink_share('share-1')},
+                   {'id': 'id-2', 'share': self._shrink_share('share-2'),
+                    'new_size': 1},
+                   {'id': 'id-3', 'share': self._shrink_share('share-3'),
+                    'new_size': 1}]
+
+        result = self._driver.shrink_shares(self._ctx, shrinks)
+
+        self.assertEqual({'size': 3}, result['id-1'])
+        self.assertIn('error', result['id-2'])
+        self.assertIn('error', result['id-3'])
+        # Usage comes from the listing, only share 1 is updated.
+        self.assertEqual(1, mock_paginate.call_count)
+        self.assertEqual(1, mock_rest_cmd.call_count)
+
     @patch.object(FreeNASServer, 'invoke_command')
     def test_create_snapshot(self, mock_rest_cmd):
 
@@ -336,10 +460,14 @@ class TestFreeNasDriver(test.TestCase):
                           self._driver.create_share_from_snapshot,
                           self._ctx, share, snapshot)
 
+    @patch.object(FreeNASServer, 'get_stats')
     @patch.object(FreeNASProcessRequests, '_get_volume_stat')
     @patch('manila.share.driver.ShareDriver._update_share_stats')
-    def test_update_share_stats(self, super_stats, mock_stats):
+    def test_update_share_stats(self, super_stats, mock_stats,
+                                mock_api_stats):
         mock_stats.return_value = (200, 150, 50)
+        mock_api_stats.return_value = {'requests': {}, 'pool': {},
+                                       'retries': {}}
         stats = {
             'vendor_name': 'FreeNAS',
             'storage_protocol': test_config.freenas_storage_protocol,
@@ -350,16 +478,769 @@ class TestFreeNasDriver(test.TestCase):
                 'pool_name': test_config.freenas_dataset,
                 'total_capacity_gb': 200,
                 'free_capacity_gb': 150,
+                'used_capacity_gb': 50,
                 'snapshot_support': True,
                 'create_share_from_snapshot_support': True,
+                'revert_to_snapshot_support': True,
                 'reserved_percentage':
                     test_config.reserved_share_percentage,
                 'compression': True,
                 'dedupe': True,
                 'thin_provisioning': test_config.freenas_thin_provisioning,
+                'stats_age': 0,
             }],
+            'freenas_api_stats': {
+                test_config.freenas_server_hostname: {
+                    'requests': {}, 'pool': {}, 'retries': {}}},
+            'freenas_replication': {'last_sync': None, 'lag': {}},
+            'freenas_snapshot_retention': {
+                test_config.freenas_dataset: {
+                    'runs': 0, 'last_run': None, 'deleted': 0, 'failed': 0,
+                    'range_deletes': 0, 'reclaimed_bytes': 0}},
         }
 
         self._driver._update_share_stats()
 
         self.assertEqual(stats, self._driver._stats)
+
+    @patch.object(FreeNASProcessRequests, 'update_share_stats')
+    @patch('manila.share.driver.ShareDriver._update_share_stats')
+    def test_update_share_stats_serves_last_good_stats(self, super_stats,
+                                                       mock_stats):
+        pool_name = test_config.freenas_dataset
+        mock_stats.return_value = {'pools': [{'pool_name': pool_name}]}
+        self._driver._update_share_stats()
+        read_at, stats = self._driver._pool_stats[pool_name]
+        self._driver._pool_stats[pool_name] = (read_at - 30, stats)
+
+        mock_stats.side_effect = FreeNASApiError('Unexpected error', 'slow')
+        self._driver._update_share_stats()
+
+        self.assertEqual([{'pool_name': pool_name, 'stats_age': 30}],
+                         self._driver._stats['pools'])
+
+    @patch.object(FreeNASProcessRequests, 'update_share_stats')
+    def test_read_pool_stats_timeout(self, mock_stats):
+        mock_stats.side_effect = lambda: eventlet.sleep(1)
+
+        with patch.object(test_config, 'freenas_stats_timeout', 0.01,
+                          create=True):
+            self.assertRaises(FreeNASApiError,
+                              self._driver._read_pool_stats,
+                              self._driver.helper)
+
+    @patch.object(FreeNASInventory, 'reconcile')
+    @patch.object(FreeNASProcessRequests, '_get_volume_stat')
+    def test_inventory_sync_outside_stats_deadline(self, mock_stats,
+                                                   mock_reconcile):
+        mock_stats.return_value = (200, 150, 50)
+        mock_reconcile.side_effect = lambda: eventlet.sleep(0.05)
+        helper = self._driver.helper
+        helper._inventory_active = True
+        helper.inventory.last_sync = 0
+
+        with patch.object(test_config, 'freenas_stats_timeout', 0.01,
+                          create=True):
+            stats = self._driver._read_pool_stats(helper)
+            self._driver._read_pool_stats(helper)
+            eventlet.sleep(0.1)
+            # The reconcile did not advance last_sync, it is not retried
+            # before the next interval.
+            self._driver._read_pool_stats(helper)
+
+        self.assertEqual(200, stats['pools'][0]['total_capacity_gb'])
+        self.assertEqual(1, mock_reconcile.call_count)
+
+    @patch.object(FreeNASProcessRequests, '_get_volume_stat')
+    def test_update_share_stats_provisioned_capacity(self, mock_stats):
+        mock_stats.return_value = (200, 150, 50)
+        helper = self._driver.helper
+        helper.inventory.loaded = True
+        helper.inventory.add_dataset(FAKE_SHARE_NAME, size=3)
+
+        pool = helper.update_share_stats()['pools'][0]
+
+        self.assertEqual(3, pool['provisioned_capacity_gb'])
+        self.assertEqual(test_config.max_over_subscription_ratio,
+                         pool['max_over_subscription_ratio'])
+
+    def _create_multi_pool_driver(self):
+        with patch.object(test_config, 'freenas_pools',
+                          ['pool2', '2.2.2.2:pool3'], create=True):
+            multi_driver = driver.FreeNasDriver(configuration=test_config)
+        multi_driver.do_setup(self._ctx)
+        return multi_driver
+
+    @patch.object(FreeNASProcessRequests, '_get_volume_stat', autospec=True)
+    @patch('manila.share.driver.ShareDriver._update_share_stats')
+    def test_update_share_stats_multiple_pools(self, super_stats,
+                                               mock_stats):
+        multi_driver = self._create_multi_pool_driver()
+
+        def _volume_stat(helper):
+            if helper.dataset == 'pool3':
+                raise FreeNASApiError('Unexpected error', 'unreachable')
+            return {'pool2': (100, 80, 20)}.get(helper.dataset,
+                                                (200, 150, 50))
+        mock_stats.side_effect = _volume_stat
+
+        multi_driver._update_share_stats()
+
+        pools = multi_driver._stats['pools']
+        self.assertEqual([test_config.freenas_dataset, 'pool2'],
+                         [pool['pool_name'] for pool in pools])
+        self.assertEqual([200, 100],
+                         [pool['total_capacity_gb'] for pool in pools])
+        self.assertEqual(['dr', 'dr'],
+                         [pool['replication_type'] for pool in pools])
+        self.assertIs(multi_driver.helper.handle,
+                      multi_driver.helpers['pool2'].handle)
+        self.assertIsNot(multi_driver.helper.handle,
+                         multi_driver.helpers['2.2.2.2:pool3'].handle)
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_delete_share_routed_to_pool(self, mock_rest_cmd):
+        multi_driver = self._create_multi_pool_driver()
+        share = {
+            'name': 'share-1234-4567-78787',
+            'size': 1,
+            'host': 'manila@freenas#2.2.2.2:pool3',
+            'share_id': 'share-1234-4567-78787',
+            'share_proto': test_config.freenas_storage_protocol
+        }
+        mock_rest_cmd.return_value = {'status': 'ok'}
+
+        multi_driver.delete_share(self._ctx, share)
+
+        mock_rest_cmd.assert_called_with(
+            FreeNASServer.DELETE_COMMAND,
+            '%s/pool3/%s/%s/' % (FreeNASServer.REST_API_VOLUME,
+                                 FreeNASServer.DATASET, FAKE_SHARE_NAME),
+            None)
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_get_volume_stat_is_cached(self, mock_rest_cmd):
+        gb = 1024 * 1024 * 1024
+        mock_rest_cmd.return_value = {'status': 'ok',
+                                      'body': {'avail': 150 * gb,
+                                               'used': 50 * gb}}
+
+        helper = self._driver.helper
+        self.assertEqual((200, 150, 50), helper._get_volume_stat())
+        self.assertEqual((200, 150, 50), helper._get_volume_stat())
+        self.assertEqual(1, mock_rest_cmd.call_count)
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_get_volume_stat_invalidated_by_delete_share(self, mock_rest_cmd):
+        gb = 1024 * 1024 * 1024
+        share = {
+            'name': 'share-1234-4567-78787',
+            'size': 1,
+            'share_id': 'share-1234-4567-78787',
+            'share_proto': test_config.freenas_storage_protocol
+        }
+        mock_rest_cmd.return_value = {'status': 'ok',
+                                      'body': {'avail': 150 * gb,
+                                               'used': 50 * gb}}
+
+        self._driver.helper._get_volume_stat()
+        self._driver.delete_share(self._ctx, share)
+        self._driver.helper._get_volume_stat()
+
+        self.assertEqual(3, mock_rest_cmd.call_count)
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_create_shares(self, mock_rest_cmd):
+        shares = [{
+            'id': 'id-%d' % i,
+            'name': 'share-%d-4567-78787' % i,
+            'size': 1,
+            'share_id': 'share-%d-4567-78787' % i,
+            'share_proto': test_config.freenas_storage_protocol
+        } for i in range(3)]
+        shares[2]['share_proto'] = 'INVALID_PROTOCOL'
+
+        def _invoke(command, request, params):
+            if 'agtshare-1' in (params or ''):
+                return {'status': 'error', 'response': 'dataset exists'}
+            return {'status': 'ok'}
+        mock_rest_cmd.side_effect = _invoke
+
+        result = self._driver.create_shares(self._ctx, shares)
+
+        location = {
+            "path": '%s:%s/%s/%s' % (test_config.freenas_server_hostname,
+                                     test_config.freenas_mount_point_base,
+                                     test_config.freenas_dataset,
+                                     'agtshare-0')
+        }
+        self.assertEqual({'export_locations': [location]}, result['id-0'])
+        self.assertIn('error', result['id-1'])
+        self.assertIn('error', result['id-2'])
+        # Dataset for share 0, failed dataset for share 1.
+        self.assertEqual(2, mock_rest_cmd.call_count)
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_create_snapshots(self, mock_rest_cmd):
+        snapshots = [{
+            'id': 'snap-id-%d' % i,
+            'share': {'name': 'share-%d-4567-78787' % i},
+            'share_name': 'share-%d-4567-78787' % i,
+            'name': 'share-snap-%d-4567' % i
+        } for i in range(3)]
+
+        def _invoke(command, request, params):
+            if 'agtshare-1' in params:
+                return {'status': 'error', 'response': 'dataset busy'}
+            return {'status': 'ok'}
+        mock_rest_cmd.side_effect = _invoke
+
+        result = self._driver.create_snapshots(self._ctx, snapshots)
+
+        self.assertEqual(
+            {'provider_location': '%s/%s/agtshare-0@agtsnap-0' % (
+                test_config.freenas_mount_point_base,
+                test_config.freenas_dataset)},
+            result['snap-id-0'])
+        self.assertIn('error', result['snap-id-1'])
+        self.assertIn('provider_location', result['snap-id-2'])
+        self.assertEqual(3, mock_rest_cmd.call_count)
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_create_share_from_snapshot_async(self, mock_rest_cmd):
+        share = {
+            'id': 'share-id',
+            'name': 'share-1234-4567-78787',
+            'size': 1,
+            'share_id': 'share-1234-4567-78787',
+            'share_proto': test_config.freenas_storage_protocol
+        }
+        snapshot = {'share': share, 'share_name': 'share-1234-4567-78787',
+                    'name': 'share-snap-1234-4567'}
+        location = {'path': '%s:%s' % (test_config.freenas_server_hostname,
+                                       self._get_share_path())}
+        mock_rest_cmd.return_value = {'status': 'ok'}
+
+        with patch.object(test_config, 'freenas_async_operations', True,
+                          create=True):
+            self.assertEqual(
+                {'status': 'creating_from_snapshot'},
+                self._driver.create_share_from_snapshot(self._ctx, share,
+                                                        snapshot))
+        self.assertEqual({'status': 'creating_from_snapshot'},
+                         self._driver.get_share_status(share))
+
+        self._driver.jobs.get('share-id').future.wait()
+        self._driver.jobs.poll()
+
+        self.assertEqual({'status': 'available',
+                          'export_locations': [location]},
+                         self._driver.get_share_status(share))
+        self.assertIsNone(self._driver.jobs.get('share-id'))
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_get_share_status_without_job(self, mock_rest_cmd):
+        share = {'id': 'share-id', 'name': 'share-1234-4567-78787',
+                 'size': 2,
+                 'share_proto': test_config.freenas_storage_protocol}
+        location = {'path': '%s:%s' % (test_config.freenas_server_hostname,
+                                       self._get_share_path())}
+        mock_rest_cmd.return_value = {
+            'status': 'ok',
+            'body': {'name': 'testvol/%s' % FAKE_SHARE_NAME,
+                     'refquota': None}}
+
+        self.assertEqual({'status': 'available',
+                          'export_locations': [location]},
+                         self._driver.get_share_status(share))
+
+        # The clone missed its refquota before the restart.
+        ds_url = self._driver.helper.requests.dataset_url(FAKE_SHARE_NAME)
+        mock_rest_cmd.assert_called_with(FreeNASServer.UPDATE_COMMAND,
+                                         ds_url,
+                                         json.dumps({'refquota': '2G'}))
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_get_share_status_without_dataset(self, mock_rest_cmd):
+        share = {'id': 'share-id', 'name': 'share-1234-4567-78787',
+                 'size': 1,
+                 'share_proto': test_config.freenas_storage_protocol}
+        mock_rest_cmd.return_value = {'status': 'error', 'code': 404,
+                                      'response': 'not found'}
+
+        self.assertEqual({'status': 'error'},
+                         self._driver.get_share_status(share))
+
+    @patch.object(FreeNASServer, 'iter_command')
+    def test_list_datasets_and_snapshots(self, mock_iter_cmd):
+        pool = test_config.freenas_dataset
+        listings = {
+            FreeNASServer.REST_API_VOLUME: [
+                {'name': pool},
+                {'name': '%s/agtshare-1' % pool, 'refquota': '1G'},
+                {'name': '%s/agtshare-1/child' % pool},
+                {'name': '%s/other' % pool}],
+            FreeNASServer.REST_API_SNAPSHOT: [
+                {'name': 'agtsnap-1', 'filesystem': '%s/agtshare-1' % pool},
+                {'name': 'manual', 'filesystem': '%s/agtshare-1' % pool},
+                {'name': 'agtsnap-2', 'filesystem': 'othervol/agtshare-2'}],
+        }
+
+        def _iter(request, fields):
+            for endpoint, body in listings.items():
+                if request.startswith(endpoint):
+                    return iter(body)
+        mock_iter_cmd.side_effect = _iter
+        helper = self._driver.helper
+
+        self.assertEqual(
+            [('agtshare-1', None, '1G')], list(helper.list_datasets()))
+        self.assertEqual(['agtshare-1', 'other'],
+                         [ds.name for ds in helper.list_datasets(None)])
+        self.assertEqual([('agtshare-1', 'agtsnap-1')],
+                         list(helper.list_snapshots()))
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    @patch.object(FreeNASProcessRequests, 'list_nfs_shares')
+    @patch.object(FreeNASProcessRequests, 'list_datasets')
+    def test_ensure_shares(self, mock_datasets, mock_nfs, mock_rest_cmd):
+        mount_path = '%s/%s' % (test_config.freenas_mount_point_base,
+                                test_config.freenas_dataset)
+        mock_datasets.return_value = iter([
+            FreeNASDataset('agtshare-1', None, None),
+            FreeNASDataset('agtshare-2', None, None)])
+        mock_nfs.return_value = iter([
+            FreeNASNFSShare(3, ['%s/agtshare-1' % mount_path])])
+        mock_rest_cmd.return_value = {'status': 'ok'}
+        shares = [{'id': 'id-%d' % i, 'name': 'share-%d-4567' % i,
+                   'share_proto': test_config.freenas_storage_protocol}
+                  for i in range(1, 4)]
+
+        result = self._driver.ensure_shares(self._ctx, shares)
+
+        self.assertEqual(
+            [{'path': '%s:%s/agtshare-1' % (
+                test_config.freenas_server_hostname, mount_path)}],
+            result['id-1']['export_locations'])
+        self.assertFalse(result['id-1']['reapply_access_rules'])
+        # Share 2 has no export, its rules are applied again.
+        self.assertTrue(result['id-2']['reapply_access_rules'])
+        self.assertEqual({'status': 'error'}, result['id-3'])
+        self.assertFalse(mock_rest_cmd.called)
+
+    @patch.object(FreeNASProcessRequests, '_paginate')
+    def test_ensure_shares_managed(self, mock_paginate):
+        helper = self._driver.helper
+        mount_path = '%s/%s' % (test_config.freenas_mount_point_base,
+                                test_config.freenas_dataset)
+        helper.inventory.add_dataset(
+            'legacy', {'name': 'legacy',
+                       'comments': utils.MANAGED_PREFIX + 'share-1-4567'})
+        listings = {
+            helper.requests.datasets_url: [
+                {'name': '%s/legacy' % test_config.freenas_dataset}],
+            helper.requests.nfs_shares_url: [
+                {'id': 3, 'nfs_paths': ['%s/legacy' % mount_path]}]}
+        mock_paginate.side_effect = lambda url, fields: iter(listings[url])
+        shares = [{'id': 'id-1', 'name': 'share-1-4567',
+                   'share_proto': test_config.freenas_storage_protocol}]
+
+        result = self._driver.ensure_shares(self._ctx, shares)
+
+        self.assertEqual(
+            [{'path': '%s:%s/legacy' % (
+                test_config.freenas_server_hostname, mount_path)}],
+            result['id-1']['export_locations'])
+        # The export of the managed dataset is found.
+        self.assertFalse(result['id-1']['reapply_access_rules'])
+
+    def _access_rule(self, access_to, access_level='rw',
+                     access_type='ip'):
+        return {'access_id': 'access-%s' % access_to,
+                'access_type': access_type, 'access_to': access_to,
+                'access_level': access_level}
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_update_access_exports_share_with_first_rule(self,
+                                                         mock_rest_cmd):
+        share = {'name': 'share-1234-4567-78787'}
+        rules = [self._access_rule('10.0.0.5'),
+                 self._access_rule('10.1.0.0/16')]
+        mock_rest_cmd.return_value = {'status': 'ok', 'body': {'id': 4}}
+
+        self._driver.update_access(self._ctx, share, rules, rules, [])
+
+        command, request, params = mock_rest_cmd.call_args[0]
+        self.assertEqual(FreeNASServer.CREATE_COMMAND, command)
+        self.assertEqual({'nfs_paths': [self._get_share_path()],
+                          'nfs_hosts': '10.0.0.5',
+                          'nfs_network': '10.1.0.0/16',
+                          'nfs_ro': False}, json.loads(params))
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_update_access_sends_changed_fields(self, mock_rest_cmd):
+        share = {'name': 'share-1234-4567-78787'}
+        self._driver.helper.inventory.add_nfs_share(
+            self._get_share_path(),
+            {'id': 4, 'nfs_hosts': '10.0.0.5 10.0.0.6',
+             'nfs_network': '10.1.0.0/16', 'nfs_ro': False})
+        rules = [self._access_rule('10.0.0.5'),
+                 self._access_rule('10.0.0.7'),
+                 self._access_rule('10.1.0.0/16')]
+        mock_rest_cmd.return_value = {'status': 'ok'}
+
+        self._driver.update_access(self._ctx, share, rules,
+                                   [self._access_rule('10.0.0.7')],
+                                   [self._access_rule('10.0.0.6')])
+
+        mock_rest_cmd.assert_called_once_with(
+            FreeNASServer.UPDATE_COMMAND,
+            '%s/4/' % FreeNASServer.REST_API_SHARE,
+            json.dumps({'nfs_hosts': '10.0.0.5 10.0.0.7'}))
+        self.assertEqual('10.0.0.5 10.0.0.7',
+                         self._driver.helper.inventory.get_nfs_share(
+                             self._get_share_path())['nfs_hosts'])
+
+        # Nothing changed, nothing is sent.
+        self._driver.update_access(self._ctx, share, rules, [], [])
+        self.assertEqual(1, mock_rest_cmd.call_count)
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_update_access_unexports_share_without_rules(self,
+                                                         mock_rest_cmd):
+        share = {'name': 'share-1234-4567-78787'}
+        self._driver.helper.inventory.add_nfs_share(
+            self._get_share_path(), {'id': 4, 'nfs_hosts': '10.0.0.5'})
+        mock_rest_cmd.return_value = {'status': 'ok'}
+
+        self._driver.update_access(self._ctx, share, [], [],
+                                   [self._access_rule('10.0.0.5')])
+
+        mock_rest_cmd.assert_called_once_with(
+            FreeNASServer.DELETE_COMMAND,
+            '%s/4/' % FreeNASServer.REST_API_SHARE, None)
+        self.assertIsNone(self._driver.helper.inventory.get_nfs_share_id(
+            self._get_share_path()))
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_update_access_invalid_rules(self, mock_rest_cmd):
+        share = {'name': 'share-1234-4567-78787'}
+        mixed = [self._access_rule('10.0.0.5'),
+                 self._access_rule('10.0.0.6', access_level='ro')]
+
+        self.assertRaises(exception.InvalidShareAccessLevel,
+                          self._driver.update_access, self._ctx, share,
+                          mixed, mixed, [])
+        self.assertFalse(mock_rest_cmd.called)
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_update_access_skips_unsupported_rules(self, mock_rest_cmd):
+        share = {'name': 'share-1234-4567-78787'}
+        rules = [self._access_rule('admin', access_type='user'),
+                 self._access_rule('10.0.0.500'),
+                 self._access_rule('10.0.0.5')]
+        mock_rest_cmd.return_value = {'status': 'ok', 'body': {'id': 4}}
+
+        result = self._driver.update_access(self._ctx, share, rules, rules,
+                                            [])
+
+        self.assertEqual({'access-admin': {'state': 'error'},
+                          'access-10.0.0.500': {'state': 'error'}}, result)
+        command, request, params = mock_rest_cmd.call_args[0]
+        self.assertEqual(FreeNASServer.CREATE_COMMAND, command)
+        self.assertEqual('10.0.0.5', json.loads(params)['nfs_hosts'])
+
+    @patch.object(FreeNASProcessRequests, 'update_access')
+    def test_resync_shares_access(self, mock_update_access):
+        mock_update_access.side_effect = [None, FreeNASApiError(503, 'down')]
+        updates = [{'id': 'id-%d' % i,
+                    'share': {'name': 'share-%d-4567' % i},
+                    'access_rules': [self._access_rule('10.0.0.%d' % i)]}
+                   for i in range(2)]
+
+        result = self._driver.resync_shares_access(self._ctx, updates)
+
+        self.assertEqual({}, result['id-0'])
+        self.assertIn('error', result['id-1'])
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_revert_to_snapshot(self, mock_rest_cmd):
+        snapshot = {'share': {'name': 'share-1234-4567-78787'},
+                    'share_name': 'share-1234-4567-78787',
+                    'name': 'share-snap-1234-4567'}
+        mock_rest_cmd.return_value = {'status': 'ok'}
+
+        with patch.object(FreeNASProcessRequests, '_list_snapshot_records',
+                          return_value={}):
+            self._driver.revert_to_snapshot(self._ctx, snapshot, [], [])
+
+        mock_rest_cmd.assert_called_once_with(
+            FreeNASServer.CREATE_COMMAND,
+            '%s/%s/%s@%s/rollback/' % (FreeNASServer.REST_API_SNAPSHOT,
+                                       test_config.freenas_dataset,
+                                       FAKE_SHARE_NAME, FAKE_SNAPSHOT_NAME),
+            '{}')
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_revert_to_snapshot_with_newer_snapshots(self, mock_rest_cmd):
+        snapshot = {'share': {'name': 'share-1234-4567-78787'},
+                    'share_name': 'share-1234-4567-78787',
+                    'name': 'share-snap-1234-4567'}
+        filesystem = '%s/%s' % (test_config.freenas_dataset, FAKE_SHARE_NAME)
+        records = {FAKE_SHARE_NAME: [
+            {'name': 'auto-20170101.0000-2w', 'filesystem': filesystem,
+             'creation': 100},
+            {'name': FAKE_SNAPSHOT_NAME, 'filesystem': filesystem,
+             'creation': 200},
+            {'name': 'auto-20170102.0000-2w', 'filesystem': filesystem,
+             'creation': 300}]}
+
+        with patch.object(FreeNASProcessRequests, '_list_snapshot_records',
+                          return_value=records):
+            error = self.assertRaises(exception.InvalidShareSnapshot,
+                                      self._driver.revert_to_snapshot,
+                                      self._ctx, snapshot, [], [])
+
+        self.assertIn('auto-20170102.0000-2w', error.msg)
+        self.assertNotIn('auto-20170101.0000-2w', error.msg)
+        self.assertFalse(mock_rest_cmd.called)
+
+    def _manage_share(self, path):
+        return {'name': 'share-5678-4567-78787',
+                'share_proto': test_config.freenas_storage_protocol,
+                'export_locations': [{'path': '%s:%s' % (
+                    test_config.freenas_server_hostname, path)}]}
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_manage_existing(self, mock_rest_cmd):
+        gb = 1024 * 1024 * 1024
+        path = '%s/%s/legacy' % (test_config.freenas_mount_point_base,
+                                 test_config.freenas_dataset)
+        share = self._manage_share(path)
+        mock_rest_cmd.side_effect = [
+            {'status': 'ok', 'body': {'name': 'testvol/legacy',
+                                      'refquota': None,
+                                      'used': 2.5 * gb}},
+            {'status': 'ok'}]
+
+        result = self._driver.manage_existing(share, {})
+
+        self.assertEqual(3, result['size'])
+        self.assertEqual([{'path': '%s:%s' % (
+            test_config.freenas_server_hostname, path)}],
+            result['export_locations'])
+        command, request, params = mock_rest_cmd.call_args[0]
+        self.assertEqual(FreeNASServer.UPDATE_COMMAND, command)
+        self.assertEqual({'comments': 'manila-share:share-5678-4567-78787',
+                          'refquota': '3G'}, json.loads(params))
+        # Later operations address the adopted dataset.
+        self.assertEqual(
+            'legacy', self._driver.helper._get_share_dataset(
+                share['name']).name)
+
+        mock_rest_cmd.side_effect = None
+        mock_rest_cmd.return_value = {'status': 'ok'}
+        self._driver.unmanage(share)
+        self.assertIsNone(
+            self._driver.helper.inventory.get_managed_dataset(share['name']))
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_manage_existing_invalid(self, mock_rest_cmd):
+        mock_rest_cmd.return_value = {'status': 'error', 'code': 404}
+
+        self.assertRaises(exception.ManageInvalidShare,
+                          self._driver.manage_existing,
+                          self._manage_share('/mnt/otherpool/legacy'), {})
+        self.assertFalse(mock_rest_cmd.called)
+        self.assertRaises(exception.ManageInvalidShare,
+                          self._driver.manage_existing,
+                          self._manage_share('/mnt/testvol/missing'), {})
+
+    def _replica_list(self):
+        host = 'host@backend#%s' % test_config.freenas_dataset
+        active = {'id': 'r1', 'name': 'share-1234-4567-78787',
+                  'host': host, 'share_proto': 'NFS',
+                  'replica_state': constants.REPLICA_STATE_ACTIVE}
+        replica = {'id': 'r2', 'name': 'share-5678-4567-78787',
+                   'host': host, 'share_proto': 'NFS',
+                   'replica_state': constants.REPLICA_STATE_OUT_OF_SYNC}
+        return [active, replica]
+
+    def _replication_task(self, lastsnapshot):
+        dataset = self._driver.helper.dataset
+        return {'id': 3,
+                'repl_filesystem': '%s/agtshare-1234' % dataset,
+                'repl_zfs': '%s/agtshare-5678' % dataset,
+                'repl_remote_hostname': test_config.freenas_server_hostname,
+                'repl_lastsnapshot': lastsnapshot}
+
+    @patch.object(FreeNASServer, 'iter_command')
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_create_replica(self, mock_rest_cmd, mock_iter):
+        mock_rest_cmd.return_value = {'status': 'ok'}
+        mock_iter.return_value = iter([])
+        replica_list = self._replica_list()
+
+        result = self._driver.create_replica(
+            self._ctx, replica_list, replica_list[1], [], [])
+
+        self.assertEqual(constants.REPLICA_STATE_OUT_OF_SYNC,
+                         result['replica_state'])
+        self.assertEqual([{'path': '%s:%s/%s/agtshare-5678' % (
+            test_config.freenas_server_hostname,
+            test_config.freenas_mount_point_base,
+            self._driver.helper.dataset)}], result['export_locations'])
+        (command, request, params), _kw = mock_rest_cmd.call_args_list[0]
+        self.assertEqual(FreeNASServer.CREATE_COMMAND, command)
+        self.assertEqual('%s/' % FreeNASServer.REST_API_REPLICATION, request)
+        self.assertEqual('%s/agtshare-5678' % self._driver.helper.dataset,
+                         json.loads(params)['repl_zfs'])
+        # The first replication snapshot is taken right away.
+        self.assertTrue(json.loads(mock_rest_cmd.call_args_list[1][0][2])[
+            'name'].startswith(utils.REPLICA_SNAPSHOT_PREFIX))
+
+    @ddt.data((60, constants.REPLICA_STATE_IN_SYNC),
+              (3600, constants.REPLICA_STATE_OUT_OF_SYNC),
+              (None, constants.REPLICA_STATE_OUT_OF_SYNC))
+    @ddt.unpack
+    @patch.object(FreeNASServer, 'iter_command')
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_update_replica_state(self, age, state, mock_rest_cmd,
+                                  mock_iter):
+        mock_rest_cmd.return_value = {'status': 'ok'}
+        lastsnapshot = ''
+        if age is not None:
+            lastsnapshot = utils.generate_replica_snapshot_name(
+                time.time() - age)
+        mock_iter.return_value = iter(
+            [self._replication_task(lastsnapshot)])
+        replica_list = self._replica_list()
+
+        self.assertEqual(state, self._driver.update_replica_state(
+            self._ctx, replica_list, replica_list[1], [], []))
+
+    @patch.object(FreeNASServer, 'iter_command')
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_update_replica_state_no_task(self, mock_rest_cmd, mock_iter):
+        mock_rest_cmd.return_value = {'status': 'ok'}
+        mock_iter.return_value = iter([])
+        replica_list = self._replica_list()
+
+        self.assertEqual(constants.STATUS_ERROR,
+                         self._driver.update_replica_state(
+                             self._ctx, replica_list, replica_list[1], [],
+                             []))
+
+    def _snapshot_records(self):
+        filesystem = '%s/agtshare-1' % self._driver.helper.dataset
+        return [
+            {'name': 'auto-20170901.1200-2w', 'filesystem': filesystem,
+             'creation': 1504267200, 'used': 3 * utils.GB},
+            {'name': 'auto-20170902.1200-2w', 'filesystem': filesystem,
+             'creation': 1504353600, 'used': utils.GB},
+            {'name': 'agtsnap-1', 'filesystem': filesystem,
+             'creation': 1504400000, 'used': 0},
+            {'name': 'auto-20170903.1200-2w', 'filesystem': filesystem,
+             'creation': 1504440000, 'used': utils.GB},
+            {'name': 'auto-20170904.1200-2w', 'filesystem': filesystem,
+             'creation': 1504526400, 'used': utils.GB},
+            {'name': 'auto-20170801.1200-2w',
+             'filesystem': filesystem + '/child', 'creation': 1501588800}]
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    @patch.object(FreeNASProcessRequests, '_get_retention_policy')
+    @patch.object(FreeNASProcessRequests, '_paginate')
+    def test_prune_snapshots_dry_run(self, mock_paginate, mock_policy,
+                                     mock_rest_cmd):
+        mock_paginate.return_value = iter(self._snapshot_records())
+        mock_policy.return_value = FreeNASRetentionPolicy(keep_last=1)
+
+        report = self._driver.prune_snapshots(
+            self._ctx, dry_run=True)[test_config.freenas_dataset]
+
+        dataset = self._driver.helper.dataset
+        self.assertEqual(['%s/agtshare-1@auto-201709%02d.1200-2w' % (
+            dataset, day) for day in (1, 2, 3)], report['expired'])
+        self.assertEqual(5 * utils.GB, report['reclaimed_bytes'])
+        self.assertEqual(0, report['deleted'])
+        self.assertFalse(mock_rest_cmd.called)
+
+    @patch.object(test_config, 'freenas_snapshot_range_delete', True,
+                  create=True)
+    @patch.object(FreeNASServer, 'invoke_command')
+    @patch.object(FreeNASProcessRequests, '_get_retention_policy')
+    @patch.object(FreeNASProcessRequests, '_paginate')
+    def test_prune_snapshots(self, mock_paginate, mock_policy,
+                             mock_rest_cmd):
+        mock_paginate.return_value = iter(self._snapshot_records())
+        mock_policy.return_value = FreeNASRetentionPolicy(keep_last=1)
+
+        def _invoke(command, request, params, priority=None):
+            # The appliance refuses range deletes.
+            if '%25' in request:
+                return {'status': 'error', 'code': 404}
+            return {'status': 'ok'}
+        mock_rest_cmd.side_effect = _invoke
+
+        report = self._driver.prune_snapshots(
+            self._ctx)[test_config.freenas_dataset]
+
+        self.assertEqual(3, report['deleted'])
+        self.assertEqual(0, report['failed'])
+        self.assertEqual(5 * utils.GB, report['reclaimed_bytes'])
+        requests = [call[0][1] for call in mock_rest_cmd.call_args_list]
+        # agtsnap-1 splits the expired snapshots in two runs, only the
+        # first can be a range.
+        self.assertEqual(1, len([req for req in requests if '%25' in req]))
+        self.assertEqual(4, len(requests))
+        self.assertEqual(
+            {FreeNASScheduler.BULK},
+            set(call[1]['priority'] for call in mock_rest_cmd.call_args_list))
+        stats = self._driver.helper.get_retention_stats()
+        self.assertEqual(1, stats['runs'])
+        self.assertEqual(3, stats['deleted'])
+        self.assertEqual(0, stats['range_deletes'])
+
+    def test_get_backend_info(self):
+        info = self._driver.get_backend_info(self._ctx)
+
+        self.assertEqual(info, self._driver.get_backend_info(self._ctx))
+        self.assertEqual(driver.VERSION, info['driver_version'])
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_delete_share_removes_nfs_share(self, mock_rest_cmd):
+        share = {
+            'name': 'share-1234-4567-78787',
+            'size': 1,
+            'share_id': 'share-1234-4567-78787',
+            'share_proto': test_config.freenas_storage_protocol
+        }
+        inventory = self._driver.helper.inventory
+        inventory.add_dataset(FAKE_SHARE_NAME)
+        inventory.add_nfs_share(self._get_share_path(), {'id': 12})
+        mock_rest_cmd.return_value = {'status': 'ok'}
+
+        self._driver.delete_share(self._ctx, share)
+
+        mock_rest_cmd.assert_any_call(FreeNASServer.DELETE_COMMAND,
+                                      '%s/12/' % FreeNASServer.REST_API_SHARE,
+                                      None)
+        self.assertFalse(inventory.has_dataset(FAKE_SHARE_NAME))
+        self.assertIsNone(inventory.get_nfs_share_id(self._get_share_path()))
+
+    @patch.object(FreeNASServer, 'invoke_command')
+    def test_create_snapshot_already_in_inventory(self, mock_rest_cmd):
+        share = {
+            'name': 'share-1234-4567-78787',
+            'size': 1,
+            'share_id': 'share-1234-4567-78787',
+            'share_proto': test_config.freenas_storage_protocol
+        }
+        snapshot = {'share': share, 'share_name': 'share-1234-4567-78787',
+                    'name': 'share-snap-1234-4567'}
+        self._driver.helper.inventory.add_snapshot(FAKE_SHARE_NAME,
+                                                   FAKE_SNAPSHOT_NAME)
+
+        self._driver.create_snapshot(self._ctx, snapshot)
+
+        self.assertFalse(mock_rest_cmd.called)
@@ -0,0 +1,473 @@
+# Copyright (c) 2017 Agatti Software Labs. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import eventlet
+import httplib
+import json
+import socket
+
+from manila.share.drivers.freenas.freenasapi import CommandResponse
+from manila.share.drivers.freenas.freenasapi import FreeNASApiError
+from manila.share.drivers.freenas.freenasapi import FreeNASCircuitBreaker
+from manila.share.drivers.freenas.freenasapi import FreeNASConnectionPool
+from manila.share.drivers.freenas.freenasapi import FreeNASRetryPolicy
+from manila.share.drivers.freenas.freenasapi import FreeNASScheduler
+from manila.share.drivers.freenas.freenasapi import FreeNASServer
+from manila.share.drivers.freenas.freenasapi import FreeNASTokenBucket
+from manila import test
+from mock import ANY
+from mock import MagicMock
+from mock import patch
+
+
+class FakeHTTPResponse(object):
+
+    def __init__(self, status=200, body='', will_close=False):
+        self.status = status
+        self.reason = 'OK' if status < 400 else 'ERROR'
+        self.msg = {}
+        self.will_close = will_close
+        self._body = body
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._body
+        data, self._body = self._body[:amt], self._body[amt:]
+        return data
+
+
+class TestFreeNASConnectionPool(test.TestCase):
+
+    def setUp(self):
+        super(TestFreeNASConnectionPool, self).setUp()
+        self.pool = FreeNASConnectionPool('1.1.1.1', max_size=2)
+        self.mock_alive = self.mock_object(FreeNASConnectionPool,
+                                           '_is_alive',
+                                           MagicMock(return_value=True))
+
+    def test_reuses_released_connection(self):
+        conn, reused = self.pool.acquire()
+        self.assertFalse(reused)
+        self.pool.release(conn)
+
+        conn2, reused = self.pool.acquire()
+        self.assertTrue(reused)
+        self.assertIs(conn, conn2)
+        stats = self.pool.get_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['in_use'])
+
+    def test_unhealthy_connection_is_evicted(self):
+        conn, _ = self.pool.acquire()
+        self.pool.release(conn)
+        self.mock_alive.return_value = False
+
+        conn2, reused = self.pool.acquire()
+        self.assertFalse(reused)
+        self.assertIsNot(conn, conn2)
+        self.assertEqual(1, self.pool.get_stats()['evictions'])
+
+    def test_idle_connection_expires(self):
+        self.pool._idle_timeout = 0
+        conn, _ = self.pool.acquire()
+        with patch('time.time', side_effect=[100, 200]):
+            self.pool.release(conn)
+        self.assertEqual(0, self.pool.get_stats()['idle'])
+        self.assertEqual(1, self.pool.get_stats()['evictions'])
+
+    def test_non_reusable_connection_is_closed(self):
+        conn, _ = self.pool.acquire()
+        conn.close = MagicMock()
+        self.pool.release(conn, reusable=False)
+        conn.close.assert_called_once_with()
+        self.assertEqual(0, self.pool.get_stats()['idle'])
+
+
+class TestFreeNASServer(test.TestCase):
+
+    def setUp(self):
+        super(TestFreeNASServer, self).setUp()
+        self.server = FreeNASServer('1.1.1.1', 80, username='user',
+                                    password='password')
+        self.conn = MagicMock()
+        self.mock_object(FreeNASConnectionPool, 'connect',
+                         MagicMock(return_value=self.conn))
+        self.mock_object(FreeNASConnectionPool, '_is_alive',
+                         MagicMock(return_value=True))
+
+    def test_invoke_command_keeps_connection_alive(self):
+        self.conn.getresponse.return_value = FakeHTTPResponse(
+            body=json.dumps({'name': 'agattivol'}))
+
+        for _ in range(3):
+            response = self.server.invoke_command(
+                FreeNASServer.SELECT_COMMAND, '/storage/volume/agattivol',
+                None)
+            self.assertEqual(FreeNASServer.STATUS_OK, response['status'])
+
+        stats = self.server.get_pool_stats()
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(2, stats['hits'])
+        self.conn.request.assert_called_with(
+            'GET', '/api/v1/storage/volume/agattivol', None, ANY)
+
+    def test_invoke_command_http_error(self):
+        self.conn.getresponse.return_value = FakeHTTPResponse(status=404)
+
+        response = self.server.invoke_command(
+            FreeNASServer.SELECT_COMMAND, '/storage/volume/agattivol', None)
+
+        self.assertEqual(FreeNASServer.STATUS_ERROR, response['status'])
+        self.assertEqual('404:ERROR', response['response'])
+
+    def test_invoke_command_returns_per_call_response(self):
+        self.conn.getresponse.side_effect = [
+            FakeHTTPResponse(body=json.dumps({'name': 'agattivol'})),
+            FakeHTTPResponse(status=500)]
+
+        first = self.server.invoke_command(
+            FreeNASServer.SELECT_COMMAND, '/storage/volume/agattivol', None)
+        second = self.server.invoke_command(
+            FreeNASServer.SELECT_COMMAND, '/storage/volume/agattivol', None)
+
+        self.assertIsInstance(first, CommandResponse)
+        self.assertEqual(FreeNASServer.STATUS_OK, first.status)
+        self.assertEqual(200, first.code)
+        self.assertEqual({'name': 'agattivol'}, first.body)
+        self.assertEqual(FreeNASServer.STATUS_ERROR, second.status)
+        self.assertEqual(500, second.code)
+        self.assertIsNone(second.body)
+
+    @patch('time.sleep')
+    def test_invoke_command_retries_transient_error(self, mock_sleep):
+        self.conn.getresponse.side_effect = [
+            FakeHTTPResponse(status=502),
+            FakeHTTPResponse(body=json.dumps({'name': 'agattivol'}))]
+
+        response = self.server.invoke_command(
+            FreeNASServer.SELECT_COMMAND, '/storage/volume/agattivol', None)
+
+        self.assertEqual(FreeNASServer.STATUS_OK, response['status'])
+        self.assertEqual(1, mock_sleep.call_count)
+        stats = self.server.get_retry_stats()
+        self.assertEqual(2, stats['attempts'])
+        self.assertEqual(1, stats['retries'])
+        self.assertEqual('closed', stats['circuit_breaker']['state'])
+
+    @patch('time.sleep')
+    def test_invoke_command_does_not_retry_unsafe_post(self, mock_sleep):
+        self.conn.getresponse.return_value = FakeHTTPResponse(status=502)
+
+        response = self.server.invoke_command(
+            FreeNASServer.CREATE_COMMAND, '/sharing/nfs/', '{}')
+
+        self.assertEqual(FreeNASServer.STATUS_ERROR, response['status'])
+        self.assertFalse(mock_sleep.called)
+        self.assertEqual(1, self.server.get_retry_stats()['attempts'])
+
+    @patch('time.sleep')
+    def test_invoke_command_fails_fast_when_breaker_open(self, mock_sleep):
+        self.server = FreeNASServer('1.1.1.1', 80, username='user',
+                                    password='password',
+                                    retry_policy=FreeNASRetryPolicy(0),
+                                    breaker_threshold=2)
+        self.conn.request.side_effect = socket.error(errno.ECONNREFUSED,
+                                                     'Connection refused')
+
+        for _ in range(3):
+            response = self.server.invoke_command(
+                FreeNASServer.SELECT_COMMAND, '/storage/volume/agattivol',
+                None)
+            self.assertEqual(FreeNASServer.STATUS_ERROR, response['status'])
+
+        self.assertEqual(2, self.conn.request.call_count)
+        stats = self.server.get_retry_stats()
+        self.assertEqual(1, stats['rejected'])
+        self.assertEqual('open', stats['circuit_breaker']['state'])
+
+    def test_interrupted_half_open_trial_allows_next_trial(self):
+        self.server = FreeNASServer('1.1.1.1', 80, username='user',
+                                    password='password',
+                                    retry_policy=FreeNASRetryPolicy(0),
+                                    breaker_threshold=1,
+                                    breaker_reset_timeout=0)
+        # A 503 opens the breaker, the half open trial then hangs.
+        responses = [FakeHTTPResponse(status=503), None,
+                     FakeHTTPResponse(body='{}')]
+
+        def _getresponse():
+            response = responses.pop(0)
+            if response is None:
+                eventlet.sleep(1)
+            return response
+        self.conn.getresponse.side_effect = _getresponse
+
+        self.server.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                   '/storage/volume/agattivol', None)
+        self.assertEqual('open', self.server._breaker.get_state())
+        with eventlet.Timeout(0.01, False):
+            self.server.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                       '/storage/volume/agattivol', None)
+        response = self.server.invoke_command(
+            FreeNASServer.SELECT_COMMAND, '/storage/volume/agattivol', None)
+
+        self.assertEqual(FreeNASServer.STATUS_OK, response['status'])
+        self.assertEqual('closed', self.server._breaker.get_state())
+
+    def test_invoke_command_records_metrics(self):
+        body = json.dumps({'name': 'agattivol'})
+        self.conn.getresponse.side_effect = [
+            FakeHTTPResponse(body=body), FakeHTTPResponse(status=404)]
+
+        self.server.invoke_command(
+            FreeNASServer.SELECT_COMMAND, '/storage/volume/agattivol', None)
+        self.server.invoke_command(
+            FreeNASServer.DELETE_COMMAND,
+            '/storage/volume/agattivol/datasets/share-1/', None)
+
+        stats = self.server.get_stats()['requests']
+        select = stats['select /storage/volume']
+        self.assertEqual(1, select['requests'])
+        self.assertEqual(0, select['errors'])
+        self.assertEqual(len(body), select['bytes_received'])
+        self.assertEqual(1, select['latency']['count'])
+        self.assertEqual(1, stats['delete /storage/volume']['errors'])
+
+    def test_stale_connection_resends_idempotent_request(self):
+        self.conn.getresponse.side_effect = [
+            FakeHTTPResponse(body='{}'), httplib.BadStatusLine("''"),
+            FakeHTTPResponse(body=json.dumps({'name': 'agattivol'}))]
+
+        for _ in range(2):
+            response = self.server.invoke_command(
+                FreeNASServer.SELECT_COMMAND, '/storage/volume/agattivol',
+                None)
+
+        self.assertEqual({'name': 'agattivol'}, response.body)
+        self.assertEqual(3, self.conn.request.call_count)
+        self.assertEqual(2, self.server.get_retry_stats()['attempts'])
+
+    def test_timed_out_post_is_not_resent(self):
+        self.conn.getresponse.side_effect = [
+            FakeHTTPResponse(body='{}'), socket.timeout('timed out')]
+
+        self.server.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                   '/storage/volume/agattivol', None)
+        response = self.server.invoke_command(FreeNASServer.CREATE_COMMAND,
+                                              '/sharing/nfs/', '{}')
+
+        self.assertEqual(FreeNASServer.STATUS_ERROR, response['status'])
+        self.assertEqual(2, self.conn.request.call_count)
+
+    def test_timeout_error_response(self):
+        response = self.server._get_error_info(socket.timeout('timed out'))
+
+        self.assertEqual('timeout:timed out', response.response)
+
+    def test_timed_out_request_frees_pool_slot(self):
+        self.server = FreeNASServer('1.1.1.1', 80, username='user',
+                                    password='password', pool_size=1)
+        self.conn.getresponse.side_effect = lambda: eventlet.sleep(1)
+
+        with eventlet.Timeout(0.01, False):
+            self.server.invoke_command(FreeNASServer.SELECT_COMMAND,
+                                       '/storage/volume/agattivol', None)
+
+        self.assertEqual(0, self.server.get_pool_stats()['in_use'])
+        self.conn.getresponse.side_effect = None
+        self.conn.getresponse.return_value = FakeHTTPResponse(body='{}')
+        with eventlet.Timeout(1):
+            response = self.server.invoke_command(
+                FreeNASServer.SELECT_COMMAND, '/storage/volume/agattivol',
+                None)
+        self.assertEqual(FreeNASServer.STATUS_OK, response['status'])
+
+    def test_iter_command_streams_records(self):
+        records = [{'id': i, 'name': 'agtshare-%d' % i, 'used': i}
+                   for i in range(100)]
+        self.server.STREAM_CHUNK_SIZE = 16
+        self.conn.getresponse.return_value = FakeHTTPResponse(
+            body=json.dumps(records))
+
+        result = list(self.server.iter_command('/sharing/nfs/?limit=0',
+                                               fields=('id', 'name')))
+
+        self.assertEqual([{'id': r['id'], 'name': r['name']}
+                          for r in records], result)
+        self.assertEqual(1, self.server.get_pool_stats()['idle'])
+        stats = self.server.get_stats()['requests']['select /sharing/nfs']
+        self.assertEqual(len(json.dumps(records)), stats['bytes_received'])
+
+    def test_iter_command_error(self):
+        self.conn.getresponse.return_value = FakeHTTPResponse(status=404)
+
+        self.assertRaises(FreeNASApiError, list,
+                          self.server.iter_command('/sharing/nfs/'))
+
+    def _slow_send(self, calls):
+        def _send(method, request_d, param_list, headers):
+            calls.append((method, request_d))
+            eventlet.sleep(0.01)
+            return 200, json.dumps({'name': 'agattivol'})
+        self.mock_object(self.server, '_send', _send)
+
+    def test_invoke_command_coalesces_selects(self):
+        calls = []
+        self._slow_send(calls)
+
+        threads = [eventlet.spawn(self.server.invoke_command,
+                                  FreeNASServer.SELECT_COMMAND,
+                                  '/storage/volume/agattivol', None)
+                   for _ in range(3)]
+        responses = [thread.wait() for thread in threads]
+
+        self.assertEqual([('GET', '/storage/volume/agattivol')], calls)
+        self.assertEqual([{'name': 'agattivol'}] * 3,
+                         [response.body for response in responses])
+        self.assertEqual(2, self.server.get_retry_stats()['coalesced'])
+
+    def test_invoke_command_does_not_join_select_older_than_write(self):
+        calls = []
+        self._slow_send(calls)
+
+        first = eventlet.spawn(self.server.invoke_command,
+                               FreeNASServer.SELECT_COMMAND,
+                               '/storage/volume/agattivol', None)
+        eventlet.sleep(0)
+        self.server.invoke_command(FreeNASServer.UPDATE_COMMAND,
+                                   '/storage/volume/agattivol', '{}')
+        second = eventlet.spawn(self.server.invoke_command,
+                                FreeNASServer.SELECT_COMMAND,
+                                '/storage/volume/agattivol', None)
+        first.wait()
+        second.wait()
+
+        self.assertEqual(3, len(calls))
+        self.assertEqual(0, self.server.get_retry_stats()['coalesced'])
+
+    def test_invoke_command_uses_command_priority(self):
+        self.conn.getresponse.return_value = FakeHTTPResponse(body='{}')
+
+        self.server.invoke_command(FreeNASServer.CREATE_COMMAND,
+                                   '/sharing/nfs/', '{}')
+        self.server.invoke_command(FreeNASServer.DELETE_COMMAND,
+                                   '/sharing/nfs/1/', None)
+
+        stats = self.server.get_stats()['scheduler']
+        self.assertEqual(1, stats['wait']['interactive']['count'])
+        self.assertEqual(1, stats['wait']['bulk']['count'])
+        self.assertEqual(0, stats['running'])
+
+
+class TestFreeNASRetryPolicy(test.TestCase):
+
+    def setUp(self):
+        super(TestFreeNASRetryPolicy, self).setUp()
+        self.policy = FreeNASRetryPolicy(max_retries=2)
+
+    def test_post_retried_only_when_not_sent(self):
+        refused = socket.error(errno.ECONNREFUSED, 'Connection refused')
+        reset = socket.error(errno.ECONNRESET, 'Connection reset')
+
+        self.assertTrue(self.policy.should_retry('POST', refused, 1))
+        self.assertFalse(self.policy.should_retry('POST', reset, 1))
+        self.assertTrue(self.policy.should_retry('DELETE', reset, 1))
+        self.assertFalse(self.policy.should_retry('DELETE', reset, 3))
+
+    def test_resend_only_when_safe(self):
+        stale = httplib.BadStatusLine("''")
+        reset = socket.error(errno.ECONNRESET, 'Connection reset')
+        timeout = socket.timeout('timed out')
+
+        self.assertTrue(self.policy.can_resend('GET', stale, True))
+        self.assertTrue(self.policy.can_resend('POST', reset, False))
+        self.assertFalse(self.policy.can_resend('POST', stale, True))
+        self.assertFalse(self.policy.can_resend('GET', timeout, True))
+
+    def test_backoff_is_bounded(self):
+        policy = FreeNASRetryPolicy(backoff=1, max_backoff=4)
+        for attempt in range(1, 10):
+            self.assertLessEqual(policy.get_backoff(attempt), 4)
+
+
+class TestFreeNASCircuitBreaker(test.TestCase):
+
+    @patch('time.time')
+    def test_half_open_trial(self, mock_time):
+        mock_time.return_value = 100
+        breaker = FreeNASCircuitBreaker(threshold=1, reset_timeout=10)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+
+        mock_time.return_value = 111
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+
+        self.assertEqual(FreeNASCircuitBreaker.CLOSED, breaker.get_state())
+        self.assertTrue(breaker.allow())
+
+
+class TestFreeNASScheduler(test.TestCase):
+
+    def test_admits_by_priority(self):
+        scheduler = FreeNASScheduler(max_concurrency=1)
+        order = []
+
+        def _request(name, priority):
+            with scheduler.slot(priority):
+                order.append(name)
+
+        scheduler.acquire()
+        threads = [eventlet.spawn(_request, 'delete', FreeNASScheduler.BULK),
+                   eventlet.spawn(_request, 'stats', FreeNASScheduler.NORMAL),
+                   eventlet.spawn(_request, 'create',
+                                  FreeNASScheduler.INTERACTIVE)]
+        eventlet.sleep(0)
+        stats = scheduler.get_stats()
+        self.assertEqual({'interactive': 1, 'normal': 1, 'bulk': 1},
+                         stats['queue_depth'])
+        scheduler.release()
+        for thread in threads:
+            thread.wait()
+
+        self.assertEqual(['create', 'stats', 'delete'], order)
+        self.assertEqual(3, scheduler.get_stats()['max_queue_depth'])
+
+    def test_timeout_leaves_queue(self):
+        scheduler = FreeNASScheduler(max_concurrency=1)
+        scheduler.acquire()
+
+        with eventlet.Timeout(0.01, False):
+            scheduler.acquire(FreeNASScheduler.INTERACTIVE)
+        scheduler.release()
+
+        stats = scheduler.get_stats()
+        self.assertEqual(0, stats['queue_depth']['interactive'])
+        scheduler.acquire()
+        self.assertEqual(1, scheduler.get_stats()['running'])
+
+    @patch('time.time')
+    def test_token_bucket(self, mock_time):
+        mock_time.return_value = 100
+        bucket = FreeNASTokenBucket(rate=2, burst=2)
+
+        self.assertEqual(0, bucket.take())
+        self.assertEqual(0, bucket.take())
+        self.assertAlmostEqual(0.5, bucket.take())
+
+        mock_time.return_value = 100.5
+        self.assertEqual(0, bucket.take())
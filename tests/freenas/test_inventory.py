@@ -0,0 +1,122 @@
+# Copyright (c) 2017 Agatti Software Labs. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from manila.share.drivers.freenas.freenasapi import FreeNASApiError
+from manila.share.drivers.freenas.freenasapi import FreeNASServer
+from manila.share.drivers.freenas.inventory import FreeNASInventory
+from manila import test
+from mock import MagicMock
+
+FAKE_DATASETS = [{'name': 'testvol'},
+                 {'name': 'testvol/agtshare-1'},
+                 {'name': 'testvol/agtshare-2'},
+                 {'name': 'testvol/agtshare-2/child'}]
+FAKE_NFS_SHARES = [{'id': 7, 'nfs_paths': ['/mnt/testvol/agtshare-1']}]
+FAKE_SNAPSHOTS = [{'name': 'agtsnap-1', 'filesystem': 'testvol/agtshare-1'},
+                  {'name': 'other', 'filesystem': 'othervol/data'}]
+
+
+class TestFreeNASInventory(test.TestCase):
+
+    def setUp(self):
+        super(TestFreeNASInventory, self).setUp()
+        self.handle = MagicMock()
+        self.listings = {
+            FreeNASServer.REST_API_VOLUME: FAKE_DATASETS,
+            FreeNASServer.REST_API_SHARE: FAKE_NFS_SHARES,
+            FreeNASServer.REST_API_SNAPSHOT: FAKE_SNAPSHOTS,
+        }
+
+        def _iter(request, fields=None, priority=None):
+            for endpoint, body in self.listings.items():
+                if request.startswith(endpoint):
+                    return iter(body)
+        self.handle.iter_command.side_effect = _iter
+        self.inventory = FreeNASInventory(self.handle, 'testvol')
+
+    def test_load(self):
+        self.inventory.load()
+
+        self.assertTrue(self.inventory.loaded)
+        self.assertEqual(['agtshare-1', 'agtshare-2'],
+                         sorted(self.inventory.datasets))
+        self.assertEqual(7, self.inventory.get_nfs_share_id(
+            '/mnt/testvol/agtshare-1'))
+        self.assertTrue(self.inventory.has_snapshot('agtshare-1',
+                                                    'agtsnap-1'))
+        self.assertEqual(['agtshare-1'], list(self.inventory.snapshots))
+
+    def test_load_error(self):
+        self.handle.iter_command.side_effect = FreeNASApiError(503, 'down')
+
+        self.assertRaises(FreeNASApiError, self.inventory.load)
+        self.assertFalse(self.inventory.loaded)
+
+    def test_reconcile(self):
+        self.inventory.load()
+        self.inventory.add_dataset('agtshare-3')
+        self.listings[FreeNASServer.REST_API_VOLUME] = [
+            {'name': 'testvol/agtshare-1'}, {'name': 'testvol/agtshare-4'}]
+
+        diff = self.inventory.reconcile()
+
+        self.assertEqual((1, 2), diff['datasets'])
+        self.assertEqual(['agtshare-1', 'agtshare-4'],
+                         sorted(self.inventory.datasets))
+
+    def test_reconcile_keeps_local_changes_made_during_listing(self):
+        self.inventory.load()
+        listing = self.handle.iter_command.side_effect
+
+        def _iter(request, fields=None, priority=None):
+            if request.startswith(FreeNASServer.REST_API_VOLUME):
+                self.inventory.add_dataset('agtshare-3')
+            return listing(request, fields)
+        self.handle.iter_command.side_effect = _iter
+
+        self.inventory.reconcile()
+
+        self.assertTrue(self.inventory.has_dataset('agtshare-3'))
+
+    def test_provisioned_capacity(self):
+        gb = 1024 * 1024 * 1024
+        self.listings[FreeNASServer.REST_API_VOLUME] = [
+            {'name': 'testvol/agtshare-1', 'refquota': 2 * gb},
+            {'name': 'testvol/agtshare-2', 'refquota': 'none'}]
+        self.inventory.load()
+        self.assertEqual(2, self.inventory.provisioned_gb)
+
+        self.inventory.add_dataset('agtshare-3', size=5)
+        self.assertEqual(7, self.inventory.provisioned_gb)
+        self.inventory.update_dataset('agtshare-3', refquota='10G')
+        self.assertEqual(12, self.inventory.provisioned_gb)
+        self.inventory.remove_dataset('agtshare-1')
+        self.assertEqual(10, self.inventory.provisioned_gb)
+
+        self.inventory.reconcile()
+
+        self.assertEqual(2, self.inventory.provisioned_gb)
+
+    def test_managed_datasets(self):
+        self.listings[FreeNASServer.REST_API_VOLUME] = [
+            {'name': 'testvol/legacy', 'comments': 'manila-share:share-1'},
+            {'name': 'testvol/agtshare-2', 'comments': 'other'}]
+        self.inventory.load()
+
+        self.assertEqual('legacy',
+                         self.inventory.get_managed_dataset('share-1'))
+        self.assertEqual({'share-1': 'legacy'}, self.inventory.managed)
+
+        self.inventory.update_dataset('legacy', comments='')
+        self.assertIsNone(self.inventory.get_managed_dataset('share-1'))
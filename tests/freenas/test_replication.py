@@ -0,0 +1,108 @@
+# Copyright (c) 2017 Agatti Software Labs. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+
+from manila.share.drivers.freenas.freenasapi import FreeNASApiError
+from manila.share.drivers.freenas.replication import FreeNASReplica
+from manila.share.drivers.freenas.replication import FreeNASReplicator
+from manila.share.drivers.freenas import utils
+from manila import test
+from mock import MagicMock
+
+
+class TestFreeNASReplicator(test.TestCase):
+
+    def setUp(self):
+        super(TestFreeNASReplicator, self).setUp()
+        self.source = MagicMock()
+        self.target = MagicMock()
+        self.replicator = FreeNASReplicator(interval=0)
+        self.received = {}
+
+        def _get_replication(share_name, target, replica_name):
+            if replica_name not in self.received:
+                return None
+            return {'repl_lastsnapshot': self.received[replica_name]}
+        self.source.get_replication.side_effect = _get_replication
+
+    def _replica(self, replica_name, share_name='share-1'):
+        replica = FreeNASReplica(self.source, share_name, self.target,
+                                 replica_name)
+        self.replicator.track(replica)
+        return replica
+
+    def test_refresh_updates_lag(self):
+        replica = self._replica('replica-1')
+        self.received['replica-1'] = ''
+
+        self.assertIsNone(self.replicator.refresh(replica))
+        self.assertIsNone(self.replicator.get_lag('replica-1'))
+
+        now = int(time.time())
+        self.received['replica-1'] = 'testvol/agtshare-1@%s' % (
+            utils.generate_replica_snapshot_name(now - 60))
+        self.assertEqual(now - 60, self.replicator.refresh(replica))
+        self.assertTrue(60 <= self.replicator.get_lag('replica-1') < 120)
+        self.assertEqual({'replica-1'},
+                         set(self.replicator.get_stats()['lag']))
+
+    def test_refresh_missing_task(self):
+        replica = self._replica('replica-1')
+
+        self.assertRaises(FreeNASApiError, self.replicator.refresh, replica)
+
+    def test_sync_prunes_to_oldest_received(self):
+        self._replica('replica-1')
+        self._replica('replica-2')
+        self.received['replica-1'] = utils.generate_replica_snapshot_name(200)
+        self.received['replica-2'] = utils.generate_replica_snapshot_name(100)
+
+        self.assertEqual(0, self.replicator.sync())
+
+        self.source.take_replication_snapshot.assert_called_once_with(
+            'share-1')
+        self.source.prune_replication_snapshots.assert_called_once_with(
+            'share-1', 100)
+        self.assertIsNotNone(self.replicator.get_stats()['last_sync'])
+
+    def test_sync_keeps_snapshots_until_all_received(self):
+        self._replica('replica-1')
+        self._replica('replica-2')
+        self.received['replica-1'] = utils.generate_replica_snapshot_name(200)
+        self.received['replica-2'] = ''
+
+        self.assertEqual(0, self.replicator.sync())
+
+        self.assertFalse(self.source.prune_replication_snapshots.called)
+
+    def test_sync_counts_failed_shares(self):
+        self._replica('replica-1', share_name='share-1')
+        self._replica('replica-2', share_name='share-2')
+        self.received['replica-2'] = utils.generate_replica_snapshot_name(100)
+
+        self.assertEqual(1, self.replicator.sync())
+        self.source.prune_replication_snapshots.assert_called_once_with(
+            'share-2', 100)
+
+    def test_forget(self):
+        replica = self._replica('replica-1')
+        self.received['replica-1'] = utils.generate_replica_snapshot_name(100)
+        self.replicator.refresh(replica)
+
+        self.replicator.forget('replica-1')
+
+        self.assertIsNone(self.replicator.get_lag('replica-1'))
+        self.assertEqual(0, self.replicator.sync())
+        self.assertFalse(self.source.take_replication_snapshot.called)
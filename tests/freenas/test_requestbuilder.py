@@ -0,0 +1,93 @@
+# Copyright (c) 2017 Agatti Software Labs. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from manila.share.drivers.freenas.freenasapi import FreeNASServer
+from manila.share.drivers.freenas.requestbuilder import FreeNASRequestBuilder
+from manila.share.drivers.freenas import utils
+from manila import test
+from mock import patch
+
+
+class TestFreeNASRequestBuilder(test.TestCase):
+
+    def setUp(self):
+        super(TestFreeNASRequestBuilder, self).setUp()
+        self.builder = FreeNASRequestBuilder('testvol', '/mnt/testvol',
+                                             cache_size=2)
+
+    def test_urls(self):
+        self.assertEqual('%s/testvol/' % FreeNASServer.REST_API_VOLUME,
+                         self.builder.volume_url)
+        self.assertEqual('%s/testvol/%s/agtshare-1/' % (
+            FreeNASServer.REST_API_VOLUME, FreeNASServer.DATASET),
+            self.builder.dataset_url('agtshare-1'))
+        self.assertEqual('%s/4/' % FreeNASServer.REST_API_SHARE,
+                         self.builder.nfs_share_url(4))
+        self.assertEqual('%s/testvol/agtshare-1@agtsnap-2/' % (
+            FreeNASServer.REST_API_SNAPSHOT),
+            self.builder.snapshot_url('agtshare-1', 'agtsnap-2'))
+        self.assertEqual('%s/testvol/agtshare-1@agtsnap-2/%s/' % (
+            FreeNASServer.REST_API_SNAPSHOT, FreeNASServer.CLONE),
+            self.builder.snapshot_url('agtshare-1', 'agtsnap-2',
+                                      FreeNASServer.CLONE))
+        self.assertEqual('%s/testvol/agtshare-1@a%%25b/' % (
+            FreeNASServer.REST_API_SNAPSHOT),
+            self.builder.snapshot_range_url('agtshare-1', 'a', 'b'))
+        self.assertEqual('%s/3/' % FreeNASServer.REST_API_REPLICATION,
+                         self.builder.replication_url(3))
+
+    def test_get_share(self):
+        dataset = self.builder.get_share('share-1234-4567')
+
+        self.assertEqual('agtshare-1234', dataset.name)
+        self.assertEqual('/mnt/testvol/agtshare-1234', dataset.mountpoint)
+        self.assertEqual(self.builder.dataset_url('agtshare-1234'),
+                         dataset.url)
+        self.assertEqual(utils.generate_share_name(
+            'share-1234-4567', '/mnt/testvol')['mountpoint'],
+            dataset.mountpoint)
+
+    @patch.object(utils, 'generate_share_name',
+                  wraps=utils.generate_share_name)
+    def test_share_identities_are_memoized(self, mock_generate):
+        first = self.builder.get_share('share-1-a')
+
+        self.assertIs(first, self.builder.get_share('share-1-a'))
+        self.assertEqual(1, mock_generate.call_count)
+        self.builder.get_share('share-2-a')
+        self.builder.get_share('share-1-a')
+        # share-2 is the least recently used one and is dropped.
+        self.builder.get_share('share-3-a')
+        self.builder.get_share('share-1-a')
+        self.assertEqual(3, mock_generate.call_count)
+        self.builder.get_share('share-2-a')
+        self.assertEqual(4, mock_generate.call_count)
+
+    def test_get_snapshot_name(self):
+        self.assertEqual('agtsnap-1234',
+                         self.builder.get_snapshot_name('share-snap-1234'))
+
+
+class TestLRUCache(test.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = utils.LRUCache(2)
+        cache.get('a', str.upper)
+        cache.get('b', str.upper)
+        cache.get('a', str.upper)
+        cache.get('c', str.upper)
+
+        self.assertEqual(2, len(cache))
+        self.assertEqual('A', cache.get('a', lambda key: None))
+        self.assertIsNone(cache.get('b', lambda key: None))
@@ -0,0 +1,76 @@
+# Copyright (c) 2017 Agatti Software Labs. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from manila.share.drivers.freenas.retention import FreeNASRetentionPolicy
+from manila.share.drivers.freenas import utils
+from manila import test
+
+# Monday 2017-09-04 12:00 UTC
+NOW = 1504526400
+DAY = 86400
+# Two snapshots a day, newest first.
+SNAPSHOTS = [('snap-%d' % i, NOW - i * DAY // 2) for i in range(40)]
+
+
+class TestFreeNASRetentionPolicy(test.TestCase):
+
+    def _kept(self, policy, snapshots=SNAPSHOTS):
+        expired = policy.get_expired(snapshots)
+        return [name for name, _taken in snapshots if name not in expired]
+
+    def test_no_rules_keeps_everything(self):
+        policy = FreeNASRetentionPolicy()
+
+        self.assertFalse(policy.enabled)
+        self.assertEqual([], policy.get_expired(SNAPSHOTS))
+
+    def test_keep_last(self):
+        policy = FreeNASRetentionPolicy(keep_last=3)
+
+        self.assertEqual(['snap-0', 'snap-1', 'snap-2'], self._kept(policy))
+        # Oldest first.
+        self.assertEqual('snap-39', policy.get_expired(SNAPSHOTS)[0])
+
+    def test_keep_daily(self):
+        policy = FreeNASRetentionPolicy(keep_daily=3)
+
+        self.assertEqual(['snap-0', 'snap-2', 'snap-4'], self._kept(policy))
+
+    def test_keep_weekly(self):
+        policy = FreeNASRetentionPolicy(keep_weekly=3)
+
+        # Newest of this week, and of the weeks ending Sunday 09-03 and
+        # Sunday 08-27.
+        self.assertEqual(['snap-0', 'snap-2', 'snap-16'], self._kept(policy))
+
+    def test_rules_combine(self):
+        policy = FreeNASRetentionPolicy(keep_last=2, keep_daily=2,
+                                        keep_weekly=2)
+
+        self.assertEqual(['snap-0', 'snap-1', 'snap-2'], self._kept(policy))
+
+    def test_unknown_age_is_kept(self):
+        policy = FreeNASRetentionPolicy(keep_last=1)
+        snapshots = SNAPSHOTS[:3] + [('manual', None)]
+
+        self.assertEqual(['snap-2', 'snap-1'], policy.get_expired(snapshots))
+
+    def test_get_snapshot_time(self):
+        self.assertEqual(NOW, utils.get_snapshot_time(
+            {'name': 'auto-20170904.1200-2w'}))
+        self.assertEqual(NOW, utils.get_snapshot_time(
+            {'name': 'agtrepl-%d' % NOW}))
+        self.assertEqual(5, utils.get_snapshot_time(
+            {'name': 'agtsnap-1', 'creation': {'rawvalue': '5'}}))
+        self.assertIsNone(utils.get_snapshot_time({'name': 'agtsnap-1'}))